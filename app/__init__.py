@@ -47,7 +47,7 @@ from sqlalchemy import JSON
 from app import mongo, log_functions
 from app.smtp import Mailer
 from app.config import config
-from app.models import db, User
+from app.models import db, User, upgrade_report_table
 from app.certification import generate_symmetric_key
 from app.scripts import prettify_time_diff
 
@@ -170,7 +170,10 @@ if config['smtp_enabled']: # we should do something with this later on
                             port = config['smtp_port'],
                             username = config['smtp_username'],
                             password = config['smtp_password'],
-                            from_address = config['smtp_from_address'])
+                            from_address = config['smtp_from_address'],
+                            pool_size = config['smtp_pool_size'],
+                            keepalive_interval = config['smtp_keepalive_interval'],
+                            timeout = config['smtp_timeout'])
 
         mailer.send_mail(subject=f"{config['site_name']} online", content=f"{config['site_name']} is now online at {config['domain']}.", to_address=config['default_user_email'], logfile=log)
     
@@ -197,6 +200,19 @@ pd.options.mode.chained_assignment = None
 
 
 
+# form uploads may be larger than other requests, so here we only allow request bodies of up 
+# to `max_form_upload_size` on the form upload view; every other view keeps the app's global 
+# MAX_CONTENT_LENGTH, which is `max_upload_size`. Nb. Flask 2.3 does not let us set this on the 
+# request from within the view, and the endpoint is matched before the request body is parsed.
+class LibreFormsRequest(Flask.request_class):
+
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'forms.upload_forms':
+            return config['max_form_upload_size']
+        return super().max_content_length
+
+
 ##########################
 # Flask App - define a Flask app using the create_app() / factory method with blueprints
 ##########################
@@ -208,6 +224,7 @@ def create_app(test_config=None, celery_app=False, db_init_only=False):
  
     # create the app object
     app = Flask(__name__, instance_relative_config=True)
+    app.request_class = LibreFormsRequest
 
     # add some app configurations
     app.config.from_mapping(
@@ -219,14 +236,22 @@ def create_app(test_config=None, celery_app=False, db_init_only=False):
         # SQLALCHEMY_DATABASE_URI = f'sqlite:///{os.path.join(app.instance_path, "app.sqlite")}',
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         UPLOAD_FOLDER = config['upload_folder'],
+        # form uploads are allowed up to `max_form_upload_size`, see LibreFormsRequest
         MAX_CONTENT_LENGTH = config['max_upload_size'],
         HCAPTCHA_ENABLED = config['enable_hcaptcha'],
         HCAPTCHA_SITE_KEY = config['hcaptcha_site_key'] if config['hcaptcha_site_key'] else None,
         HCAPTCHA_SECRET_KEY = config['hcaptcha_secret_key'] if config['hcaptcha_secret_key'] else None,
         REPORT_SEND_RATE=config['report_send_rate'],
+        REPORT_FAN_OUT=config['report_fan_out'],
+        REPORT_TASK_MAX_RETRIES=config['report_task_max_retries'],
+        MAIL_DIGEST_WINDOW=config['mail_digest_window'],
+        MAIL_DIGEST_FLUSH_RATE=config['mail_digest_flush_rate'],
         USE_ELASTICSEARCH_AS_WRAPPER = config['use_elasticsearch_as_wrapper'],
+        USE_SQLITE_FTS_SEARCH = config['use_sqlite_fts_search'],
         EXCLUDE_FORMS_FROM_SEARCH=config['exclude_forms_from_search'] if config['exclude_forms_from_search'] else [],
         ELASTICSEARCH_INDEX_REFRESH_RATE=config['elasticsearch_index_refresh_rate'],
+        ANALYTICS_EXPORT_RATE=config['analytics_export_rate'],
+        DATAFRAME_CHUNK_SIZE=config['dataframe_chunk_size'],
         CELERY_CONFIG={
             'broker_url':config['celery_broker'],
             'result_backend':config['celery_backend'],
@@ -248,6 +273,10 @@ def create_app(test_config=None, celery_app=False, db_init_only=False):
         os.makedirs(app.instance_path)
     except OSError:
         pass
+
+    # we keep the embedded search index in the instance folder by default, like app.sqlite
+    if not config['sqlite_fts_path']:
+        config['sqlite_fts_path'] = os.path.join(app.instance_path, 'search.sqlite')
     try:
         os.makedirs(config['upload_folder'])
     except OSError:
@@ -299,6 +328,18 @@ def create_app(test_config=None, celery_app=False, db_init_only=False):
 
         db.create_all()
 
+        # add columns introduced after the report table was created, see app.models
+        if upgrade_report_table():
+            log.info('LIBREFORMS - upgraded the report table.')
+
+        # count existing submissions in the daily rollups the first time we start, see app.mongo;
+        # we don't stop the application if MongoDB is unavailable, since writes keep them current
+        try:
+            if mongodb.initialize_submission_rollups():
+                log.info('LIBREFORMS - built the daily submission rollups.')
+        except Exception as e:
+            log.warning(f'LIBREFORMS - could not build the daily submission rollups: {e}')
+
         # create default user if doesn't exist
         # solution from https://stackoverflow.com/a/39288652
         user = db.session.query(User).filter_by(id=1)
@@ -360,6 +401,20 @@ def create_app(test_config=None, celery_app=False, db_init_only=False):
         # log our success connecting to elasticsearch
         log.info('LIBREFORMS - connected to elasticsearch server.' )
 
+    # here we schedule a celery task to send written documents to the search index, see 
+    # app.search_index; we import the task when it is called to avoid circular imports
+    if (config['use_elasticsearch_as_wrapper'] or config['use_sqlite_fts_search']) and config['search_index_on_write']:
+
+        def schedule_search_index_flush(countdown):
+            # a failure here should not fail the write; the periodic index cycle will pick up the events
+            try:
+                from celeryd.tasks import flush_search_index_events_async
+                flush_search_index_events_async.apply_async(countdown=countdown)
+            except Exception as e:
+                log.warning(f'LIBREFORMS - could not schedule a search index flush: {e}')
+
+        mongodb.search_index_listener = schedule_search_index_flush
+
     # # we define the elasticsearch indexing task here
     # @celery.task()
     # def elasticsearch_index_document(body, id, index="submissions"):
@@ -581,6 +636,20 @@ def create_app(test_config=None, celery_app=False, db_init_only=False):
         app.register_blueprint(cli.bp, cli_group='libreforms')
         # app.cli.groups['libreforms'].help = 'libreforms command group help text'
 
+    # here we record the version of the form definitions loaded by this worker, and then
+    # check before each request whether another worker has published a newer version,
+    # see app.form_registry.
+    from app.form_registry import sync_form_registry_version, refresh_form_registry_if_stale
+    sync_form_registry_version()
+
+    @app.before_request
+    def refresh_form_registry():
+        try:
+            if refresh_form_registry_if_stale():
+                log.info(f'LIBREFORMS - reloaded form definitions.')
+        except Exception as e:
+            log.warning(f'LIBREFORMS - failed to reload form definitions: {e}')
+
     @app.before_request
     def make_session_permanent():
         session.permanent = True
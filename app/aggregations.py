@@ -0,0 +1,335 @@
+"""
+aggregations.py: server-side aggregation of form data for dashboards
+
+Dashboards, see app.views.dashboards, used to read every submission for a form into
+a dataframe and pass it to plotly, which serialized each point into the page. This
+script pushes the work behind each `_dashboard` config down to MongoDB, so that only
+the `x`, `y` and `color` fields are read, and bar charts and histograms are returned
+as one row per bin, rather than one row per submission.
+
+# aggregate_bar_data(form_name, x, y=None, color=None)
+
+This groups submissions by their `x` (and `color`) values using a $group stage, and
+sums `y` for each group, or counts the submissions in each group if `y` is not set;
+this matches the default behavior of plotly's histogram function, which we previously
+used to render bar charts.
+
+# aggregate_histogram_data(form_name, x, y=None, color=None, bins=None)
+
+This bins submissions by `x` and sums `y` (or counts submissions) in each bin. We bin
+numeric fields into `bins` equal-width bins between the minimum and maximum value,
+timestamps and date fields into days, and treat any other field as categorical, in
+which case this is the same as aggregate_bar_data().
+
+# load_point_data(form_name, fields, sort=None)
+
+Scatter and line charts plot each submission, so these cannot be binned; instead, we
+project only the fields the chart needs and, if there are more than `dashboard_max_points`
+submissions, take a random sample of that size in the database. We return the points
+along with the number of points available before sampling.
+
+# downsample_line_data(df, x, y, color=None, target_points=None)
+
+This reduces a line chart to at most `target_points` points (split between each `color`
+series) using the Largest-Triangle-Three-Buckets (LTTB) algorithm, which keeps the points
+that contribute most to the visible shape of each series, so peaks and troughs survive.
+
+# downsample_scatter_data(df, color=None, target_points=None, random_state=None)
+
+This reduces a scatter chart to at most `target_points` points using stratified random
+sampling: each `color` group keeps a share of the points proportional to its size (and
+at least one point), so small groups do not disappear from the chart.
+
+# aggregate_rollup_data(form_name, color=None)
+
+Dashboards that only need the number of submissions per day can set `"source": "rollups"` 
+in their `_dashboard` config, in which case we read the daily submission rollups (see 
+MongoDB.query_submission_rollups) instead of the form's documents. These dashboards may
+be colored by `owner` or `approval` state.
+
+# get_cached_figure(key) / cache_figure(key, figure)
+
+Rendering a dashboard figure means querying, downsampling and encoding it as plotly JSON,
+which is wasted work if the form has not changed since the figure was last rendered. We
+keep an in-process, least-recently-used cache of up to `dashboard_figure_cache_size` figures.
+The dashboards view keys each figure on the form, dashboard index, theme and y override,
+as well as the form's write version (see MongoDB.bump_write_version) and the version of
+the form definitions, so any write to a form invalidates exactly that form's figures.
+
+"""
+
+__name__ = "app.aggregations"
+__author__ = "Sig Janoska-Bedi"
+__credits__ = ["Sig Janoska-Bedi"]
+__version__ = "2.2.0"
+__license__ = "AGPL-3.0"
+__maintainer__ = "Sig Janoska-Bedi"
+__email__ = "signe@atreeus.com"
+
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from app.config import config
+from app.mongo import mongodb
+from app.form_registry import compile_form_schema
+
+
+# here we store rendered dashboard figures, see get_cached_figure()
+_figure_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
+
+
+# here we determine how we should bin a field: numeric fields by value, timestamp and date
+# fields by day, and any other field as categorical
+def get_field_kind(form_name, field):
+
+    if field in [mongodb.metadata_field_names['timestamp'], f"{mongodb.metadata_field_names['metadata']}.created_timestamp"]:
+        return 'date'
+
+    schema = compile_form_schema(form_name)
+
+    if field in schema and schema[field]['type'] in ['int', 'float']:
+        return 'numeric'
+
+    if field in schema and schema[field]['type'] == 'date':
+        return 'date'
+
+    return 'categorical'
+
+
+# we convert values to numbers in the pipeline, setting any that cannot be converted to null
+def numeric_expression(field):
+    return {'$convert': {'input': f'${field}', 'to': 'double', 'onError': None, 'onNull': None}}
+
+
+def value_accumulator(y=None):
+    return {'$sum': numeric_expression(y)} if y else {'$sum': 1}
+
+
+# here we build the dataframe returned to the view from the $group results, which are keyed
+# on an `_id` dict with `x` and (optionally) `color` keys, and sorted by `x` in the pipeline
+def build_aggregation_dataframe(results, x, y=None, color=None):
+
+    value = y if y else 'count'
+
+    df = pd.DataFrame([{x: r['_id'].get('x'), **({color: r['_id'].get('color')} if color else {}), value: r['value']} for r in results],
+                        columns=[x] + ([color] if color else []) + [value])
+
+    return df
+
+
+def aggregate_bar_data(form_name, x, y=None, color=None):
+
+    pipeline = [
+        {'$match': {x: {'$ne': None}}},
+        {'$group': {
+            '_id': {'x': f'${x}', **({'color': f'${color}'} if color else {})},
+            'value': value_accumulator(y),
+        }},
+        {'$sort': {'_id.x': 1}},
+    ]
+
+    return build_aggregation_dataframe(mongodb.aggregate_collection(form_name, pipeline), x, y=y, color=color)
+
+
+def aggregate_histogram_data(form_name, x, y=None, color=None, bins=None):
+
+    bins = bins if bins else config['dashboard_histogram_bins']
+    kind = get_field_kind(form_name, x)
+
+    if kind == 'categorical':
+        return aggregate_bar_data(form_name, x, y=y, color=color)
+
+    if kind == 'date':
+
+        # timestamps are stored as strings starting YYYY-MM-DD, so we bin them by day
+        # using the first ten characters
+        pipeline = [
+            {'$match': {x: {'$type': 'string'}}},
+            {'$group': {
+                '_id': {'x': {'$substrBytes': [f'${x}', 0, 10]}, **({'color': f'${color}'} if color else {})},
+                'value': value_accumulator(y),
+            }},
+            {'$sort': {'_id.x': 1}},
+        ]
+
+        df = build_aggregation_dataframe(mongodb.aggregate_collection(form_name, pipeline), x, y=y, color=color)
+        df[x] = pd.to_datetime(df[x], errors='coerce')
+        return df
+
+    # for numeric fields, we first find the range of values, and then group each value into
+    # one of `bins` equal-width bins, which we label using the midpoint of the bin
+    bounds = list(mongodb.aggregate_collection(form_name, [
+        {'$group': {'_id': None, 'min': {'$min': numeric_expression(x)}, 'max': {'$max': numeric_expression(x)}}},
+    ]))
+
+    if len(bounds) < 1 or bounds[0]['min'] is None:
+        return build_aggregation_dataframe([], x, y=y, color=color)
+
+    minimum, maximum = bounds[0]['min'], bounds[0]['max']
+    width = (maximum - minimum) / bins if maximum > minimum else 1
+
+    pipeline = [
+        {'$addFields': {'__value': numeric_expression(x)}},
+        {'$match': {'__value': {'$ne': None}}},
+        {'$group': {
+            '_id': {
+                # the maximum value falls at the upper edge of the last bin, so we cap the bin index
+                'x': {'$min': [bins-1, {'$floor': {'$divide': [{'$subtract': ['$__value', minimum]}, width]}}]},
+                **({'color': f'${color}'} if color else {}),
+            },
+            'value': value_accumulator(y),
+        }},
+        {'$sort': {'_id.x': 1}},
+    ]
+
+    df = build_aggregation_dataframe(mongodb.aggregate_collection(form_name, pipeline), x, y=y, color=color)
+    df[x] = minimum + (df[x] + 0.5) * width
+    return df
+
+
+def load_point_data(form_name, fields, sort=None):
+
+    fields = [x for x in dict.fromkeys(fields) if x]
+
+    pipeline = [
+        {'$match': {fields[0]: {'$ne': None}}},
+        {'$project': {'_id': 0, **{x: 1 for x in fields}}},
+    ]
+
+    # we only sample when there are more points than we are willing to read
+    documents, total, filtered = mongodb.query_collection_page(form_name, projection=['_id'], limit=1)
+    if total > config['dashboard_max_points']:
+        pipeline.append({'$sample': {'size': config['dashboard_max_points']}})
+
+    if sort:
+        pipeline.append({'$sort': {sort: 1}})
+
+    df = pd.DataFrame(list(mongodb.aggregate_collection(form_name, pipeline)), columns=fields)
+
+    # we also return the number of points available, so the view can report the sampling ratio
+    return df, total if total > config['dashboard_max_points'] else len(df.index)
+
+
+# these are the fields the submission rollups can be grouped by, besides the day
+ROLLUP_COLOR_FIELDS = ['owner', 'approval']
+
+
+def aggregate_rollup_data(form_name, color=None):
+
+    color = color if color in ROLLUP_COLOR_FIELDS else None
+
+    df = mongodb.query_submission_rollups(form_names=[form_name], group_by=['day'] + ([color] if color else []))
+    df['day'] = pd.to_datetime(df['day'], errors='coerce')
+
+    return df
+
+
+# here we convert x values to floats so we can compute triangle areas; datetimes (and
+# strings that parse as datetimes, like timestamps) are converted to nanoseconds
+def get_numeric_axis(series):
+
+    numeric = pd.to_numeric(series, errors='coerce')
+
+    if numeric.notna().all():
+        return numeric.astype(float).to_numpy()
+
+    dates = pd.to_datetime(series, errors='coerce')
+    return dates.astype('int64').astype(float).to_numpy()
+
+
+# this returns the positions of the points LTTB keeps from a series of `len(x)` points, which 
+# we expect to be sorted by x; see Sveinn Steinarsson, "Downsampling Time Series for Visual 
+# Representation" (2013). We always keep the first and last points.
+def lttb_indices(x, y, threshold):
+
+    length = len(x)
+
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+
+    indices = [0]
+    bucket_size = (length - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+
+        # the average point of the next bucket is the third vertex of each triangle
+        next_start = int(np.floor((i + 1) * bucket_size)) + 1
+        next_end = min(int(np.floor((i + 2) * bucket_size)) + 1, length)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        start = int(np.floor(i * bucket_size)) + 1
+        end = int(np.floor((i + 1) * bucket_size)) + 1
+
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+
+        a = start + int(np.nanargmax(areas)) if not np.isnan(areas).all() else start
+        indices.append(a)
+
+    indices.append(length - 1)
+
+    return np.array(indices)
+
+
+def downsample_line_data(df, x, y, color=None, target_points=None):
+
+    target_points = target_points if target_points else config['dashboard_target_points']
+
+    if len(df.index) <= target_points:
+        return df
+
+    groups = [group for _, group in df.groupby(color, sort=False)] if color else [df]
+
+    # we split the target between each series in proportion to its size
+    sampled = []
+    for group in groups:
+
+        group = group.dropna(subset=[y])
+        threshold = max(int(target_points * len(group.index) / len(df.index)), 3)
+
+        keep = lttb_indices(get_numeric_axis(group[x]), pd.to_numeric(group[y], errors='coerce').astype(float).to_numpy(), threshold)
+        sampled.append(group.iloc[keep])
+
+    return pd.concat(sampled, ignore_index=True) if len(sampled) > 0 else df.iloc[0:0]
+
+
+def downsample_scatter_data(df, color=None, target_points=None, random_state=None):
+
+    target_points = target_points if target_points else config['dashboard_target_points']
+
+    if len(df.index) <= target_points:
+        return df
+
+    if not color:
+        return df.sample(n=target_points, random_state=random_state).reset_index(drop=True)
+
+    fraction = target_points / len(df.index)
+
+    return df.groupby(color, group_keys=False, sort=False, dropna=False).apply(
+                lambda group: group.sample(n=max(int(round(len(group.index) * fraction)), 1), random_state=random_state)
+            ).reset_index(drop=True)
+
+
+def get_cached_figure(key):
+
+    with _figure_cache_lock:
+
+        if key not in _figure_cache:
+            return None
+
+        _figure_cache.move_to_end(key)
+        return _figure_cache[key]
+
+
+def cache_figure(key, figure):
+
+    with _figure_cache_lock:
+
+        _figure_cache[key] = figure
+        _figure_cache.move_to_end(key)
+
+        while len(_figure_cache) > config['dashboard_figure_cache_size']:
+            _figure_cache.popitem(last=False)
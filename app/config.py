@@ -156,6 +156,14 @@ config['smtp_username'] = None
 config['smtp_password'] = None 
 config['smtp_from_address'] = None 
 
+# these configs control the pool of SMTP connections each process keeps open to 
+# the mail server, see app.smtp: at most `smtp_pool_size` connections, which are 
+# checked with a NOOP before reuse if they have been idle for longer than 
+# `smtp_keepalive_interval` seconds. `smtp_timeout` is the socket timeout in seconds.
+config['smtp_pool_size'] = 2
+config['smtp_keepalive_interval'] = 30
+config['smtp_timeout'] = 30
+
 
 # this configuration is used to set custom logic at the bottom of user profiles.
 # nb. this will show up for ALL USERS and ALL GROUPS by default, and be universally
@@ -176,6 +184,16 @@ config['celery_backend'] = 'rpc://'
 # this config enables support for sending emails asynchronously using Celery.
 config['send_mail_asynchronously'] = True
 
+# form notifications (submissions, updates and approval decisions) are sent right away
+# by default. If `mail_digest_window` is set to a number of seconds, we instead queue
+# each notification for each recipient, and merge a recipient's notifications into a 
+# single digest once the oldest has waited this long; celery checks for digests that 
+# are due every `mail_digest_flush_rate` seconds. Approval requests are always sent 
+# right away, and forms can opt out by setting `_digest_notifications` to False. See
+# app.notifications for more details.
+config['mail_digest_window'] = None
+config['mail_digest_flush_rate'] = 60.0
+
 
 # this config enables support for writing forms to MongoDB asynchronously using
 # Celery. See discussion at https://github.com/libreForms/libreForms-flask/issues/180.
@@ -222,11 +240,33 @@ config['enable_user_profile_log_aggregation'] = False
 # send system reports (eg. complex reports with a routing list, instead of
 # single-user reports). The `user_defined_reports` will allow users to create
 # reports when it assesses to True. The `report_send_rate` config is a float 
-# defining the interval (in seconds) we want to set between sending reports.
+# defining the interval (in seconds) at which we check for due reports; each
+# check only reads the reports that are due, see app.filters, so this can be
+# short without its cost growing with the number of reports.
 config['enable_reports'] = True
 config['system_reports'] = None
 config['user_defined_reports'] = True
-config['report_send_rate'] = 3600.0
+config['report_send_rate'] = 60.0
+
+# these configs control how due reports are sent. By default, a single celery task sends
+# every due report in turn. If `report_fan_out` is set to True, that task instead enqueues 
+# one task per form with due reports, each sending at most `report_fan_out_batch_size` 
+# reports, so delivery is spread across workers. At most `report_fan_out_concurrency` of these
+# tasks are in flight at once, counting those waiting to retry: each run only enqueues enough
+# new tasks to make up the difference. Dispatched reports are leased for `report_task_lease` 
+# seconds, after which they are counted as failed and become due again, and failed reports 
+# are retried up to `report_task_max_retries` times, see app.filters. A report that raises an
+# error on that many attempts is skipped until its next scheduled run, in either mode.
+config['report_fan_out'] = False
+config['report_fan_out_batch_size'] = 50
+config['report_fan_out_concurrency'] = 20
+config['report_task_lease'] = 900
+config['report_task_max_retries'] = 3
+
+# this config sets the number of distinct report results each worker caches; results are
+# shared by reports with the same form, filters and time window, and invalidated when the 
+# form is written to, see app.filters. Set this to 0 to disable the cache.
+config['report_evaluation_cache_size'] = 128
 
 # UNTESTED: these configs specify the login credentials for the MongoDB 
 # database, especially useful for externalized databases.
@@ -258,7 +298,74 @@ config['max_upload_size'] = 16 * 1000 * 1000
 # excel uploads, see https://github.com/libreForms/libreForms-flask/issues/184
 # and https://github.com/libreForms/libreForms-flask/issues/378.
 config['allow_form_uploads_as_excel'] = False
-config['max_form_upload_size'] = 50 * 1000 
+config['max_form_upload_size'] = 50 * 1000 * 1000
+
+# these configs define how form uploads are imported. When `import_form_uploads_asynchronously`
+# is set, uploads are spooled to disk and imported by a background celery task that reports
+# its progress back to the upload page; otherwise, they are imported within the request. In
+# both cases, files are parsed and written to the database `form_upload_chunk_size` rows at
+# a time, see app.form_imports. Nb. if you disable asynchronous imports, you should probably
+# reduce `max_form_upload_size` to avoid long-running requests.
+config['import_form_uploads_asynchronously'] = True
+config['form_upload_chunk_size'] = 1000
+# this is the number of days we keep the error report for each upload, see app.form_imports
+config['form_upload_errors_max_age'] = 7
+
+# this config sets the interval (in milliseconds) that the form page waits after a
+# field changes before sending its pending field values to the forms.lint_fields
+# endpoint for validation, which lets us validate several fields in one request.
+config['lint_debounce_interval'] = 300
+
+# this config sets the path to the marker file used to share the current version of 
+# the form definitions between application workers, so that changes to libreforms/
+# form_config.py can be reloaded without restarting the application; see app.form_registry.
+# Nb. this file should NOT be added to the gunicorn `reload_extra_files` list.
+config['form_registry_marker'] = 'log/form_registry.version'
+
+# these configs set the number of rows the tables view (and the tables.table_data JSON
+# endpoint) returns per page by default, and the maximum page size clients may request
+# using the `page_size` arg. Filtering, sorting and paging are run in the database, so
+# rendering a table only reads a single page of submissions.
+config['table_page_size'] = 100
+config['table_max_page_size'] = 1000
+
+# this config sets the number of documents read into each dataframe when background processes, 
+# like report selection and search indexing, iterate over a form in chunks; this bounds the 
+# memory these processes use, regardless of the size of the form, see MongoDB.iter_dataframes.
+config['dataframe_chunk_size'] = 1000
+
+# these configs define how dashboard data is aggregated in the database before it is sent to
+# the client, see app.aggregations. Histograms of numeric fields are split into `dashboard_histogram_bins`
+# bins. Scatter and line charts read at most `dashboard_max_points` submissions (sampled at random
+# in the database), and are then downsampled to `dashboard_target_points` points before they are
+# rendered: line charts using LTTB, and scatter charts using random sampling stratified by `color`.
+# Form administrators can override the target for a given dashboard by setting the `max_points` 
+# key in its `_dashboard` config.
+config['dashboard_histogram_bins'] = 50
+config['dashboard_max_points'] = 100000
+config['dashboard_target_points'] = 2000
+
+# this config sets the number of rendered dashboard figures each application worker caches;
+# cached figures are invalidated whenever the form they are drawn from is written to, see 
+# app.aggregations. Set this to 0 to disable the cache.
+config['dashboard_figure_cache_size'] = 256
+
+# this config sets the number of days the admin overview counts as recent submissions; the 
+# overview reads the daily submission rollups, see MongoDB.query_submission_rollups.
+config['admin_overview_recent_days'] = 30
+
+# these configs define how form collections are exported to Parquet for analytics, see
+# app.exports; this requires pyarrow, see requirements/parquet.txt. Snapshots are written
+# to `analytics_export_folder`, `analytics_export_batch_size` rows at a time. If you set
+# `analytics_export_rate` to a float (in seconds), celerybeat will periodically write a new
+# snapshot of every form; otherwise, exports can be run using the `flask libreforms export-parquet`
+# command or the celeryd.tasks.export_forms_to_parquet_async task. We keep the latest
+# `analytics_export_retention` snapshots of each form and remove older ones after each
+# export; set this to None to keep every snapshot.
+config['analytics_export_folder'] = 'exports/'
+config['analytics_export_batch_size'] = 10000
+config['analytics_export_rate'] = None
+config['analytics_export_retention'] = 7
 
 # this config sets the relative path to the config folder, which will be used
 # to store instance-specific configurations, see additional discussion at
@@ -282,11 +389,8 @@ config['path_to_accessibility_audio'] = 'static'
 # application frontend. The `exclude_forms_from_search` option defaults to 
 # False, but can take a list of form names to exclude. The `elasticsearch_index_refresh_rate`
 # field is a float defining the interval (in seconds) we want to set between each time the 
-# elasticsearch index is updated. Nb. we add 50 seconds to this when selecting forms to index,
-# in case there are delays in the celery task being run, as this only has the potential,
-# low risk effect of reindexing forms that have already been indexed. For further discussion,
-# see https://github.com/libreForms/libreForms-flask/issues/236. We added the option to 
-# `use_elasticsearch_as_wrapper`, which will turn on celeryd.index_new_documents and start
+# elasticsearch index is updated, see https://github.com/libreForms/libreForms-flask/issues/236.
+# We added the option to `use_elasticsearch_as_wrapper`, which will turn on celeryd.index_new_documents and start
 # trying to index documents, see https://github.com/libreForms/libreForms-flask/issues/254.
 # The `fuzzy_search` option turns fuzzy matching off, if it assesses to false, otherwise
 # should be set to an option parsable by the search engine (monogdb or elasticsearch). For
@@ -298,6 +402,31 @@ config['exclude_forms_from_search'] = None
 config['use_elasticsearch_as_wrapper'] = False
 config['elasticsearch_host'] = 'localhost'
 config['elasticsearch_index_refresh_rate'] = 600.0
+# each index cycle only sends the documents written, restored or soft deleted since the last
+# cycle, see app.search_index, using the elasticsearch bulk helper with batches of 
+# `elasticsearch_index_batch_size` documents. We re-send documents written in the last 
+# `elasticsearch_index_lag` seconds on the following cycle, in case concurrent writes are 
+# committed out of order. Use `flask libreforms reindex-search` to rebuild the index from scratch.
+config['elasticsearch_index_batch_size'] = 500
+config['elasticsearch_index_lag'] = 60
+# when `search_index_on_write` is set, each write also queues its documents to be indexed,
+# and celery sends the queued documents to elasticsearch in bulk within 
+# `search_index_flush_window` seconds, so new submissions are searchable almost right away;
+# the periodic index cycle then only picks up whatever the flushes missed.
+config['search_index_on_write'] = True
+config['search_index_flush_window'] = 5.0
+
+# for single-node deployments, setting `use_sqlite_fts_search` replaces MongoDB text search with
+# an embedded SQLite FTS5 index stored at `sqlite_fts_path` (which defaults to `search.sqlite` in
+# the application's instance folder, next to `app.sqlite`), with BM25 ranking and prefix matching.
+# It is kept up to date from the write path (see `search_index_on_write` above). When this is
+# first enabled on an existing deployment, celery builds the index from the stored documents on
+# its next search index flush, which runs at least every `elasticsearch_index_refresh_rate` 
+# seconds, and searches return no results until it has; you can instead build it right away 
+# using `flask libreforms reindex-search`. If `use_elasticsearch_as_wrapper` is also set, searches 
+# go to elasticsearch. See app.fts for more details.
+config['use_sqlite_fts_search'] = False
+config['sqlite_fts_path'] = None
 config['fuzzy_search'] = False # | "AUTO" | 5 | 80 < examples for elasticsearch, elasticsearch, and fuzzywuzzy
 config['limit_search_results_length'] = None
 
@@ -0,0 +1,247 @@
+"""
+exports.py: columnar (Parquet) snapshots of form collections for analytics
+
+The app.mongo docstring describes read_documents_from_collection as a way to pass
+form data to data science toolkits, but reading a whole collection into memory on
+each analysis puts load on the production database and returns untyped data. This
+script writes point-in-time snapshots of each form collection to Parquet files
+that analysts can query with their own tools (pandas, DuckDB, Spark, etc.). It
+depends on pyarrow, which is an optional dependency, see requirements/parquet.txt.
+
+Snapshots are written under the `analytics_export_folder` app config, in the
+following layout, where each file holds at most `analytics_export_batch_size` rows
+per row group:
+
+    <analytics_export_folder>/<form_name>/<snapshot timestamp>-<snapshot ID>/month=YYYY-MM/part-0.parquet
+
+Each snapshot is written to a temporary directory, which is renamed into place once
+the export is complete, so readers never see a partial snapshot. The random snapshot ID
+keeps exports started within the same second from colliding. Once a snapshot is in place,
+we remove all but the latest `analytics_export_retention` snapshots of the form, so periodic
+exports do not fill the disk.
+
+# build_arrow_schema(form_name)
+
+This derives the Arrow schema for a form from each field's `output_data` type, see
+libreforms.lint for the permitted types: str, int, float, list and date. We also include
+the document ID and the owner, reporter, timestamp and created timestamp metadata.
+
+# export_form_to_parquet(form_name, partition_by_month=True)
+
+This reads the collection using a projected cursor, sorted by `_metadata.created_timestamp`,
+which we index, see MongoDB.create_export_indexes, and writes it to Parquet in batches, so memory use is bounded by the batch size. When
+`partition_by_month` is set, documents are partitioned by the month they were created in;
+because the cursor is sorted, we only ever have one partition open at a time. Values that
+cannot be cast to their field's type are written as null.
+
+"""
+
+__name__ = "app.exports"
+__author__ = "Sig Janoska-Bedi"
+__credits__ = ["Sig Janoska-Bedi"]
+__version__ = "2.2.0"
+__license__ = "AGPL-3.0"
+__maintainer__ = "Sig Janoska-Bedi"
+__email__ = "signe@atreeus.com"
+
+import os, shutil, datetime, uuid
+import libreforms
+from app.config import config
+from app.mongo import mongodb
+
+
+def get_created_timestamp_field():
+    return f"{mongodb.metadata_field_names['metadata']}.created_timestamp"
+
+
+# these are the metadata columns included in each export, mapped to the keys we read them from
+def get_export_metadata_columns():
+    return {
+        '_id': '_id',
+        mongodb.metadata_field_names['owner']: mongodb.metadata_field_names['owner'],
+        mongodb.metadata_field_names['reporter']: mongodb.metadata_field_names['reporter'],
+        mongodb.metadata_field_names['timestamp']: mongodb.metadata_field_names['timestamp'],
+        'created_timestamp': get_created_timestamp_field(),
+    }
+
+
+def get_form_field_types(form_name):
+    return { field: field_config.get('output_data', {}).get('type', 'str')
+                for field, field_config in libreforms.forms[form_name].items() if not field.startswith("_") }
+
+
+def build_arrow_schema(form_name):
+
+    import pyarrow as pa
+
+    arrow_types = {
+        'str': pa.string(),
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'list': pa.list_(pa.string()),
+        'date': pa.date32(),
+    }
+
+    fields = [ pa.field(x, pa.string()) for x in get_export_metadata_columns().keys() ]
+    fields += [ pa.field(field, arrow_types.get(output_type, pa.string())) for field, output_type in get_form_field_types(form_name).items() ]
+
+    return pa.schema(fields)
+
+
+# here we cast a single value to a field's output type, returning None if this fails
+def coerce_export_value(value, output_type):
+
+    if value is None:
+        return None
+
+    try:
+        if output_type == 'int':
+            return int(value)
+
+        if output_type == 'float':
+            return float(value)
+
+        if output_type == 'list':
+            return [str(x) for x in value] if isinstance(value, list) else [str(value)]
+
+        if output_type == 'date':
+            if isinstance(value, datetime.datetime):
+                return value.date()
+            return datetime.date.fromisoformat(str(value)[:10])
+
+    except (TypeError, ValueError):
+        return None
+
+    return str(value)
+
+
+# here we read a value from a document using a dotted key, eg. `_metadata.created_timestamp`
+def get_document_value(document, key):
+
+    for part in key.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+
+    return document
+
+
+def get_partition_name(document):
+
+    created = get_document_value(document, get_created_timestamp_field())
+
+    # created timestamps are stored as str(datetime), so the month is the first seven characters
+    return f"month={str(created)[:7]}" if created else "month=unknown"
+
+
+# here we remove all but the latest `retention` snapshots of a form; snapshot names start with
+# their timestamp, so they sort chronologically, and we skip hidden staging directories
+def prune_form_snapshots(form_name, export_folder=None, retention=None):
+
+    export_folder = export_folder if export_folder else config['analytics_export_folder']
+    retention = retention if retention else config['analytics_export_retention']
+
+    if not retention:
+        return []
+
+    form_path = os.path.join(export_folder, form_name)
+    snapshots = sorted(x for x in os.listdir(form_path) if not x.startswith('.') and os.path.isdir(os.path.join(form_path, x)))
+    expired = snapshots[:-retention]
+
+    for snapshot in expired:
+        shutil.rmtree(os.path.join(form_path, snapshot), ignore_errors=True)
+
+    return expired
+
+
+def export_form_to_parquet(form_name, partition_by_month=True, export_folder=None, batch_size=None):
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    export_folder = export_folder if export_folder else config['analytics_export_folder']
+    batch_size = batch_size if batch_size else config['analytics_export_batch_size']
+
+    schema = build_arrow_schema(form_name)
+    field_types = get_form_field_types(form_name)
+    metadata_columns = get_export_metadata_columns()
+
+    snapshot = f"{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+    snapshot_path = os.path.join(export_folder, form_name, snapshot)
+    staging_path = os.path.join(export_folder, form_name, f".{snapshot}.tmp")
+    os.makedirs(staging_path, exist_ok=True)
+
+    summary = {'form_name': form_name, 'path': snapshot_path, 'rows': 0, 'partitions': []}
+
+    writer = None
+    partition = None
+    batch = []
+
+    def flush(batch):
+        columns = { column: [ str(get_document_value(x, key)) if get_document_value(x, key) is not None else None for x in batch ]
+                        for column, key in metadata_columns.items() }
+        columns.update({ field: [ coerce_export_value(x.get(field), output_type) for x in batch ]
+                        for field, output_type in field_types.items() })
+
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+
+    try:
+        mongodb.create_export_indexes(form_name)
+
+        # we still allow the sort to spill to disk, in case the index has not finished building
+        for document in mongodb.iter_documents_from_collection(form_name,
+                                    projection=list(metadata_columns.values()) + list(field_types.keys()),
+                                    sort=[(get_created_timestamp_field(), 1)],
+                                    batch_size=batch_size, allow_disk_use=True):
+
+            document_partition = get_partition_name(document) if partition_by_month else None
+
+            # when the partition changes, we flush the current batch and start a new file
+            if writer is None or document_partition != partition:
+                if writer is not None:
+                    if len(batch) > 0:
+                        flush(batch)
+                    writer.close()
+
+                partition = document_partition
+                partition_path = os.path.join(staging_path, partition) if partition else staging_path
+                os.makedirs(partition_path, exist_ok=True)
+
+                writer = pq.ParquetWriter(os.path.join(partition_path, 'part-0.parquet'), schema)
+                summary['partitions'].append(partition)
+                batch = []
+
+            batch.append(document)
+            summary['rows'] += 1
+
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+
+        if writer is not None:
+            if len(batch) > 0:
+                flush(batch)
+            writer.close()
+            writer = None
+
+        os.rename(staging_path, snapshot_path)
+
+    except Exception:
+        if writer is not None:
+            writer.close()
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+
+    summary['pruned'] = prune_form_snapshots(form_name, export_folder=export_folder)
+
+    return summary
+
+
+# this exports each of the forms in `form_names`, or every form if none are passed, and
+# returns a list of summaries; nb. collections without any documents produce an empty snapshot.
+def export_forms_to_parquet(form_names=None, partition_by_month=True, export_folder=None):
+
+    form_names = form_names if form_names else list(libreforms.forms.keys())
+
+    return [ export_form_to_parquet(form_name, partition_by_month=partition_by_month, export_folder=export_folder)
+                for form_name in form_names ]
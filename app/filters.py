@@ -38,6 +38,20 @@ https://github.com/signebedi/libreForms/issues/73 for more information.
 Report backend references:
 1. https://github.com/libreForms/libreForms-flask/issues/191
 
+## Filters
+
+Report filters are written as a comma-separated list of parenthetical conditions, each
+comparing a form field to a literal value using one of the operators in get_operators(),
+for example:
+
+    $(Text_Field == 'pig'), $(Int_Field >= 7)
+
+Every condition must hold for a submission to be included in a report. Strings must be 
+quoted; other values are read as numbers, or as True / False. compile_report_filters()
+compiles these into a MongoDB query, casting each value to the `output_data` type of the 
+field it is compared to, so filtering happens in the database. Filters that cannot be 
+compiled raise a ValueError, rather than being ignored.
+
 Filter references:
 1. https://github.com/libreForms/libreForms-flask/issues/204 (comparison operators)
 2. https://github.com/libreForms/libreForms-flask/issues/213 (identity & membership operators)
@@ -57,12 +71,20 @@ from flask import url_for
 
 from app.mongo import mongodb
 from app.config import config
+from app.form_registry import load_form_dataframe
 import libreforms
 
 from datetime import datetime
 from dateutil import parser
 import pandas as pd
+import operator, json, threading, uuid
 import re
+from collections import OrderedDict
+
+
+# here we store the submissions selected by each distinct report query, see select_form_report_hyperlinks()
+_report_cache = OrderedDict()
+_report_cache_lock = threading.Lock()
 
 ##########################
 # Filters - conditions used to assess forms for inclusion in reports
@@ -113,22 +135,129 @@ def get_operators():
 #     return True
 
 
-def lint_filters(s, *args, **kwargs):
+# here we map each of the operators in get_operators() to its MongoDB query operator
+def get_mongodb_operators():
+    return {
+        '==': '$eq',
+        '!=': '$ne',
+        '>=': '$gte',
+        '<=': '$lte',
+        '>': '$gt',
+        '<': '$lt',
+    }
+
+
+# this matches a single condition, eg. `Int_Field >= 7`; we try the two-character operators first
+FILTER_CONDITION_PATTERN = re.compile(r'^\s*([A-Za-z_][\w.]*)\s*(' + '|'.join(re.escape(x) for x in sorted(get_operators(), key=len, reverse=True)) + r')\s*(.+?)\s*$')
+
+
+# these are the metadata fields that filters may reference, in addition to the form's fields
+def get_filterable_metadata_fields():
+    return [ mongodb.metadata_field_names[x] for x in ['owner', 'reporter', 'timestamp', 'approver'] ] \
+                + [ f"{mongodb.metadata_field_names['metadata']}.created_timestamp" ]
+
+
+# here we read the literal on the right-hand side of a condition: quoted values are strings, 
+# and anything else must be a number or a boolean
+def parse_filter_literal(value):
+
+    if len(value) > 1 and value[0] == value[-1] and value[0] in ["'", '"']:
+        return value[1:-1]
+
+    if value in ['True', 'False']:
+        return value == 'True'
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{value} is not a number; strings must be quoted")
+
+
+# here we find the `output_data` type of the field a condition references; metadata 
+# fields are stored as strings. If no form is passed, we do not cast values.
+def get_filter_field_type(form_name, field):
+
+    if field in get_filterable_metadata_fields():
+        return 'str'
+
+    if not form_name:
+        return None
+
+    if field.startswith("_") or field not in libreforms.forms[form_name]:
+        raise ValueError(f"{field} is not a field in {form_name}")
+
+    return libreforms.forms[form_name][field].get('output_data', {}).get('type', 'str')
+
+
+def coerce_filter_value(value, field_type):
+
+    if field_type in ['int', 'float']:
+        if isinstance(value, (bool, str)) or (field_type == 'int' and not float(value).is_integer()):
+            raise ValueError(f"{value} is not {'an integer' if field_type == 'int' else 'a number'}")
+        return int(value) if field_type == 'int' else float(value)
+
+    # dates are stored as YYYY-MM-DD strings, which we can compare lexically
+    if field_type == 'date':
+        try:
+            return parser.parse(str(value)).strftime("%Y-%m-%d")
+        except (ValueError, OverflowError):
+            raise ValueError(f"{value} is not a date")
+
+    # nb. list fields are stored as lists of strings; MongoDB matches a list when any element matches
+    if field_type in ['str', 'list']:
+        return str(value)
+
+    return value
+
+
+# this compiles a filter string into a MongoDB query, raising a ValueError if the string
+# cannot be parsed, uses an unsupported operator, references a field that does not exist 
+# on `form_name`, or compares a field to a value that cannot be cast to its type. Empty 
+# filters compile to an empty query.
+def compile_report_filters(s, form_name=None):
+
+    if not s or s.strip() == '':
+        return {}
+
+    if form_name and form_name not in libreforms.forms:
+        raise ValueError(f"{form_name} is not a valid form")
 
     try:
         STRINGS = new_preprocess_text_filters(s)
-    except:
-        return False
+    except (AssertionError, IndexError):
+        raise ValueError(f"could not parse filters {s}; conditions should be formatted $(field == 'value')")
+
+    if len(STRINGS) < 1:
+        raise ValueError(f"could not parse filters {s}; conditions should be formatted $(field == 'value')")
+
+    conditions = []
 
     for string in STRINGS:
-        try:
-            operand1, comparison, operand2 = string.split()
-        except:
-            return False
-        COMPARISONS = get_operators()
 
-        if comparison not in COMPARISONS:
-            return False
+        match = FILTER_CONDITION_PATTERN.match(string)
+
+        if not match:
+            raise ValueError(f"could not parse condition {string}; supported operators are {', '.join(get_operators().keys())}")
+
+        field, comparison, operand = match.groups()
+        value = coerce_filter_value(parse_filter_literal(operand), get_filter_field_type(form_name, field))
+
+        conditions.append({field: {get_mongodb_operators()[comparison]: value}})
+
+    return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
+
+def lint_filters(s, *args, form_name=None, **kwargs):
+
+    try:
+        compile_report_filters(s, form_name=form_name)
+    except ValueError:
+        return False
 
     return True
 
@@ -205,18 +334,18 @@ def get_map_of_form_data(*args, add_hyperlink=False, single_form:str=None):
         if single_form and single_form != form:
             continue
 
-        TEMP[form] = mongodb.new_read_documents_from_collection(form)
-
-        # if no form data is found, let's return an empty DataFrame
-        if not isinstance(TEMP[form], pd.DataFrame):
+        # we load the form data with typed columns, dropping the fields passed as *args in 
+        # the query itself (except the document ID, which we need for hyperlinks); if no 
+        # form data is found, this returns an empty DataFrame. 
+        TEMP[form] = load_form_dataframe(form, exclude_fields=[x for x in args if x != '_id'])
 
-            TEMP[form] = pd.DataFrame()
+        if len(TEMP[form].index) < 1:
             continue
 
         # we add a hyperlink field if it's been requested
         if add_hyperlink:
             # TEMP[form]['Hyperlink'] = TEMP[form].apply(lambda row: config['domain']+url_for('submissions.render_document', form_name=form, document_id=row['_id']), axis=1)
-            TEMP[form]['Hyperlink'] = TEMP[form].apply(lambda row: f"{config['domain']}/submissions/{form}/{row['_id']}", axis=1)
+            TEMP[form]['Hyperlink'] = f"{config['domain']}/submissions/{form}/" + TEMP[form]['_id'].astype(str)
 
         # use *args to drop fields with value if the dataframe is not empty;
         # for example, if you run get_map_of_form_data('Metadata','Journal'),
@@ -228,63 +357,422 @@ def get_map_of_form_data(*args, add_hyperlink=False, single_form:str=None):
     return TEMP
 
 # selects user-generated reports that have 'come due', that is, have reached the the time
-# based trigger to be sent out.
-def select_user_reports_by_time():
+# based trigger to be sent out. Each report stores the time it is next due in its indexed 
+# `next_run_at` field (see app.models.Report.schedule), so we only read the reports that are
+# due, in the order they came due, rather than assessing every report on each run. We return
+# the reports as a dataframe, which is empty if no reports are due.
+def select_user_reports_by_time(current_time=None):
 
     # import the database instance
-    from app import db
     from app.models import Report
 
-    # we map each human-readable `frequency` option to its corresponding interval
-    # in seconds. Should we remove this from the application code, and simply add
-    # as a field in the Report data model? That might save some complexity here...
-    time_map = {
-        'hourly': 3600,
-        'daily': 86400,
-        'weekly': 604800,
-        'monthly': 2592000, # this we map to 30 days, though this may have problems...
-        'annually': 31536000,
+    # we take a current timestamp
+    current_time = current_time if current_time else datetime.timestamp(datetime.now())
+
+    reports = Report.query.filter(Report.next_run_at <= current_time) \
+                    .order_by(Report.next_run_at).all()
+
+    columns = [ x.name for x in Report.__table__.columns ]
+
+    return pd.DataFrame([ {x: getattr(report, x) for x in columns} for report in reports ], columns=columns)
+
+# here we map each report `time_condition` onto a MongoDB query selecting the submissions
+# it covers. Timestamps are stored as strings of UTC datetimes (see app.mongo), which sort 
+# lexically, so we compare them against the cutoff rendered in the same format. Nb. this 
+# selects submissions created / modified AFTER the cutoff; previously, these were selected
+# using the unix timestamp of each submission, and the comparison selected those BEFORE it.
+def compile_report_time_window(time_condition, last_run_at=None, current_time=None):
+
+    current_time = current_time if current_time else datetime.timestamp(datetime.now())
+
+    created = f"{mongodb.metadata_field_names['metadata']}.created_timestamp"
+    modified = mongodb.metadata_field_names['timestamp']
+
+    windows = {
+        'created_last_hour': (created, 3600),
+        'created_last_day': (created, 86400),
+        'created_last_week': (created, 604800),
+        'created_last_weekly': (created, 604800), # this is the value stored by the Report model
+        'created_last_month': (created, 2592000), # this we map to 30 days, though this may have problems...
+        'created_last_year': (created, 31536000),
     }
 
-    # we take a current timestamp
-    current_time = datetime.timestamp(datetime.now())
+    if time_condition in windows:
+        field, interval = windows[time_condition]
+        cutoff = current_time - interval
 
-    # read in report data
-    df = pd.read_sql_table(Report.__tablename__, con=db.engine.connect())
+    elif time_condition in ['created_since_last_run', 'modified_since_last_run'] and last_run_at:
+        field = created if time_condition == 'created_since_last_run' else modified
+        cutoff = last_run_at
 
-    # drop where inactive is set to False
-    df = df[df['active']==1]
+    # created_all_time, and reports that have never been run, cover all submissions
+    else:
+        return {}
 
-    # drop where frequency is set to 'manual'
-    df = df[df['frequency']!='manual']
+    return {field: {'$gte': str(datetime.utcfromtimestamp(cutoff))}}
 
-    # drop where there is an end_at specified, and it has passed
-    df = df[(df['end_at']!=0) | (df['end_at']>=current_time)]
 
-    # drop where there is an start_at specified, and it has not yet arrived
-    df = df[(df['start_at']!=0) | (df['start_at']<=current_time)]
+# this compiles the MongoDB query selecting the submissions covered by a report: those in 
+# its time window that match its filters. This raises a ValueError if the filters are invalid.
+def compile_report_query(form_name, time_condition, filters=None, last_run_at=None, current_time=None):
 
-    # here we do some (rather inefficient, admittedly; we should find a way
-    # to optimize this if performance becomes an issue). First, we map the timestamps
-    # to the human readable `frequency` field.
-    if len(df) > 0:
-        df['int_frequency'] = df.apply(lambda row: time_map[row['frequency']], axis=1)
-    else: return df # if the length is already 0 here, then we just return the empty dataframe
+    conditions = [ x for x in [
+        compile_report_time_window(time_condition, last_run_at=last_run_at, current_time=current_time),
+        compile_report_filters(filters, form_name=form_name),
+    ] if x ]
 
-    # then, we calculate how long it has been since the report was last run
-    df['time_since_last_run'] = current_time - df['last_run_at']
+    return conditions[0] if len(conditions) == 1 else {'$and': conditions} if len(conditions) > 1 else {}
 
-    # we select rows that are 'due'; that is, the time elapsed since they were
-    # last run is equal to or greater than the frequency at which they are sent.
-    df = df[df['time_since_last_run']>=df['int_frequency']]
-    
-    # finally, we reindex the dataframe; this might not actually be necessary but 
-    # is a good failsafe to ensure we can assume the structure of each dataframes 
-    # index in future operations.
-    df.reset_index(drop=True, inplace=True)
 
-    # finally, we return the dataframe
-    return df
+# this selects the submissions covered by a report and returns their hyperlinks. Both the 
+# time window and the report's filters are applied in the query, so we only read the IDs of
+# matching submissions. Invalid filters raise a ValueError, rather than selecting every submission.
+def select_report_hyperlinks(form_name, time_condition, filters=None, last_run_at=None, current_time=None):
+
+    if form_name not in libreforms.forms:
+        return []
+
+    query = compile_report_query(form_name, time_condition, filters=filters, last_run_at=last_run_at, current_time=current_time)
+
+    return [ f"{config['domain']}/submissions/{form_name}/{str(x['_id'])}" 
+                for x in mongodb.iter_documents_from_collection(form_name, query=query, projection=['_id'], batch_size=config['dataframe_chunk_size']) ]
+
+
+# these are the timestamp fields a report query may reference, which we parse before comparing
+def get_report_timestamp_fields():
+    return [ mongodb.metadata_field_names['timestamp'], f"{mongodb.metadata_field_names['metadata']}.created_timestamp" ]
+
+
+# this lists the fields referenced by a query compiled by compile_report_query()
+def get_report_query_fields(query):
+
+    fields = []
+
+    for key, condition in query.items():
+        if key in ['$and', '$or']:
+            fields += [ x for subquery in condition for x in get_report_query_fields(subquery) ]
+        else:
+            fields.append(key)
+
+    return list(dict.fromkeys(fields))
+
+
+# here we read the values of `field` from a chunk of form data; `field` may reference a
+# subfield using dot notation, eg. `_metadata.created_timestamp`
+def get_report_column(df, field):
+
+    if field in df.columns:
+        return df[field]
+
+    parent, _, child = field.partition('.')
+
+    if child and parent in df.columns:
+        return df[parent].map(lambda x: x.get(child) if isinstance(x, dict) else None)
+
+    return pd.Series([None]*len(df.index), index=df.index, dtype=object)
+
+
+REPORT_QUERY_OPERATORS = {
+    '$eq': operator.eq,
+    '$ne': operator.ne,
+    '$gte': operator.ge,
+    '$lte': operator.le,
+    '$gt': operator.gt,
+    '$lt': operator.lt,
+}
+
+
+# this compares a single (non-list) value using an ordering operator, which, like MongoDB, 
+# only matches values of the same type as `value`
+def compare_report_value(x, query_operator, value):
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        comparable = isinstance(x, (int, float)) and not isinstance(x, bool)
+    else:
+        comparable = isinstance(x, type(value))
+
+    return bool(comparable and REPORT_QUERY_OPERATORS[query_operator](x, value))
+
+
+# here we compare a column to a value using a MongoDB query operator, approximating MongoDB's 
+# semantics: equality and ordering comparisons match lists when any element matches, and 
+# ordering comparisons only match values of the same type as `value`.
+def compare_report_column(series, query_operator, value):
+
+    operators = REPORT_QUERY_OPERATORS
+
+    if pd.api.types.is_datetime64_any_dtype(series):
+        value = pd.to_datetime(value)
+
+    elif query_operator in ['$eq', '$ne']:
+        matches = series.map(lambda x: value in x if isinstance(x, list) else x == value).astype(bool)
+        return matches if query_operator == '$eq' else ~matches
+
+    # list fields hold a list in each row, so we compare them element by element
+    elif series.map(lambda x: isinstance(x, list)).any():
+        return series.map(lambda x: any(compare_report_value(e, query_operator, value) for e in x) if isinstance(x, list) 
+                                        else compare_report_value(x, query_operator, value)).astype(bool)
+
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        series = pd.to_numeric(series, errors='coerce')
+
+    else:
+        series = series.where(series.map(lambda x: isinstance(x, type(value))))
+
+    return operators[query_operator](series, value).fillna(False).astype(bool)
+
+
+# this evaluates a query compiled by compile_report_query() against a chunk of form data, 
+# returning a boolean mask; `column` is a callable returning the (parsed) values of a field
+def match_report_query(query, column, index):
+
+    mask = pd.Series(True, index=index)
+
+    for key, condition in query.items():
+
+        if key == '$and':
+            for subquery in condition:
+                mask &= match_report_query(subquery, column, index)
+
+        elif key == '$or':
+            matches = pd.Series(False, index=index)
+            for subquery in condition:
+                matches |= match_report_query(subquery, column, index)
+            mask &= matches
+
+        else:
+            for query_operator, value in condition.items():
+                mask &= compare_report_column(column(key), query_operator, value)
+
+    return mask
+
+
+# here we rewrite a query compiled by compile_report_query() into a canonical form, so that
+# equivalent report definitions produce the same query: we flatten nested $and / $or clauses, 
+# drop duplicate conditions and sort them. We return the query and its JSON serialization,
+# which we use as a cache key.
+def normalize_report_query(query):
+
+    def normalize(query):
+
+        conditions = []
+
+        for key, condition in query.items():
+
+            if key in ['$and', '$or']:
+                subqueries = []
+                for subquery in [ normalize(x) for x in condition ]:
+                    subqueries += subquery[key] if list(subquery.keys()) == [key] else [subquery]
+
+                subqueries = list({ json.dumps(x, sort_keys=True, default=str): x for x in subqueries }.items())
+                subqueries = [ x for _, x in sorted(subqueries) ]
+
+                conditions.append(subqueries[0] if len(subqueries) == 1 else {key: subqueries})
+
+            else:
+                conditions.append({key: condition})
+
+        if len(conditions) == 1:
+            return conditions[0]
+
+        return normalize({'$and': conditions})
+
+    query = normalize(query) if len(query) > 0 else {}
+
+    return query, json.dumps(query, sort_keys=True, default=str)
+
+
+def get_cached_report_result(key):
+
+    with _report_cache_lock:
+
+        if key not in _report_cache:
+            return None
+
+        _report_cache.move_to_end(key)
+        return _report_cache[key]
+
+
+def cache_report_result(key, result):
+
+    with _report_cache_lock:
+
+        _report_cache[key] = result
+        _report_cache.move_to_end(key)
+
+        while len(_report_cache) > config['report_evaluation_cache_size']:
+            _report_cache.popitem(last=False)
+
+
+# this selects the submissions covered by each of the `reports` (a dataframe of Report rows) 
+# for a single form, and returns a dict mapping each report ID to its hyperlinks. Rather than
+# querying the form once per report, we read it once, selecting the submissions covered by any 
+# of the reports and projecting only the fields they reference, and then evaluate each report 
+# against each chunk in pandas, parsing timestamps once per chunk. Reports with invalid filters
+# are logged and left out of the result.
+#
+# Many users subscribe to the same report definitions, so we evaluate each distinct query 
+# (after normalize_report_query) once and share the result between reports. Results are also 
+# cached, keyed on the form, the query (which includes its time window) and the form's write 
+# version, see MongoDB.bump_write_version, so they are reused until the form is written to.
+def select_form_report_hyperlinks(form_name, reports, current_time=None):
+
+    from app import log
+
+    queries = {}
+
+    for index, row in reports.iterrows():
+        try:
+            queries[row['report_id']] = normalize_report_query(compile_report_query(form_name, row['time_condition'], filters=row['filters'], 
+                                                                last_run_at=row['last_run_at'], current_time=current_time))
+        except ValueError as e:
+            log.error(f"LIBREFORMS - failed to send report {row['report_id']}: invalid filters: {e}")
+
+    if form_name not in libreforms.forms or len(queries) < 1:
+        return { report_id: [] for report_id in queries.keys() }
+
+    write_version = mongodb.get_write_version(form_name)
+
+    # here we find the distinct queries, and those we have not already evaluated
+    distinct = { key: query for query, key in queries.values() }
+    results = { key: get_cached_report_result((form_name, key, write_version)) for key in distinct.keys() }
+    pending = { key: distinct[key] for key, result in results.items() if result is None }
+
+    if len(pending) > 0:
+
+        results.update({ key: [] for key in pending.keys() })
+
+        # if any report covers every submission, so does the query
+        query = {} if any(len(x) == 0 for x in pending.values()) else {'$or': list(pending.values())}
+
+        fields = get_report_query_fields({'$and': list(pending.values())})
+        timestamp_fields = get_report_timestamp_fields()
+
+        for chunk in mongodb.iter_dataframes(form_name, chunk_size=config['dataframe_chunk_size'], projection=['_id'] + fields, filter=query):
+
+            columns = {}
+
+            def column(field):
+                if field not in columns:
+                    series = get_report_column(chunk, field)
+                    columns[field] = pd.to_datetime(series, errors='coerce') if field in timestamp_fields else series
+                return columns[field]
+
+            links = f"{config['domain']}/submissions/{form_name}/" + chunk['_id'].astype(str)
+
+            for key, report_query in pending.items():
+                results[key] += list(links[match_report_query(report_query, column, chunk.index)])
+
+        for key in pending.keys():
+            cache_report_result((form_name, key, write_version), results[key])
+
+    # nb. reports with the same query share the same list of hyperlinks, which callers should not modify
+    return { report_id: results[key] for report_id, (query, key) in queries.items() }
+
+
+# this sends each of the due `reports` (a dataframe of Report rows) for a single form, reading
+# the form once, see select_form_report_hyperlinks(). Each report is sent independently, so a
+# failure only affects that report; we log failures and return the IDs of the failed reports
+# that should be retried.
+def send_form_reports(form_name, form_reports, current_time=None):
+
+    # import the database instance 
+    from app import db, log
+    from app.models import Report, User
+    from celeryd.tasks import send_mail_many_async
+
+    current_time = current_time if current_time else datetime.timestamp(datetime.now())
+    current_time_human_readable = str(datetime.fromtimestamp(current_time))
+
+    selected = select_form_report_hyperlinks(form_name, form_reports, current_time=current_time)
+
+    failed = []
+    errored = []
+    completed = []
+    messages = []
+
+    for index, row in form_reports.iterrows():
+
+        try:
+
+            # we skip reports whose filters could not be compiled, which have been logged
+            if row['report_id'] not in selected:
+                completed.append(row['report_id'])
+                continue
+
+            hyperlinks = selected[row['report_id']]
+
+            # verify that the user exists and is active, and select their email
+            user = User.query.filter_by(id=str(row['user_id'])).first()
+
+            # skip sending the email if the user has been removed or is inactive, or no submissions were selected
+            if not user or not user.active or len(hyperlinks) < 1:
+                completed.append(row['report_id'])
+                continue
+
+            email = user.email
+
+            # we queue the email, and send the form's reports as a batch below
+            subject = f'{config["site_name"]} Report {row["name"]} {current_time_human_readable}'
+            content = f"Report: {row['name']}, Form: {row['form_name']}\n"+"\n".join(hyperlinks)
+            messages.append((row['report_id'], {'subject': subject, 'content': content, 'to_address': email}))
+
+        except Exception as e:
+            log.warning(f"LIBREFORMS - failed to send report {row['report_id']}: {e}")
+            errored.append(row['report_id'])
+
+    # send emails async, over a single SMTP connection, see app.smtp; if we cannot queue them,
+    # eg. because the broker is down, we treat each of these reports as failed
+    if len(messages) > 0:
+        try:
+            m = send_mail_many_async.delay([ message for report_id, message in messages ])
+            completed += [ report_id for report_id, message in messages ]
+
+        except Exception as e:
+            log.warning(f"LIBREFORMS - failed to queue reports for form {form_name}: {e}")
+            failed += [ report_id for report_id, message in messages ]
+
+    # a report that raised an error is likely to raise it again, so we count its attempts, and
+    # once it has failed `report_task_max_retries` times, we give up on this run and move it to 
+    # its next run below; until then, it is retried over the same time window
+    for report_id in errored:
+
+        try:
+            report = Report.query.filter_by(report_id=str(report_id)).first()
+            report.failed_attempts = (report.failed_attempts or 0) + 1
+
+            if report.failed_attempts >= config['report_task_max_retries']:
+                log.warning(f"LIBREFORMS - giving up on report {report_id} after {report.failed_attempts} failed attempts, it will run again at its next scheduled time.")
+                completed.append(report_id)
+            else:
+                failed.append(report_id)
+
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"LIBREFORMS - failed to record a failed attempt for report {report_id}: {e}")
+            failed.append(report_id)
+
+    # we only update last_run_at, and advance next_run_at, once a report's email has been queued
+    # (or it had nothing to send, or we gave up on it), so reports that could not be queued are 
+    # retried over the same time window; due reports we skipped are advanced too, so they are 
+    # not selected again until their next run
+    for report_id in completed:
+
+        try:
+            report = Report.query.filter_by(report_id=str(report_id)).first()
+            report.last_run_at = datetime.timestamp(datetime.now()) 
+            report.last_run_at_human_readable = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S") 
+            report.schedule()
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"LIBREFORMS - failed to reschedule report {report_id}: {e}")
+
+    return failed
+
 
 # this is the synchronous function that will be used to send reports. It will be wrapped
 # by a corresponding asynchronous celery function in celeryd.
@@ -292,94 +780,77 @@ def send_eligible_reports():
 
     # we take a current timestamp
     current_time = datetime.timestamp(datetime.now())
-    current_time_human_readable = str(datetime.now())
-
-    # we map each timeframe relative to the current timestamp
-    timestamp_time_map = {
-        'hourly': current_time - 3600,
-        'daily': current_time - 86400,
-        'weekly': current_time - 604800,
-        'monthly': current_time - 2592000, # this we map to 30 days, though this may have problems...
-        'annually': current_time - 31536000,
-    }
 
     # first, we select all the reports that are due to be sent
-    report_df = select_user_reports_by_time()
-
-    # next, we select the form data that should be sent, dropping 
-    # the fields we don't want included.
-    form_df = get_map_of_form_data(mongodb.metadata_field_names['journal'], mongodb.metadata_field_names['metadata'], mongodb.metadata_field_names['ip_address'], mongodb.metadata_field_names['approver'], 
-                                        mongodb.metadata_field_names['approval'], mongodb.metadata_field_names['approver_comment'], mongodb.metadata_field_names['signature'], '_id', add_hyperlink=True)
-
-    # next, we iterate through each report and select the corresponding dataframe
-    for index, row in report_df.iterrows():
-        TEMP = form_df[row['form_name']].copy()
-
-        # we create a unix timestamp field for the form data
-        TEMP['unixTimestamp'] = TEMP.apply(lambda row: datetime.timestamp(parser.parse(row[mongodb.metadata_field_names['timestamp']])), axis=1)
-
-        # collect forms based on timetamp `time_condition` condition
-        if row['time_condition'] == 'created_since_last_run':
-            # select where unixTimestamp - row['time_since_last_run']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < row['time_since_last_run']].reset_index(drop=True)
-        elif row['time_condition'] == 'modified_since_last_run':
-            # select where unixTimestamp - row['time_since_last_run']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < row['time_since_last_run']].reset_index(drop=True)
-        elif row['time_condition'] == 'created_all_time':
-            # we just leave the dataframe as-is
-            pass
-        elif row['time_condition'] == 'created_last_hour':
-            # select where unixTimestamp - time_map['hourly']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['hourly']].reset_index(drop=True)
-        elif row['time_condition'] == 'created_last_day':
-            # select where unixTimestamp - time_map['daily']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['daily']].reset_index(drop=True)
-        elif row['time_condition'] == 'created_last_week':
-            # select where unixTimestamp - time_map['weekly']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['weekly']].reset_index(drop=True)
-        elif row['time_condition'] == 'created_last_month':
-            # select where unixTimestamp - time_map['monthly']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['monthly']].reset_index(drop=True)
-        elif row['time_condition'] == 'created_last_year':
-            # select where unixTimestamp - time_map['annually']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['annually']].reset_index(drop=True)
-
-        # run queries against data if filters have been passed
-        if row['filters'] and row['filters'] != '':
-            try:
-                TEMP.query(generate_pandas_query_string(new_preprocess_text_filters(row['filters'])), inplace=True)
-            except:
-                pass # NEEDS REVIEW not sure how / where to validate query strings ...
-
-        # import the database instance 
-        from app import db
-        from app.models import Report, User
+    report_df = select_user_reports_by_time(current_time=current_time)
+
+    # next, we group the reports by form and send them, so that each form with due 
+    # reports is read once per cycle
+    for form_name, form_reports in report_df.groupby('form_name'):
+        send_form_reports(form_name, form_reports, current_time=current_time)
+
+
+# this is the fan-out alternative to send_eligible_reports(), used when the `report_fan_out`
+# config is set: rather than sending due reports serially, we return batches of report IDs, 
+# one per form and at most `report_fan_out_batch_size` reports each, for the caller to send 
+# as separate celery tasks (see celeryd.send_form_reports_async). We lease each dispatched 
+# report by pushing its `next_run_at` back by `report_task_lease` seconds and tagging it with
+# its batch's `dispatch_id`, so later runs do not dispatch it again while its task is pending;
+# the task reschedules it once sent, which clears the lease. If the task fails for good, the 
+# report becomes due again when the lease expires. We keep at most `report_fan_out_concurrency`
+# batches in flight: each run counts the batches that still hold an unexpired lease, and only
+# dispatches enough new batches to make up the difference.
+def dispatch_eligible_reports(current_time=None):
+
+    from sqlalchemy import func, distinct
+    from app import db
+    from app.models import Report
 
-        # verify that the user is active and select their email
-        user = User.query.filter_by(id=str(row['user_id'])).first()
-        email = user.email
+    current_time = current_time if current_time else datetime.timestamp(datetime.now())
 
-        if not user.active:
-            continue
+    report_df = select_user_reports_by_time(current_time=current_time)
 
-        # update last_run_at data
-        report = Report.query.filter_by(report_id=str(row['report_id'])).first()
-        report.last_run_at = datetime.timestamp(datetime.now()) 
-        report.last_run_at_human_readable = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S") 
+    batches = []
+
+    for form_name, form_reports in report_df.groupby('form_name', sort=False):
+        report_ids = list(form_reports['report_id'])
+        batches += [ (form_name, report_ids[i:i+config['report_fan_out_batch_size']]) 
+                        for i in range(0, len(report_ids), config['report_fan_out_batch_size']) ]
+
+    # batches that are still sending, or waiting to retry, count against the limit
+    in_flight = db.session.query(func.count(distinct(Report.dispatch_id))).filter(Report.dispatch_id != None, 
+                                                                                    Report.next_run_at > current_time).scalar()
+
+    batches = batches[:max(config['report_fan_out_concurrency'] - in_flight, 0)]
+
+    for form_name, report_ids in batches:
+        Report.query.filter(Report.report_id.in_(report_ids)).update({Report.next_run_at: current_time + config['report_task_lease'], 
+                                                                      Report.dispatch_id: str(uuid.uuid4())}, synchronize_session=False)
+
+    if len(batches) > 0:
         db.session.commit()
 
-        # skip sending the email if the length of 
-        # the form dataframe is less than 1
-        if len(TEMP) < 1:
-            continue
+    return batches
 
-        # send email async
-        from celeryd.tasks import send_mail_async
-        subject = f'{config["site_name"]} Report {row["name"]} {current_time_human_readable}'
-        content = f"Report: {row['name']}, Form: {row['form_name']}\n"+"\n".join([f'{row["Hyperlink"]}' for index, row in TEMP.iterrows()])
-        m = send_mail_async.delay(subject=subject, content=content, to_address=email)
 
+# this sends a batch of reports dispatched by dispatch_eligible_reports(), returning the IDs
+# of any that failed; reports that have been deactivated or rescheduled since they were 
+# dispatched are skipped.
+def send_report_batch(form_name, report_ids, current_time=None):
+
+    from app.models import Report
+
+    current_time = current_time if current_time else datetime.timestamp(datetime.now())
 
+    reports = Report.query.filter(Report.report_id.in_(report_ids), Report.active == True, Report.next_run_at != None).all()
+
+    columns = [ x.name for x in Report.__table__.columns ]
+    form_reports = pd.DataFrame([ {x: getattr(report, x) for x in columns} for report in reports ], columns=columns)
+
+    if len(form_reports.index) < 1:
+        return []
+
+    return send_form_reports(form_name, form_reports, current_time=current_time)
 
 
 # this is the synchronous function that will be used to send an individual report. It does not test
@@ -393,63 +864,10 @@ def send_individual_report(report, user):
     current_time = datetime.timestamp(datetime.now())
     current_time_human_readable = str(datetime.now())
 
-    # we map each timeframe relative to the current timestamp
-    timestamp_time_map = {
-        'hourly': current_time - 3600,
-        'daily': current_time - 86400,
-        'weekly': current_time - 604800,
-        'monthly': current_time - 2592000, # this we map to 30 days, though this may have problems...
-        'annually': current_time - 31536000,
-    }
-
     try:
     
-        TEMP = get_map_of_form_data(mongodb.metadata_field_names['journal'], mongodb.metadata_field_names['metadata'], mongodb.metadata_field_names['ip_address'], mongodb.metadata_field_names['approver'], 
-                                    mongodb.metadata_field_names['approval'], mongodb.metadata_field_names['approver_comment'], mongodb.metadata_field_names['signature'], '_id', 
-                                    add_hyperlink=True, single_form=report.form_name)
-        TEMP = TEMP[report.form_name]
-
-        # we create a unix timestamp field for the form data
-        TEMP['unixTimestamp'] = TEMP.apply(lambda row: datetime.timestamp(parser.parse(row[mongodb.metadata_field_names['timestamp']])), axis=1)
-
-        # then, we calculate how long it has been since the report was last run
-        time_since_last_run = current_time - report.last_run_at
-
-
-        # collect forms based on timetamp `time_condition` condition
-        if report.time_condition == 'created_since_last_run':
-            # select where unixTimestamp - row['time_since_last_run']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < time_since_last_run].reset_index(drop=True)
-        elif report.time_condition == 'modified_since_last_run':
-            # select where unixTimestamp - row['time_since_last_run']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < time_since_last_run].reset_index(drop=True)
-        elif report.time_condition == 'created_all_time':
-            # we just leave the dataframe as-is
-            pass
-        elif report.time_condition == 'created_last_hour':
-            # select where unixTimestamp - time_map['hourly']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['hourly']].reset_index(drop=True)
-        elif report.time_condition == 'created_last_day':
-            # select where unixTimestamp - time_map['daily']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['daily']].reset_index(drop=True)
-        elif report.time_condition == 'created_last_week':
-            # select where unixTimestamp - time_map['weekly']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['weekly']].reset_index(drop=True)
-        elif report.time_condition == 'created_last_month':
-            # select where unixTimestamp - time_map['monthly']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['monthly']].reset_index(drop=True)
-        elif report.time_condition == 'created_last_year':
-            # select where unixTimestamp - time_map['annually']
-            TEMP = TEMP.loc[TEMP['unixTimestamp'] < timestamp_time_map['annually']].reset_index(drop=True)
-
-        # run queries against data if filters have been passed
-        if report.filters and report.filters != '':
-            try:
-                TEMP.query(generate_pandas_query_string(new_preprocess_text_filters(report.filters)), inplace=True)
-            except:
-                pass # NEEDS REVIEW not sure how / where to validate query strings ...
-
-        # print(TEMP)
+        hyperlinks = select_report_hyperlinks(report.form_name, report.time_condition, filters=report.filters, 
+                                                last_run_at=report.last_run_at, current_time=current_time)
 
         # import the database instance  
         # from app.models import Report
@@ -458,18 +876,14 @@ def send_individual_report(report, user):
         # update last_run_at data
         report.last_run_at = datetime.timestamp(datetime.now()) 
         report.last_run_at_human_readable = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S") 
+        report.schedule()
         db.session.commit()
 
-        # skip sending the email if the length of 
-        # the form dataframe is less than 1
-        # if len(TEMP) < 1:
-        #     continue
-
         # send email async
         from celeryd.tasks import send_mail_async
         email = user.email
         subject = f'{config["site_name"]} Report {report.name} {current_time_human_readable}'
-        content = f"Report: {report.name}, Form: {report.form_name}\n"+"\n".join([f'{row["Hyperlink"]}' for index, row in TEMP.iterrows()])
+        content = f"Report: {report.name}, Form: {report.form_name}\n"+"\n".join(hyperlinks)
         m = send_mail_async.delay(subject=subject, content=content, to_address=email)
 
         return True
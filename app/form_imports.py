@@ -0,0 +1,361 @@
+"""
+form_imports.py: chunked parsing and bulk import of CSV / Excel form uploads
+
+Form uploads, see https://github.com/libreForms/libreForms-flask/issues/184,
+used to be read fully into memory and written row-by-row within the HTTP
+request that received them. This script defines the pipeline that replaces
+that approach: the view function spools the uploaded file to disk and (by
+default) hands it to a celery task in celeryd.tasks, which runs the import in
+the background while a status endpoint reports on its progress.
+
+# spool_form_upload(file, username)
+
+This saves the werkzeug FileStorage object passed by the view function to a
+per-user directory under the `upload_folder` app config, and returns the
+path to the spooled file. The file is removed once the import has run.
+
+# iter_upload_chunks(filepath, chunk_size)
+
+This yields the contents of a CSV or Excel file as a series of DataFrames of at
+most `chunk_size` rows. CSV files are read using pandas' `chunksize` param and
+.xlsx files are streamed using openpyxl's read-only mode, so memory use stays
+bounded by the chunk size rather than by the file size. Legacy .xls files have
+no streaming reader, so these are read in full and then sliced.
+
+# validate_upload_chunk(df, schema, first_row_number)
+
+This applies each field's `output_data` type, required flag and validators to a
+chunk, column by column. Types are coerced in a vectorised fashion (eg. using
+pd.to_numeric and pd.to_datetime with errors='coerce'), and validators are run
+once per distinct value in a column rather than once per row. It returns the
+rows that passed, cast to their output types, and a list of errors - one per
+failing cell - with the row number as it appears in the uploaded file.
+
+# import_form_upload(filepath, form_name, ...)
+
+This validates each chunk against the compiled form schema (see app.form_registry),
+bulk inserts the rows that passed validation using MongoDB.write_documents_to_collection,
+and writes the rows that did not to an error report CSV that users can download from
+the forms.download_upload_errors view. Error reports are removed after `form_upload_errors_max_age`
+days, the next time the same user imports a file. Nothing is written to the database for a row
+that fails validation. It calls the optional `progress_callback` after each chunk with
+a summary dict, and returns the same summary once the file has been fully processed.
+
+"""
+
+__name__ = "app.form_imports"
+__author__ = "Sig Janoska-Bedi"
+__credits__ = ["Sig Janoska-Bedi"]
+__version__ = "2.2.0"
+__license__ = "AGPL-3.0"
+__maintainer__ = "Sig Janoska-Bedi"
+__email__ = "signe@atreeus.com"
+
+import os, uuid, csv, time
+import pandas as pd
+from werkzeug.utils import secure_filename
+
+from app.config import config
+from app.mongo import mongodb
+from app.form_registry import compile_form_schema, lint_field_value
+
+
+def get_form_import_directory(username):
+    path = os.path.join(config['upload_folder'], 'form_imports', secure_filename(str(username)))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def spool_form_upload(file, username):
+
+    # we prefix the spooled file with a random ID to avoid collisions between
+    # concurrent uploads, but keep the extension so we know how to parse it.
+    upload_id = uuid.uuid4().hex
+    extension = os.path.splitext(secure_filename(file.filename))[1].lower()
+
+    filepath = os.path.join(get_form_import_directory(username), f"{upload_id}{extension}")
+    file.save(filepath)
+
+    return filepath
+
+
+# here we estimate the number of data rows in the file so we can report progress as
+# a percentage; for CSVs this is a line count, so it may be slightly off when cells
+# contain line breaks, which is fine for a progress bar.
+def estimate_upload_row_count(filepath):
+
+    try:
+        if filepath.endswith('.xlsx'):
+            from openpyxl import load_workbook
+            workbook = load_workbook(filepath, read_only=True)
+            count = workbook.worksheets[0].max_row or 0
+            workbook.close()
+
+        elif filepath.endswith('.xls'):
+            return None
+
+        else:
+            with open(filepath, 'rb') as f:
+                count = sum(1 for _ in f)
+
+        # drop the header row
+        return max(count - 1, 0)
+
+    except Exception:
+        return None
+
+
+def iter_upload_chunks(filepath, chunk_size=None):
+
+    chunk_size = chunk_size if chunk_size else config['form_upload_chunk_size']
+
+    if filepath.endswith('.xlsx'):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(filepath, read_only=True, data_only=True)
+
+        try:
+            # ensure the excel document only has one sheet
+            assert len(workbook.sheetnames) == 1, "Your submitted Excel file has too many sheets. To avoid breaking assumptions, please only submit Excel files with a single sheet."
+
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+
+            try:
+                header = [str(x) if x is not None else '' for x in next(rows)]
+            except StopIteration:
+                return
+
+            chunk = []
+            for row in rows:
+
+                # openpyxl yields trailing empty rows in some files; skip these
+                if all(x is None for x in row):
+                    continue
+
+                chunk.append(row)
+
+                if len(chunk) >= chunk_size:
+                    yield pd.DataFrame(chunk, columns=header)
+                    chunk = []
+
+            if len(chunk) > 0:
+                yield pd.DataFrame(chunk, columns=header)
+
+        finally:
+            workbook.close()
+
+    elif filepath.endswith('.xls'):
+        excel_file = pd.ExcelFile(filepath, engine='xlrd')
+
+        # ensure the excel document only has one sheet
+        assert len(excel_file.sheet_names) == 1, "Your submitted Excel file has too many sheets. To avoid breaking assumptions, please only submit Excel files with a single sheet."
+
+        df = excel_file.parse()
+
+        for start in range(0, len(df.index), chunk_size):
+            yield df.iloc[start:start+chunk_size]
+
+    else:
+        # we read every cell as a string, and leave empty cells as empty strings, so pandas 
+        # does not infer a different type for each chunk, or turn values like 'NA' into NaN;
+        # each column is then cast using the form schema, see coerce_upload_column()
+        for chunk in pd.read_csv(filepath, chunksize=chunk_size, dtype=str, keep_default_na=False):
+            yield chunk
+
+
+# here we verify that the chunk has all the columns the form expects, and return it with
+# any stray columns dropped. We also replace NaN values with None so they are stored as
+# null in MongoDB, rather than as float('nan').
+def prepare_upload_chunk(df, schema):
+
+    for x in schema.keys(): # a minimalist common sense check
+        assert x in df.columns, f"{x} not in columns"
+
+    df = df[[x for x in schema.keys()]]
+
+    return df.astype(object).where(pd.notnull(df), None)
+
+
+# here we cast a column to the field's output type. We return the cast column, with values
+# converted back to native python types so pymongo can encode them, and a boolean mask of
+# the non-missing values that could not be cast.
+def coerce_upload_column(series, field_schema, missing):
+
+    output_type = field_schema['type']
+
+    # fields that permit multiple values, like checkboxes, are passed in a single cell as
+    # a comma-separated string
+    if output_type == 'list' or field_schema['input_type'] == 'checkbox':
+        coerced = series.map(lambda x: x if isinstance(x, list) else [y.strip() for y in str(x).split(',') if y.strip() != ''], na_action='ignore')
+        return coerced.where(~missing, None), pd.Series(False, index=series.index)
+
+    if output_type in ['int', 'float']:
+        numeric = pd.to_numeric(series, errors='coerce')
+        invalid = ~missing & numeric.isna()
+
+        if output_type == 'int':
+            invalid = invalid | (~missing & numeric.notna() & (numeric % 1 != 0))
+            cast = int
+        else:
+            cast = float
+
+        # we build this as an object series, otherwise pandas would upcast ints to floats
+        coerced = pd.Series([cast(x) if pd.notna(x) else None for x in numeric], index=series.index, dtype=object)
+        return coerced.where(~missing & ~invalid, None), invalid
+
+    if output_type == 'date':
+        dates = pd.to_datetime(series, errors='coerce')
+        invalid = ~missing & dates.isna()
+        coerced = dates.dt.strftime("%Y-%m-%d")
+        return coerced.astype(object).where(~missing & ~invalid, None), invalid
+
+    # default to treating values as strings; nb. Excel files may contain numeric or date
+    # cells, so we cast them back here
+    coerced = series.map(lambda x: str(x), na_action='ignore')
+    return coerced.where(~missing, None), pd.Series(False, index=series.index)
+
+
+def run_field_validators(series, validators):
+
+    # we collect the error message of the first validator each value fails, or None if it passes
+    def validate(value):
+        result = lint_field_value(validators, value)
+        return None if result is True else result
+
+    # list values are unhashable, so we validate these row by row; otherwise, we validate
+    # each distinct value once and map the results back onto the column.
+    if series.map(lambda x: isinstance(x, list)).any():
+        return series.map(validate)
+
+    results = {value: validate(value) for value in series.unique()}
+    return series.map(results)
+
+
+def validate_upload_chunk(df, schema, first_row_number=2):
+
+    df = prepare_upload_chunk(df, schema)
+
+    # we track the row number as it will appear to the user in their spreadsheet;
+    # by default, we assume the first data row follows a single header row
+    row_numbers = pd.Series(range(first_row_number, first_row_number+len(df.index)), index=df.index)
+
+    errors = []
+    invalid_rows = pd.Series(False, index=df.index)
+
+    for field, field_schema in schema.items():
+
+        original = df[field]
+        missing = original.isna() | (original.map(lambda x: str(x).strip() == '', na_action='ignore') == True)
+
+        coerced, invalid = coerce_upload_column(original, field_schema, missing)
+
+        for index in original.index[invalid]:
+            errors.append({'row': row_numbers[index], 'field': field, 'value': original[index], 
+                                'error': f"{field} must be of type {field_schema['type']}."})
+
+        if field_schema['required']:
+            for index in original.index[missing]:
+                errors.append({'row': row_numbers[index], 'field': field, 'value': None, 
+                                'error': f"{field} is required."})
+
+        # we only run validators against values that were successfully cast
+        to_validate = ~missing & ~invalid
+        if len(field_schema['validators']) > 0 and to_validate.any():
+            messages = run_field_validators(coerced[to_validate], field_schema['validators'])
+            failed = messages.notna()
+
+            for index in messages.index[failed]:
+                errors.append({'row': row_numbers[index], 'field': field, 'value': original[index], 
+                                'error': messages[index]})
+
+            invalid = invalid | failed.reindex(df.index, fill_value=False)
+
+        invalid_rows = invalid_rows | invalid | (missing if field_schema['required'] else False)
+
+        df[field] = coerced
+
+    return df.loc[~invalid_rows], sorted(errors, key=lambda x: x['row'])
+
+
+# here we append errors to the error report for an upload, creating it if needed
+def write_upload_errors(errors, filepath):
+
+    write_header = not os.path.exists(filepath)
+
+    with open(filepath, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['row', 'field', 'value', 'error'])
+        if write_header:
+            writer.writeheader()
+        writer.writerows(errors)
+
+
+# here we remove error reports older than `form_upload_errors_max_age` days from an upload
+# directory, so they do not accumulate once users have had a chance to download them
+def remove_expired_upload_errors(directory, max_age=None):
+
+    max_age = max_age if max_age else config['form_upload_errors_max_age']
+    cutoff = time.time() - max_age * 86400
+    removed = 0
+
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+
+        try:
+            if filename.endswith('_errors.csv') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+
+        # another import may have removed the file already
+        except FileNotFoundError:
+            pass
+
+    return removed
+
+
+def import_form_upload(filepath, form_name, group=None, reporter=None, ip_address=None,
+                            chunk_size=None, progress_callback=None, remove_file=True):
+
+    schema = compile_form_schema(form_name, group=group)
+
+    # we clean up the uploader's expired error reports each time they import a file
+    remove_expired_upload_errors(os.path.dirname(filepath))
+
+    # the error report shares the random ID of the spooled file, see spool_form_upload()
+    errors_filename = f"{os.path.splitext(os.path.basename(filepath))[0]}_errors.csv"
+    errors_filepath = os.path.join(os.path.dirname(filepath), errors_filename)
+
+    summary = {
+        'form_name': form_name,
+        'reporter': reporter,
+        'total': estimate_upload_row_count(filepath),
+        'processed': 0,
+        'inserted': 0,
+        'rejected': 0,
+        'errors_file': None,
+    }
+
+    try:
+        for chunk in iter_upload_chunks(filepath, chunk_size=chunk_size):
+
+            valid_rows, errors = validate_upload_chunk(chunk, schema, first_row_number=summary['processed']+2)
+
+            # we write errors before inserting anything from the chunk
+            if len(errors) > 0:
+                write_upload_errors(errors, errors_filepath)
+                summary['errors_file'] = errors_filename
+
+            document_ids = mongodb.write_documents_to_collection(valid_rows.to_dict(orient='records'), form_name,
+                                reporter=reporter, ip_address=ip_address)
+
+            summary['processed'] += len(chunk.index)
+            summary['inserted'] += len(document_ids)
+            summary['rejected'] += len(chunk.index) - len(valid_rows.index)
+
+            if progress_callback:
+                progress_callback(summary)
+
+    finally:
+        if remove_file and os.path.exists(filepath):
+            os.remove(filepath)
+
+    return summary
@@ -0,0 +1,367 @@
+"""
+form_registry.py: compiled views of the libreForms form config
+
+The internal form representation defined in libreforms/__init__.py (and
+extended by administrators in libreforms/form_config.py) is a nested set of
+dictionaries that a number of view functions walk, field by field, each time
+they need to know something about a form. This script compiles the parts of
+that representation that do not change between requests - like the fields a
+given group can see and their `output_data` specifications - so that callers
+like the background upload pipeline in app.form_imports can reuse them.
+
+# Reloading form definitions
+
+Administrators used to apply changes to libreforms/form_config.py by restarting
+the application, see app.views.admin.restart_now, which restarts every gunicorn
+worker. Instead, reload_form_registry() re-imports the form config, validates it
+using libreforms.lint, and swaps the new definitions into `libreforms.forms` in a
+single assignment; requests already in progress keep the references they hold.
+
+Each worker (and celery daemon) is its own process, so we use a marker file (the
+`form_registry_marker` app config) to share the current version between them. An
+administrator who reloads the forms writes a new version to the marker using 
+publish_form_registry_version(), and every other process picks this up the next
+time it calls refresh_form_registry_if_stale(), which only stats the marker
+unless it has changed. The structures compiled below are keyed on the version, so
+they are never shared between two versions of the form definitions.
+
+# compile_form_metadata(group=None)
+
+This returns a bundle of the per-form metadata that views otherwise rebuild on each
+request by walking `libreforms.forms`: the forms that appear in the forms, tables and
+dashboards menus for `group`, and for each form its display name, the fields visible
+to `group`, its `_depends_on` dependency tree, and the fields rendered as user badges.
+The bundle is compiled once per version of the form definitions and group, and the
+form menus, the `_depends_on` data passed to the form templates (see 
+app.views.forms.compile_depends_on_data) and the submission badges (see
+app.views.submissions.generate_username_badge_list) read from it.
+
+# load_form_dataframe(form_name, include_metadata=False, exclude_fields=[])
+
+This loads a form's submissions into pandas with dtypes derived from the form config
+(see compile_form_dtypes), rather than as `object` columns, which substantially reduces
+the memory used by each loaded form; journal and metadata fields are dropped by default.
+
+# lint_field_value(validators, value)
+
+This runs a list of compiled validators against a value, returning True if the
+value passes each of them, or the error message of the first validator it fails.
+This is shared by the field linting views in app.views.forms and by the upload
+validation in app.form_imports.
+
+# compile_form_schema(form_name, group=None)
+
+This returns a dictionary mapping each field that `group` has access to onto
+its `output_data` struct. Form configs (keys starting with an underscore) are
+dropped, as are fields where `group` is listed under `_deny_groups`. Unlike
+app.views.forms.propagate_form_fields, this does not call any callable field
+content, so it is safe to run outside of a request and to cache. Validators are
+normalised into a list of (callable, error message) tuples; administrators can
+pass validators either as bare callables or as tuples where the second value is
+the error message, see app.views.forms.lint_field.
+
+"""
+
+__name__ = "app.form_registry"
+__author__ = "Sig Janoska-Bedi"
+__credits__ = ["Sig Janoska-Bedi"]
+__version__ = "2.2.0"
+__license__ = "AGPL-3.0"
+__maintainer__ = "Sig Janoska-Bedi"
+__email__ = "signe@atreeus.com"
+
+import os, uuid, threading
+import libreforms
+from app.config import config
+from app.mongo import mongodb
+
+
+# here we store the compiled structures, keyed by (version, form_name, group)
+_compiled_schemas = {}
+_compiled_metadata = {}
+_compiled_dtypes = {}
+
+# this tracks the last state of the marker file seen by the current process, and
+# serializes reloads within it
+_marker_state = {'mtime': None}
+_reload_lock = threading.Lock()
+
+
+def field_is_visible_to_group(field_config, group):
+    return False if isinstance(field_config, dict) and '_deny_groups' in field_config \
+        and group in field_config['_deny_groups'] else True
+
+
+def compile_field_validators(field, validators):
+    return [ validator if isinstance(validator, tuple) else (validator, f"{field} failed validation.") 
+                for validator in validators ]
+
+
+def lint_field_value(validators, value):
+
+    for validator, error_msg in validators:
+        try:
+            assert validator(value), error_msg
+
+        except Exception as e:
+            return str(e) if str(e) else error_msg
+
+    return True
+
+
+def compile_form_schema(form_name, group=None):
+
+    key = (libreforms.forms_version, form_name, group)
+
+    if key not in _compiled_schemas:
+
+        schema = {}
+
+        for field, field_config in libreforms.forms[form_name].items():
+
+            # drop configs and fields the group does not have access to
+            if field.startswith("_") or not field_is_visible_to_group(field_config, group):
+                continue
+
+            output_data = field_config.get('output_data', {})
+
+            schema[field] = {
+                'type': output_data.get('type', 'str'),
+                'required': output_data.get('required', False),
+                'validators': compile_field_validators(field, output_data.get('validators', [])),
+                'input_type': field_config.get('input_field', {}).get('type', 'text'),
+            }
+
+        _compiled_schemas[key] = schema
+
+    return _compiled_schemas[key]
+
+
+def render_form_display_name(form_name, form_config):
+  
+  if '_title' in form_config and '_subtitle' in form_config:
+    return f"{form_config['_title']}: {form_config['_subtitle']}"
+
+  elif '_title' in form_config:
+    return form_config['_title']
+
+  return form_name.replace('_',' ')
+
+
+# this compiles `_depends_on` data for a form to build a data tree that can be parsed
+# by the jinja / javascript, in the format {field: {value: [dependent fields]}}
+def compile_depends_on_tree(form_name):
+
+    tree = {}
+
+    for field, field_config in libreforms.forms[form_name].items():
+
+        # ignore form configs that start with _ but only select if the _depends_on has been set
+        if not field.startswith("_") and "_depends_on" in field_config.keys():
+
+            element = field_config['_depends_on']
+            tree.setdefault(element[0], {}).setdefault(element[1], []).append(field)
+
+    return tree
+
+
+# this returns the fields we render as user badges for a given form; we start with the
+# metadata fields that always contain usernames, then add any fields where administrators
+# have set `_render_user_badges`.
+def compile_badge_fields(form_name):
+
+    fields = [  mongodb.metadata_field_names['owner'], 
+                mongodb.metadata_field_names['reporter'], 
+                mongodb.metadata_field_names['approver'], 
+                mongodb.metadata_field_names['approval'], ]
+
+    for field, field_config in libreforms.forms[form_name].items():
+        if not field.startswith("_") and field_config.get('_render_user_badges', False):
+            fields.append(field)
+
+    return fields
+
+
+def compile_form_metadata(group=None):
+
+    key = (libreforms.forms_version, group)
+
+    if key not in _compiled_metadata:
+
+        bundle = {
+            'version': libreforms.forms_version,
+            'group': group,
+            'menus': {'forms': [], 'tables': [], 'dashboards': []},
+            'forms': {},
+        }
+
+        for form_name, form_config in libreforms.forms.items():
+
+            # these mirror the access checks in app.views.forms (checkFormGroup, 
+            # checkTableGroup and checkDashboardGroup) used to build the menus
+            if field_is_visible_to_group(form_config, group):
+                bundle['menus']['forms'].append(form_name)
+
+            if field_is_visible_to_group(form_config.get('_table', None), group):
+                bundle['menus']['tables'].append(form_name)
+
+            if form_config.get('_dashboard', None):
+                bundle['menus']['dashboards'].append(form_name)
+
+            bundle['forms'][form_name] = {
+                'display_name': render_form_display_name(form_name, form_config),
+                'visible_fields': list(compile_form_schema(form_name, group=group).keys()),
+                'depends_on': compile_depends_on_tree(form_name),
+                'badge_fields': compile_badge_fields(form_name),
+            }
+
+        _compiled_metadata[key] = bundle
+
+    return _compiled_metadata[key]
+
+
+# this maps each field in a form onto the pandas dtype we load it as: select and radio fields, 
+# which tend to have a handful of distinct values, as `category`; int and float fields as the
+# nullable Int64 and Float64 dtypes; and date fields as datetimes. We also load the timestamp
+# metadata as a datetime, and owners and reporters as categories. Other fields stay `object`.
+def compile_form_dtypes(form_name):
+
+    key = (libreforms.forms_version, form_name)
+
+    if key not in _compiled_dtypes:
+
+        dtypes = {
+            mongodb.metadata_field_names['owner']: 'category',
+            mongodb.metadata_field_names['reporter']: 'category',
+            mongodb.metadata_field_names['timestamp']: 'datetime64[ns]',
+        }
+
+        for field, field_schema in compile_form_schema(form_name).items():
+
+            if field_schema['input_type'] in ['select', 'radio']:
+                dtypes[field] = 'category'
+
+            elif field_schema['type'] == 'int':
+                dtypes[field] = 'Int64'
+
+            elif field_schema['type'] == 'float':
+                dtypes[field] = 'Float64'
+
+            elif field_schema['type'] == 'date':
+                dtypes[field] = 'datetime64[ns]'
+
+        _compiled_dtypes[key] = dtypes
+
+    return _compiled_dtypes[key]
+
+
+# this loads a form's submissions as a typed dataframe, see compile_form_dtypes. We drop the 
+# journal and metadata fields, which hold the bulk of each document, unless `include_metadata` 
+# is set; `exclude_fields` can be used to drop any other fields. 
+def load_form_dataframe(form_name, include_metadata=False, exclude_fields=[]):
+
+    exclude_fields = list(exclude_fields)
+
+    if not include_metadata:
+        exclude_fields += [ mongodb.metadata_field_names[x] for x in ['journal', 'metadata'] if mongodb.metadata_field_names[x] not in exclude_fields ]
+
+    columns = ['_id'] + list(compile_form_schema(form_name).keys()) + \
+                [ mongodb.metadata_field_names[x] for x in ['owner', 'reporter', 'timestamp'] ]
+
+    return mongodb.read_documents_as_dataframe(form_name, dtypes=compile_form_dtypes(form_name), 
+                                                exclude_fields=exclude_fields, columns=columns)
+
+
+# this is the chunked version of load_form_dataframe, which yields a form's submissions 
+# matching `filter` as typed dataframes of at most `chunk_size` rows, see MongoDB.iter_dataframes.
+def iter_form_dataframes(form_name, chunk_size=1000, filter={}, include_metadata=False, exclude_fields=[]):
+
+    exclude_fields = list(exclude_fields)
+
+    if not include_metadata:
+        exclude_fields += [ mongodb.metadata_field_names[x] for x in ['journal', 'metadata'] if mongodb.metadata_field_names[x] not in exclude_fields ]
+
+    return mongodb.iter_dataframes(form_name, chunk_size=chunk_size, filter=filter,
+                                        projection={ x: 0 for x in exclude_fields } if len(exclude_fields) > 0 else None,
+                                        dtypes=compile_form_dtypes(form_name))
+
+
+def clear_form_registry_cache():
+    _compiled_schemas.clear()
+    _compiled_metadata.clear()
+    _compiled_dtypes.clear()
+
+
+def read_form_registry_marker():
+
+    try:
+        mtime = os.stat(config['form_registry_marker']).st_mtime_ns
+        with open(config['form_registry_marker'], 'r') as f:
+            return mtime, f.read().strip()
+
+    except FileNotFoundError:
+        return None, None
+
+
+# this is run when the application starts; the forms were loaded at import time, so
+# we just record the version they correspond to without reloading them.
+def sync_form_registry_version():
+
+    mtime, version = read_form_registry_marker()
+    _marker_state['mtime'] = mtime
+    libreforms.forms_version = version
+
+    return version
+
+
+def reload_form_registry(version=None):
+
+    with _reload_lock:
+
+        # we load and validate the new forms before touching the current ones, so a
+        # broken form config raises here and leaves the current forms in place
+        new_forms = libreforms.load_forms(reload_config=True)
+        libreforms.lint(new_forms, verbose=False)
+
+        libreforms.forms = new_forms
+        libreforms.forms_version = version
+
+        clear_form_registry_cache()
+
+    return version
+
+
+# here we write a new version to the marker and reload the forms in the current
+# process; other processes will reload the next time they check the marker.
+def publish_form_registry_version():
+
+    version = uuid.uuid4().hex
+
+    reload_form_registry(version=version)
+
+    with open(config['form_registry_marker'], 'w') as f:
+        f.write(version)
+
+    _marker_state['mtime'] = os.stat(config['form_registry_marker']).st_mtime_ns
+
+    return version
+
+
+def refresh_form_registry_if_stale():
+
+    try:
+        mtime = os.stat(config['form_registry_marker']).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+    if mtime == _marker_state['mtime']:
+        return False
+
+    mtime, version = read_form_registry_marker()
+    _marker_state['mtime'] = mtime
+
+    if version == libreforms.forms_version:
+        return False
+
+    reload_form_registry(version=version)
+    return True
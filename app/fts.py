@@ -0,0 +1,202 @@
+"""
+fts.py: an embedded full-text search backend using SQLite FTS5
+
+Search has used either an external elasticsearch server (see the `use_elasticsearch_as_wrapper`
+app config) or MongoDB's $text search, which creates a text index on each collection at query
+time, and falls back to a scan of every document in Python for fuzzy matching. For single-node
+deployments, setting the `use_sqlite_fts_search` app config instead keeps a full-text index of
+the form submissions in a single SQLite database file at `sqlite_fts_path`, which needs no
+extra service to run.
+
+# Schema
+
+We store one row per document in two tables: `search_documents`, which maps the document ID and
+form name to a rowid, and the FTS5 virtual table `search_index`, which holds the same content
+as the `fullString` field we send to elasticsearch (see app.search_index.build_search_document)
+under that rowid. Keeping the IDs in a regular table with a unique index means we can update or
+remove a document without scanning the full-text index. We use the `unicode61` tokenizer with
+diacritics removed, and build prefix indexes for two and three character prefixes, so prefix
+queries do not need to scan the whole vocabulary.
+
+# Incremental maintenance
+
+When `search_index_on_write` is set, each write to MongoDB records a search index event, and
+app.search_index.flush_search_index_events applies these to this index, shortly after the write,
+using update_fts_index(). The `flask libreforms reindex-search` command rebuilds the index from
+MongoDB using rebuild_fts_index().
+
+Writes only index the documents they touch, so when the index is first enabled on an existing
+deployment, it has to be built from the documents already stored. We record whether this has
+happened in the `search_state` table, and ensure_fts_index() builds the index if it has not;
+the search index flush calls this each time it runs, so the index is built by celery shortly
+after `use_sqlite_fts_search` is enabled. Until then, searches return no results.
+
+# search_fts_index(query, exclude_forms=None, limit=10)
+
+This splits the query into terms and matches documents containing every term as a prefix, so
+a search for `jan smi` matches `Janet Smith`, and ranks them using BM25. Forms in `exclude_forms`
+are excluded, and documents in forms listed in `exclude_forms_from_search` are never indexed.
+FTS5 does not support fuzzy matching, so the `fuzzy_search` app config does not apply here;
+prefix matching covers the most common case of partially typed terms.
+
+"""
+
+__name__ = "app.fts"
+__author__ = "Sig Janoska-Bedi"
+__credits__ = ["Sig Janoska-Bedi"]
+__version__ = "2.2.0"
+__license__ = "AGPL-3.0"
+__maintainer__ = "Sig Janoska-Bedi"
+__email__ = "signe@atreeus.com"
+
+import os, re, sqlite3, contextlib
+from app.config import config
+
+
+# here we create the tables if they do not exist yet; we set WAL mode so that searches do not
+# block on, or get blocked by, the celery worker applying index updates
+def initialize_fts_database(conn):
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS search_documents (rowid INTEGER PRIMARY KEY, document_id TEXT NOT NULL UNIQUE, form_name TEXT NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS search_documents_form_name ON search_documents (form_name)")
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(content, tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+    conn.execute("CREATE TABLE IF NOT EXISTS search_state (key TEXT PRIMARY KEY, value TEXT)")
+
+
+# like MongoDB, we open a connection for each transaction rather than sharing one between
+# workers; changes are committed when the block exits without an exception
+@contextlib.contextmanager
+def get_fts_connection():
+
+    path = config['sqlite_fts_path']
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=30)
+
+    try:
+        initialize_fts_database(conn)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def delete_fts_documents(conn, document_ids):
+
+    for document_id in document_ids:
+        row = conn.execute("SELECT rowid FROM search_documents WHERE document_id = ?", (document_id,)).fetchone()
+
+        if row:
+            conn.execute("DELETE FROM search_index WHERE rowid = ?", row)
+            conn.execute("DELETE FROM search_documents WHERE rowid = ?", row)
+
+
+# `documents` is a list of (form_name, document_id, content) tuples, which replace any existing
+# rows for those documents, and `delete_ids` is a list of document IDs to remove from the index
+def update_fts_index(documents=[], delete_ids=[]):
+
+    with get_fts_connection() as conn:
+
+        delete_fts_documents(conn, list(delete_ids) + [ x[1] for x in documents ])
+
+        for form_name, document_id, content in documents:
+            rowid = conn.execute("INSERT INTO search_documents (document_id, form_name) VALUES (?, ?)", (document_id, form_name)).lastrowid
+            conn.execute("INSERT INTO search_index (rowid, content) VALUES (?, ?)", (rowid, content))
+
+    return len(documents) + len(delete_ids)
+
+
+# these are the forms we index when none are passed: every form not excluded from search
+def get_searchable_forms():
+
+    import libreforms
+
+    exclude_forms = config['exclude_forms_from_search'] if config['exclude_forms_from_search'] else []
+    return [ x for x in libreforms.forms if x not in exclude_forms ]
+
+
+def reindex_fts_documents(conn, form_names, prune=False):
+
+    from app.mongo import mongodb
+    from app.search_index import get_index_projection, build_search_document
+
+    total = 0
+
+    if prune:
+        stale = [ x[0] for x in conn.execute("SELECT DISTINCT form_name FROM search_documents") if x[0] not in form_names ]
+    else:
+        stale = []
+
+    for form_name in list(form_names) + stale:
+        conn.execute("DELETE FROM search_index WHERE rowid IN (SELECT rowid FROM search_documents WHERE form_name = ?)", (form_name,))
+        conn.execute("DELETE FROM search_documents WHERE form_name = ?", (form_name,))
+
+    for form_name in form_names:
+        for document in mongodb.iter_documents_from_collection(form_name, projection=get_index_projection()):
+            rowid = conn.execute("INSERT INTO search_documents (document_id, form_name) VALUES (?, ?)", (str(document['_id']), form_name)).lastrowid
+            conn.execute("INSERT INTO search_index (rowid, content) VALUES (?, ?)", (rowid, build_search_document(form_name, document)['fullString']))
+            total += 1
+
+    # we merge the index segments written above, which speeds up subsequent queries
+    conn.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+
+    return total
+
+
+# here we reindex every document in `form_names` from MongoDB; if `prune` is set, we also
+# remove every document from any other form, eg. forms added to `exclude_forms_from_search`
+def rebuild_fts_index(form_names=None, prune=False):
+
+    with get_fts_connection() as conn:
+
+        total = reindex_fts_documents(conn, form_names if form_names else get_searchable_forms(), prune=prune)
+
+        if prune:
+            conn.execute("INSERT OR REPLACE INTO search_state (key, value) VALUES ('built', '1')")
+
+    return total
+
+
+# this builds the index from every searchable form, unless it has already been built; we 
+# take a write lock before checking, so concurrent flushes do not build it twice. We return 
+# the number of documents indexed, or None if the index had already been built.
+def ensure_fts_index():
+
+    with get_fts_connection() as conn:
+
+        conn.execute("BEGIN IMMEDIATE")
+
+        if conn.execute("SELECT value FROM search_state WHERE key = 'built'").fetchone():
+            return None
+
+        total = reindex_fts_documents(conn, get_searchable_forms(), prune=True)
+        conn.execute("INSERT OR REPLACE INTO search_state (key, value) VALUES ('built', '1')")
+
+        return total
+
+
+# here we convert a search query into an FTS5 query that matches each term as a prefix; we
+# quote each term, so characters in the query are never parsed as FTS5 operators
+def build_fts_match_query(query):
+    return ' '.join(f'"{x}"*' for x in re.findall(r'\w+', query))
+
+
+def search_fts_index(query, exclude_forms=None, limit=10):
+
+    match = build_fts_match_query(query)
+
+    if not match:
+        return []
+
+    exclude_forms = list(exclude_forms) if exclude_forms else []
+
+    with get_fts_connection() as conn:
+
+        rows = conn.execute(f"""SELECT search_documents.document_id, search_documents.form_name, search_index.content
+                                FROM search_index JOIN search_documents ON search_documents.rowid = search_index.rowid
+                                WHERE search_index MATCH ? {f"AND search_documents.form_name NOT IN ({', '.join('?' for x in exclude_forms)})" if exclude_forms else ''}
+                                ORDER BY bm25(search_index) LIMIT ?""", [match] + exclude_forms + [limit]).fetchall()
+
+    return [ {'_id': document_id, 'formName': form_name, 'fullString': content} for document_id, form_name, content in rows ]
@@ -74,6 +74,11 @@ specified, will tailor when the reports start and stop sending. The `active`
 field will determine whether the report is actively sending or disabled.
 The `last_run_at` field captures the date that the report was last run. There
 are human readable copies of the timestamps to avoid needing add'l app logic.
+The indexed `next_run_at` field stores the time the report is next due, which
+the scheduler in app.filters uses to select only the reports that are due; it
+is None for reports that are inactive, manual or expired, see Report.schedule().
+The `dispatch_id` field is set while a report is leased to a celery task, when 
+the `report_fan_out` config is set.
 The `type` field captures the types of forms we'd like to capture by the report; 
 those created/modified since the last run, those created since the beginning of 
 time, and those created in some static timeframe relative to the time the 
@@ -92,6 +97,7 @@ from flask import current_app
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from sqlalchemy import inspect, text
 
 db = SQLAlchemy()
 
@@ -154,3 +160,73 @@ class Report(db.Model):
     end_at_human_readable = db.Column(db.String(100)) 
     last_run_at = db.Column(db.Float) # this is an optional timestamp for when the report was last run
     last_run_at_human_readable = db.Column(db.String(100)) 
+    next_run_at = db.Column(db.Float, index=True) # this is the timestamp when the report is next due, or None if it is not scheduled
+    dispatch_id = db.Column(db.String(36)) # this identifies the celery task a report has been leased to, if any, see app.filters.dispatch_eligible_reports
+    failed_attempts = db.Column(db.Integer, default=0) # this counts the consecutive failed attempts to send the report's current run, see app.filters.send_form_reports
+
+    # we map each human-readable `frequency` option to its corresponding interval in seconds
+    frequencies = {
+        'hourly': 3600,
+        'daily': 86400,
+        'weekly': 604800,
+        'monthly': 2592000, # this we map to 30 days, though this may have problems...
+        'annually': 31536000,
+    }
+
+    # this sets `next_run_at` to one interval after the report was last run (or, if it has
+    # not been run, after `start_at`), but not before `start_at`; reports that are inactive,
+    # manual, or that would next run after `end_at`, are not scheduled.
+    def schedule(self):
+
+        # rescheduling a report ends any lease it holds, and starts its next run afresh
+        self.dispatch_id = None
+        self.failed_attempts = 0
+
+        if not self.active or self.frequency not in self.frequencies:
+            self.next_run_at = None
+            return self.next_run_at
+
+        last_run_at = self.last_run_at if self.last_run_at else (self.start_at if self.start_at else datetime.timestamp(datetime.now()))
+        next_run_at = max(last_run_at + self.frequencies[self.frequency], self.start_at if self.start_at else 0)
+
+        self.next_run_at = next_run_at if not self.end_at or next_run_at <= self.end_at else None
+        return self.next_run_at
+
+
+# db.create_all() does not add columns or indexes to existing tables, so here we add the
+# `next_run_at` column, and its index, to report tables created before it existed, and schedule
+# each report; we also add the `dispatch_id` and `failed_attempts` columns. We check for the column and the index separately, since some databases, like
+# MySQL, commit the ALTER TABLE statement on its own, and we use SQLAlchemy to create the index
+# because `CREATE INDEX IF NOT EXISTS` is not supported by every database.
+def upgrade_report_table():
+
+    upgraded = False
+
+    if 'next_run_at' not in [ x['name'] for x in inspect(db.engine).get_columns(Report.__tablename__) ]:
+        with db.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {Report.__tablename__} ADD COLUMN next_run_at FLOAT"))
+
+        for report in Report.query.all():
+            report.schedule()
+        db.session.commit()
+
+        upgraded = True
+
+    if 'dispatch_id' not in [ x['name'] for x in inspect(db.engine).get_columns(Report.__tablename__) ]:
+        with db.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {Report.__tablename__} ADD COLUMN dispatch_id VARCHAR(36)"))
+
+        upgraded = True
+
+    if 'failed_attempts' not in [ x['name'] for x in inspect(db.engine).get_columns(Report.__tablename__) ]:
+        with db.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {Report.__tablename__} ADD COLUMN failed_attempts INTEGER DEFAULT 0"))
+
+        upgraded = True
+
+    for index in Report.__table__.indexes:
+        if index.name not in [ x['name'] for x in inspect(db.engine).get_indexes(Report.__tablename__) ]:
+            index.create(db.engine, checkfirst=True)
+            upgraded = True
+
+    return upgraded
@@ -113,7 +113,40 @@ connections to the database.
 # get_document()
 
 This method is a little heavy, but will get a document when you pass the collection and
-document_id. 
+document_id.
+
+# Submission rollups
+
+We keep daily counts of the documents in each collection, broken down by owner and
+approval state, in the `submission_rollups` collection of the `libreforms_meta` database.
+Each method that writes documents updates these counts, see update_submission_rollups(),
+and they can be read using query_submission_rollups() or rebuilt from the documents using
+rebuild_submission_rollups(). The application rebuilds them when it first starts against a
+database, so documents written before the rollups existed are counted, see 
+initialize_submission_rollups().
+
+# Search index marks
+
+Rather than re-sending every document to elasticsearch on each index cycle, app.search_index
+keeps a high-water mark per form in the `search_index_marks` collection of the `libreforms_meta`
+database. Soft deletes and restores do not change a document's `Timestamp`, so we record them
+as `deleted_timestamp` and `restored_timestamp` in its `Metadata` field, see 
+migrate_single_document().
+
+# Mail digest queue
+
+When notification digests are enabled, see app.notifications, queued notifications are 
+stored in the `mail_digest_queue` collection of the `libreforms_meta` database, one per 
+recipient. claim_due_notifications() marks the notifications that are due with a claim 
+token, so that concurrent flushes do not send the same digest twice.
+
+# Search index events
+
+When `search_index_on_write` and either `use_elasticsearch_as_wrapper` or `use_sqlite_fts_search` 
+are set, each method that 
+writes, soft deletes or restores documents records an `index` or `delete` event for each 
+document in the `search_index_events` collection of the `libreforms_meta` database, see
+emit_search_index_events(), and app.search_index sends them to elasticsearch in bulk.
 
 
 # Errors
@@ -143,7 +176,7 @@ __license__ = "AGPL-3.0"
 __maintainer__ = "Sig Janoska-Bedi"
 __email__ = "signe@atreeus.com"
 
-from pymongo import MongoClient, TEXT
+from pymongo import MongoClient, TEXT, UpdateOne
 import pymongo.errors
 import os
 import pandas as pd
@@ -174,6 +207,15 @@ class MongoDB:
 
         self.dbname = 'libreforms'
 
+        # we keep application bookkeeping, like per-form write versions, in a separate 
+        # database, so it does not show up as a form in collections() or searches
+        self.meta_dbname = 'libreforms_meta'
+
+        # this is called with a countdown (in seconds) when search index events are waiting to
+        # be sent to elasticsearch, see emit_search_index_events(); the app sets it to schedule 
+        # a celery task when a search index backend is enabled
+        self.search_index_listener = None
+
     # we set and update the class variable that will be used to set metadata field names, see
     # https://github.com/libreForms/libreForms-flask/issues/195
     def set_metadata_field_names(self,**kwargs):
@@ -215,6 +257,359 @@ class MongoDB:
         return fields
 
 
+    # each collection has a write version, which we increment whenever its documents are written, 
+    # modified or moved, so that callers can cache data derived from a collection and invalidate it
+    # when the collection changes; for example, see the dashboard figure cache in app.aggregations.
+    # We reuse the caller's client when one is passed.
+    def bump_write_version(self, *collection_names, client=None):
+
+        def bump(client):
+            versions = client[self.meta_dbname]['write_versions']
+            for collection_name in collection_names:
+                versions.update_one({'_id': collection_name}, {'$inc': {'version': 1}}, upsert=True)
+
+        # callers bump the version after their write has succeeded, so we log a failure here rather
+        # than raising it to the caller; a missed bump only leaves one stale cache entry
+        try:
+            if client:
+                return bump(client)
+
+            with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+                return bump(client)
+
+        except Exception as e:
+            from app import log
+            log.warning(f"LIBREFORMS - failed to bump the write version for {', '.join(collection_names)}: {e}")
+
+    def get_write_version(self, collection_name):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            document = client[self.meta_dbname]['write_versions'].find_one({'_id': collection_name})
+            return document['version'] if document else 0
+
+    # here we determine the rollup bucket a document is counted in, see update_submission_rollups():
+    # its collection, the day it was created, its owner and its approval state. Approvals are 
+    # encrypted with the approver's certificate, so we do not distinguish approvals from 
+    # disapprovals here: a document is `unassigned` if it has no approver, `pending` if it is 
+    # awaiting a decision, and `decided` once the approver has signed it.
+    def get_rollup_key(self, collection_name, document):
+
+        metadata = document.get(self.metadata_field_names['metadata']) or {}
+        created = metadata.get('created_timestamp') or document.get(self.metadata_field_names['timestamp'])
+
+        if document.get(self.metadata_field_names['approval']) not in [None, '', False]:
+            approval = 'decided'
+        elif document.get(self.metadata_field_names['approver']) not in [None, '', False]:
+            approval = 'pending'
+        else:
+            approval = 'unassigned'
+
+        # timestamps are stored as str(datetime), so the day is the first ten characters
+        return {
+            'form': collection_name, 
+            'day': str(created)[:10] if created else '', 
+            'owner': document.get(self.metadata_field_names['owner']), 
+            'approval': approval,
+        }
+
+    # this is the aggregation equivalent of get_rollup_key(), used by rebuild_submission_rollups()
+    def get_rollup_key_expression(self, collection_name):
+
+        def is_set(field):
+            return {'$not': [{'$in': [{'$ifNull': [f'${field}', None]}, [None, '', False]]}]}
+
+        return {
+            'form': collection_name,
+            'day': {'$substrBytes': [{'$ifNull': [f"${self.metadata_field_names['metadata']}.created_timestamp", 
+                                                    f"${self.metadata_field_names['timestamp']}", '']}, 0, 10]},
+            'owner': {'$ifNull': [f"${self.metadata_field_names['owner']}", None]},
+            'approval': {'$switch': {'branches': [
+                {'case': is_set(self.metadata_field_names['approval']), 'then': 'decided'},
+                {'case': is_set(self.metadata_field_names['approver']), 'then': 'pending'},
+            ], 'default': 'unassigned'}},
+        }
+
+    # we keep a count of documents per (form, day created, owner, approval state) in the 
+    # `submission_rollups` collection, so that views answering "how many submissions per form 
+    # over time" can read a few rollup rows rather than every document; see query_submission_rollups().
+    # Writers call this with the documents they have `removed` from and `added` to a collection 
+    # (a modification removes the old version and adds the new one), and we apply the net change 
+    # to each bucket. We reuse the caller's client when one is passed.
+    def update_submission_rollups(self, collection_name, removed=[], added=[], client=None):
+
+        deltas = {}
+        for documents, delta in [(removed, -1), (added, 1)]:
+            for document in documents:
+                key = tuple(self.get_rollup_key(collection_name, document).items())
+                deltas[key] = deltas.get(key, 0) + delta
+
+        operations = [ UpdateOne({'_id': dict(key)}, {'$inc': {'count': delta}, '$set': dict(key)}, upsert=True) 
+                            for key, delta in deltas.items() if delta != 0 ]
+
+        if len(operations) < 1:
+            return
+
+        def apply(client):
+            rollups = client[self.meta_dbname]['submission_rollups']
+            rollups.bulk_write(operations, ordered=False)
+            rollups.delete_many({'form': collection_name, 'count': {'$lte': 0}})
+
+        # callers update the rollups after their write has succeeded, so we log a failure here 
+        # rather than raising it to the caller; `flask libreforms rebuild-rollups` repairs any drift
+        try:
+            if client:
+                return apply(client)
+
+            with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+                return apply(client)
+
+        except Exception as e:
+            from app import log
+            log.warning(f"LIBREFORMS - failed to update the submission rollups for {collection_name}, run `flask libreforms rebuild-rollups` to repair them: {e}")
+
+    # the rollups are only maintained by writes, so documents written before they were introduced 
+    # are not counted until we rebuild them; here we rebuild every collection's rollups the first 
+    # time the application starts against a database. We record this in `rollup_state`, claiming
+    # it atomically so only one of the application's workers does the rebuild. We return True if
+    # this process rebuilt the rollups.
+    def initialize_submission_rollups(self):
+
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            state = client[self.meta_dbname]['rollup_state']
+
+            try:
+                claimed = state.update_one({'_id': 'submission_rollups', 'initialized': {'$ne': True}}, 
+                                            {'$set': {'initialized': True}}, upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                return False
+
+            if claimed.modified_count < 1 and not claimed.upserted_id:
+                return False
+
+            try:
+                self.rebuild_submission_rollups(client=client)
+            except Exception:
+                # we release the claim, so the next start tries again
+                state.update_one({'_id': 'submission_rollups'}, {'$set': {'initialized': False}})
+                raise
+
+            return True
+
+    # this recounts the rollups for each of `collection_names`, or for every collection if none
+    # are passed, from the documents themselves. We call this after bulk changes, like migrations
+    # and restores, and it is exposed through the `flask libreforms rebuild-rollups` command in case 
+    # the rollups drift, eg. because documents were modified outside the application.
+    def rebuild_submission_rollups(self, *collection_names, client=None):
+
+        def rebuild(client):
+            db = client[self.dbname]
+            rollups = client[self.meta_dbname]['submission_rollups']
+            rollups.create_index([('form', 1), ('day', 1)])
+
+            for collection_name in collection_names if len(collection_names) > 0 else db.list_collection_names():
+
+                counts = list(db[collection_name].aggregate([
+                    {'$group': {'_id': self.get_rollup_key_expression(collection_name), 'count': {'$sum': 1}}},
+                ]))
+
+                rollups.delete_many({'form': collection_name})
+                if len(counts) > 0:
+                    rollups.insert_many([ {**x, **x['_id']} for x in counts ], ordered=False)
+
+        if client:
+            return rebuild(client)
+
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            return rebuild(client)
+
+    # this is the query API for the submission rollups: it sums the rollup counts matching the
+    # passed filters, grouped by `group_by` (any of 'form', 'day', 'owner' and 'approval'), and
+    # returns a dataframe with the `group_by` columns and a `count` column, sorted by the `group_by`
+    # columns. `start` and `end` are inclusive, and may be dates or 'YYYY-MM-DD' strings. Soft 
+    # deleted documents are counted under the deleted collection, eg. `_form_name`.
+    def query_submission_rollups(self, form_names=None, start=None, end=None, owner=None, approval=None, group_by=['form', 'day']):
+
+        query = {}
+
+        if form_names:
+            query['form'] = {'$in': list(form_names)}
+
+        if start or end:
+            query['day'] = {**({'$gte': str(start)[:10]} if start else {}), **({'$lte': str(end)[:10]} if end else {})}
+
+        if owner:
+            query['owner'] = owner
+
+        if approval:
+            query['approval'] = approval
+
+        pipeline = [
+            {'$match': query},
+            {'$group': {'_id': {x: f'${x}' for x in group_by}, 'count': {'$sum': '$count'}}},
+            {'$sort': {f'_id.{x}': 1 for x in group_by}},
+        ]
+
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            results = list(client[self.meta_dbname]['submission_rollups'].aggregate(pipeline))
+
+        return pd.DataFrame([{**x['_id'], 'count': x['count']} for x in results], columns=list(group_by) + ['count'])
+
+
+    # here we add notifications to the mail digest queue, see app.notifications
+    def queue_notifications(self, notifications):
+
+        if len(notifications) < 1:
+            return
+
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            client[self.meta_dbname]['mail_digest_queue'].insert_many(notifications)
+
+    # this claims the queued notifications of each recipient whose oldest unclaimed notification
+    # was queued at or before `cutoff`, by setting their `claim` field, and returns them as a 
+    # dict mapping each recipient to their notifications in the order they were queued. Claims
+    # older than `claim_timeout` seconds, eg. from a flush that crashed, are released first.
+    def claim_due_notifications(self, cutoff, claim, current_time=None, claim_timeout=3600):
+
+        current_time = current_time if current_time else datetime.datetime.utcnow().timestamp()
+
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            queue = client[self.meta_dbname]['mail_digest_queue']
+            queue.create_index([('claim', 1), ('recipient', 1), ('queued_at', 1)])
+
+            queue.update_many({'claim': {'$ne': None}, 'claimed_at': {'$lte': current_time - claim_timeout}}, {'$set': {'claim': None}})
+
+            recipients = [ x['_id'] for x in queue.aggregate([
+                {'$match': {'claim': None}},
+                {'$group': {'_id': '$recipient', 'oldest': {'$min': '$queued_at'}}},
+                {'$match': {'oldest': {'$lte': cutoff}}},
+            ]) ]
+
+            if len(recipients) < 1:
+                return {}
+
+            queue.update_many({'recipient': {'$in': recipients}, 'claim': None}, {'$set': {'claim': claim, 'claimed_at': current_time}})
+
+            notifications = {}
+            for notification in queue.find({'claim': claim}).sort('queued_at', 1):
+                notifications.setdefault(notification['recipient'], []).append(notification)
+
+            return notifications
+
+    # this returns claimed notifications for `recipients` to the queue, eg. if their digest could not be sent
+    def release_claimed_notifications(self, claim, recipients):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            client[self.meta_dbname]['mail_digest_queue'].update_many({'claim': claim, 'recipient': {'$in': recipients}}, {'$set': {'claim': None}})
+
+    def delete_claimed_notifications(self, claim):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            client[self.meta_dbname]['mail_digest_queue'].delete_many({'claim': claim})
+
+    # here we read the search index high-water marks for a form, see app.search_index; these are the
+    # latest `Timestamp` indexed and the latest `deleted_timestamp` removed from the index.
+    def get_search_index_marks(self, form_name):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            marks = client[self.meta_dbname]['search_index_marks'].find_one({'_id': form_name})
+            return marks if marks else {'_id': form_name, 'indexed': None, 'deleted': None}
+
+    def set_search_index_marks(self, form_name, **marks):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            client[self.meta_dbname]['search_index_marks'].update_one({'_id': form_name}, {'$set': marks}, upsert=True)
+
+    # this creates the indexes we use to find documents written, restored and soft deleted 
+    # since the last search index cycle; create_index is a no-op when the index exists.
+    def create_search_index_indexes(self, form_name):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            db = client['libreforms']
+            db[form_name].create_index(self.metadata_field_names['timestamp'])
+            db[form_name].create_index(f"{self.metadata_field_names['metadata']}.restored_timestamp", sparse=True)
+            db[f"_{form_name}"].create_index(f"{self.metadata_field_names['metadata']}.deleted_timestamp", sparse=True)
+
+    # table exports read each form sorted by its timestamp, see app.views.tables
+    def create_timestamp_index(self, collection_name):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            client['libreforms'][collection_name].create_index(self.metadata_field_names['timestamp'])
+
+    # the analytics export reads each form sorted by its created timestamp, see app.exports
+    def create_export_indexes(self, form_name):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            db = client['libreforms']
+            db[form_name].create_index(f"{self.metadata_field_names['metadata']}.created_timestamp")
+
+    # here we record that documents have been written to, or moved in or out of, `collection_name`,
+    # so that app.search_index can update the search index shortly after, rather than waiting on
+    # the periodic index cycle. Writes to a soft-deletion collection, like `_form_name`, become 
+    # `delete` events for the form, and all other writes become `index` events. We then schedule 
+    # a flush, unless one is already scheduled within the `search_index_flush_window`.
+    def emit_search_index_events(self, collection_name, document_ids, client=None):
+
+        if not (config['use_elasticsearch_as_wrapper'] or config['use_sqlite_fts_search']) or not config['search_index_on_write'] or len(document_ids) < 1:
+            return
+
+        form_name, op = (collection_name[1:], 'delete') if collection_name.startswith('_') else (collection_name, 'index')
+
+        if form_name in (config['exclude_forms_from_search'] if config['exclude_forms_from_search'] else []):
+            return
+
+        def emit(client):
+            now = datetime.datetime.utcnow().timestamp()
+
+            client[self.meta_dbname]['search_index_events'].insert_many([ {'form': form_name, 'document_id': str(x), 'op': op, 
+                                                                            'emitted_at': now, 'claim': None} for x in document_ids ])
+
+            # we only schedule a flush if the last one has already run, so a burst of writes is 
+            # sent to elasticsearch in a single flush, rather than one flush per write
+            try:
+                scheduled = client[self.meta_dbname]['search_index_flush'].update_one({'_id': 'flush', 'scheduled_until': {'$lte': now}}, 
+                                {'$set': {'scheduled_until': now + config['search_index_flush_window']}}, upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                return
+
+            if self.search_index_listener and (scheduled.modified_count > 0 or scheduled.upserted_id):
+                self.search_index_listener(config['search_index_flush_window'])
+
+        # the documents have already been written by this point, so we log a failure here rather
+        # than raising it to the caller; the periodic elasticsearch cycle still picks up these
+        # documents, but the SQLite index needs a `flask libreforms reindex-search` to catch up
+        try:
+            if client:
+                return emit(client)
+
+            with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+                return emit(client)
+
+        except Exception as e:
+            from app import log
+            log.warning(f"LIBREFORMS - failed to emit search index events for {collection_name}, {e}")
+
+    # this claims up to `limit` unclaimed search index events, along with any claimed more than 
+    # `claim_timeout` seconds ago, eg. by a flush that crashed, and returns them in the order
+    # they were emitted
+    def claim_search_index_events(self, claim, limit=10000, claim_timeout=3600):
+
+        now = datetime.datetime.utcnow().timestamp()
+
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            events = client[self.meta_dbname]['search_index_events']
+            events.create_index([('claim', 1), ('emitted_at', 1)])
+
+            events.update_many({'claim': {'$ne': None}, 'claimed_at': {'$lte': now - claim_timeout}}, {'$set': {'claim': None}})
+
+            ids = [ x['_id'] for x in events.find({'claim': None}, {'_id': 1}).sort('emitted_at', 1).limit(limit) ]
+
+            if len(ids) < 1:
+                return []
+
+            events.update_many({'_id': {'$in': ids}, 'claim': None}, {'$set': {'claim': claim, 'claimed_at': now}})
+
+            return list(events.find({'claim': claim}).sort('emitted_at', 1))
+
+    def release_search_index_events(self, claim):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            client[self.meta_dbname]['search_index_events'].update_many({'claim': claim}, {'$set': {'claim': None}})
+
+    def delete_search_index_events(self, claim):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            client[self.meta_dbname]['search_index_events'].delete_many({'claim': claim})
+
     def collections(self):
         with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
             db = client['libreforms']
@@ -366,15 +761,18 @@ class MongoDB:
                 #                                         }
 
                 # print(data)
-                return str(collection.insert_one(data).inserted_id)
+                document_id = str(collection.insert_one(data).inserted_id)
+                self.bump_write_version(collection_name, client=client)
+                self.update_submission_rollups(collection_name, added=[data], client=client)
+                self.emit_search_index_events(collection_name, [document_id], client=client)
+                return document_id
 
             else:
 
-                # some very overkill slicing to get the original 'Journal' value...
-                TEMP = self.read_documents_from_collection(collection_name)
-                
-                df = pd.DataFrame(list(TEMP))
-                data[self.metadata_field_names['journal']] = dict(df.loc[ (df['_id'] == data['_id'])][self.metadata_field_names['journal']].iloc[0])
+                # here we read the original document to get its 'Journal' value, which we also
+                # need to update the submission rollups
+                original = collection.find_one({'_id': ObjectId(data['_id'])})
+                data[self.metadata_field_names['journal']] = dict(original[self.metadata_field_names['journal']])
                 # print("\n\n\n", data[self.metadata_field_names['journal']])
                 # print("\n\n\n", type(data[self.metadata_field_names['journal']]))
 
@@ -414,10 +812,49 @@ class MongoDB:
 
 
                 collection.update_one({'_id': ObjectId(data['_id'])}, { "$set": data}, upsert=False)
+                self.bump_write_version(collection_name, client=client)
+                self.update_submission_rollups(collection_name, removed=[original], added=[{**original, **data}], client=client)
+                self.emit_search_index_events(collection_name, [data['_id']], client=client)
 
                 # print(data)
                 return str(data['_id'])
 
+    # this is a bulk version of write_document_to_collection() for new submissions, used when
+    # importing form uploads. It sets the same metadata as a new, unsigned submission, but
+    # writes all the documents using a single insert_many call. We return a list of the new
+    # document IDs.
+    def write_documents_to_collection(self, documents, collection_name, reporter=None, ip_address=None):
+
+        if len(documents) < 1:
+            return []
+
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            db = client['libreforms']
+
+            collection = db[collection_name]
+
+            timestamp_human_readable = str(datetime.datetime.utcnow())
+
+            for data in documents:
+
+                data[self.metadata_field_names['reporter']] = str(reporter) if reporter else None
+                data[self.metadata_field_names['owner']] = data[self.metadata_field_names['reporter']]
+
+                if ip_address:
+                    data[self.metadata_field_names['ip_address']] = ip_address
+
+                data[self.metadata_field_names['timestamp']] = timestamp_human_readable
+                data[self.metadata_field_names['journal']] = { timestamp_human_readable: data.copy() }
+                data[self.metadata_field_names['metadata']] = {'created_timestamp': timestamp_human_readable}
+
+            # we set ordered=False so a single bad document does not stop the rest of the batch
+            result = collection.insert_many(documents, ordered=False)
+            self.bump_write_version(collection_name, client=client)
+            self.update_submission_rollups(collection_name, added=documents, client=client)
+            self.emit_search_index_events(collection_name, result.inserted_ids, client=client)
+
+            return [str(x) for x in result.inserted_ids]
+
 
     def read_documents_from_collection(self, collection_name):
         with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
@@ -426,6 +863,121 @@ class MongoDB:
             collection = db[collection_name]
             return list(collection.find())
 
+    # this reads a single page of documents from a collection, pushing filtering, projection,
+    # sorting and paging down to the database. We return the page as a list, along with the
+    # total number of documents in the collection and the number that match `query`.
+    def query_collection_page(self, collection_name, query={}, projection=None, sort=None, skip=0, limit=0):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            db = client['libreforms']
+
+            collection = db[collection_name]
+
+            cursor = collection.find(query, projection)
+
+            if sort:
+                cursor = cursor.sort(sort)
+
+            documents = list(cursor.skip(skip).limit(limit))
+
+            # we use the (metadata-based) estimated count for the collection total, and
+            # only run a full count when there is a filter to apply
+            total = collection.estimated_document_count()
+            filtered = collection.count_documents(query) if len(query) > 0 else total
+
+            return documents, total, filtered
+
+    # this yields documents from a collection one at a time, keeping the client open while
+    # the cursor is consumed, so callers like streaming exports only hold a single batch of
+    # `batch_size` documents in memory at any time.
+    # nb. set `allow_disk_use` when sorting a large collection on an unindexed field, otherwise
+    # MongoDB raises an error once the sort exceeds its in-memory limit
+    def iter_documents_from_collection(self, collection_name, query={}, projection=None, sort=None, batch_size=500, allow_disk_use=False):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            db = client['libreforms']
+
+            collection = db[collection_name]
+
+            cursor = collection.find(query, projection, batch_size=batch_size, allow_disk_use=allow_disk_use)
+
+            if sort:
+                cursor = cursor.sort(sort)
+
+            for document in cursor:
+                yield document
+
+    # here we cast each column of a dataframe to the dtype passed in `dtypes`, rather than leaving
+    # every column as `object`; values that cannot be cast are set to missing.
+    def cast_dataframe_dtypes(self, df, dtypes={}):
+
+        for field, dtype in dtypes.items():
+
+            if field not in df.columns:
+                continue
+
+            if dtype == 'Int64':
+                numeric = pd.to_numeric(df[field], errors='coerce')
+                df[field] = numeric.where(numeric % 1 == 0).astype('Int64')
+
+            elif dtype == 'Float64':
+                df[field] = pd.to_numeric(df[field], errors='coerce').astype('Float64')
+
+            elif dtype == 'datetime64[ns]':
+                df[field] = pd.to_datetime(df[field], errors='coerce')
+
+            # list values (eg. from checkboxes) are unhashable, so we leave these as objects
+            elif dtype == 'category' and not df[field].map(lambda x: isinstance(x, list)).any():
+                df[field] = df[field].astype('category')
+
+        return df
+
+    # this returns a collection as a typed pandas dataframe, see cast_dataframe_dtypes(). Fields 
+    # in `exclude_fields` are projected out in the query, so they are never read into memory. If
+    # the collection is empty, we return an empty dataframe with `columns`.
+    def read_documents_as_dataframe(self, collection_name, dtypes={}, exclude_fields=[], columns=[]):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            db = client['libreforms']
+
+            collection = db[collection_name]
+
+            projection = { x: 0 for x in exclude_fields } if len(exclude_fields) > 0 else None
+            df = pd.DataFrame(list(collection.find({}, projection)))
+
+        if len(df.index) < 1:
+            return pd.DataFrame(columns=[x for x in columns if x not in exclude_fields])
+
+        return self.cast_dataframe_dtypes(df, dtypes)
+
+    # this yields the documents in a collection matching `filter` as a series of typed dataframes 
+    # of at most `chunk_size` rows, backed by a single cursor, so callers that need pandas semantics
+    # only hold one chunk in memory at a time, however large the collection. `projection` is passed
+    # to the query as-is; nb. we yield nothing if no documents match.
+    def iter_dataframes(self, collection_name, chunk_size=1000, projection=None, filter={}, dtypes={}):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            db = client['libreforms']
+
+            collection = db[collection_name]
+
+            chunk = []
+
+            for document in collection.find(filter, projection, batch_size=chunk_size):
+
+                chunk.append(document)
+
+                if len(chunk) >= chunk_size:
+                    yield self.cast_dataframe_dtypes(pd.DataFrame(chunk), dtypes)
+                    chunk = []
+
+            if len(chunk) > 0:
+                yield self.cast_dataframe_dtypes(pd.DataFrame(chunk), dtypes)
+
+    # this runs an aggregation pipeline against a collection and returns the results as a list
+    def aggregate_collection(self, collection_name, pipeline):
+        with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
+            db = client['libreforms']
+
+            collection = db[collection_name]
+            return list(collection.aggregate(pipeline))
+
     #  this new version returns a pandas dataframe instead of a list
     def new_read_documents_from_collection(self, collection_name):
         with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
@@ -619,7 +1171,11 @@ class MongoDB:
             except (errors.InvalidId, AssertionError):
                 return False
             collection = db[collection_name]
+            original = collection.find_one({'_id': document_id})
             update_result = collection.update_one({'_id': document_id}, {'$set': {field_name: new_value}})
+            self.bump_write_version(collection_name, client=client)
+            if original:
+                self.update_submission_rollups(collection_name, removed=[original], added=[{**original, field_name: new_value}], client=client)
             return True if update_result.modified_count > 0 else False
 
     def flash_value_across_collection(self, collection_name, field_name, new_value, backup=True):
@@ -634,6 +1190,8 @@ class MongoDB:
             try:
                 collection = db[collection_name]
                 update_result = collection.update_many({}, {'$set': {field_name: new_value}})
+                self.bump_write_version(collection_name, client=client)
+                self.rebuild_submission_rollups(collection_name, client=client)
                 return True if update_result.modified_count > 0 else False
             except Exception as e:
                 print(f"An error occurred: {e}")
@@ -652,6 +1210,8 @@ class MongoDB:
             try:
                 collection = db[collection_name]
                 update_result = collection.update_many({}, {'$unset': {field_name: ""}})
+                self.bump_write_version(collection_name, client=client)
+                self.rebuild_submission_rollups(collection_name, client=client)
                 return True if update_result.modified_count > 0 else False
             except Exception as e:
                 print(f"An error occurred: {e}")
@@ -695,6 +1255,8 @@ class MongoDB:
                         target_collection.drop()  # Caution: This deletes current data in the collection
                         for doc in backup_collection.find():
                             target_collection.insert_one(doc)
+                        self.bump_write_version(collection_name, client=client)
+                        self.rebuild_submission_rollups(collection_name, client=client)
 
                 return True
         except pymongo.errors.PyMongoError as e:
@@ -757,6 +1319,9 @@ class MongoDB:
             if delete_originals_on_transfer:
                 from_collection.delete_many({})
 
+            self.bump_write_version(from_collection_name, to_collection_name, client=client)
+            self.rebuild_submission_rollups(from_collection_name, to_collection_name, client=client)
+
 
     def migrate_collection(self,from_collection_name,to_collection_name,delete_originals_on_transfer=True):
         with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
@@ -774,8 +1339,14 @@ class MongoDB:
             if delete_originals_on_transfer:
                 from_collection.delete_many({})
 
+            self.bump_write_version(from_collection_name, to_collection_name, client=client)
+            self.rebuild_submission_rollups(from_collection_name, to_collection_name, client=client)
+
 
-    def migrate_single_document(self,from_collection_name,to_collection_name,document_id,delete_originals_on_transfer=True):
+    # the optional `metadata` dict is merged into the `Metadata` field of the copied document, 
+    # which soft_delete_document() and restore_soft_deleted_document() use to record when the
+    # document was moved, see app.search_index.
+    def migrate_single_document(self,from_collection_name,to_collection_name,document_id,delete_originals_on_transfer=True,metadata={}):
         with MongoClient(host=self.host, port=self.port) if not self.dbpw else MongoClient(self.connection_string) as client:
             db = client['libreforms']
 
@@ -790,11 +1361,20 @@ class MongoDB:
                 return None
             
             document_copy = document.copy()
+
+            if metadata:
+                document_copy[self.metadata_field_names['metadata']] = {**document_copy.get(self.metadata_field_names['metadata'], {}), **metadata}
+
             # Insert copied document into new collection
             to_collection.insert_one(document_copy)
 
             if delete_originals_on_transfer:
                 from_collection.delete_one({'_id': ObjectId(document_id)})
+                self.update_submission_rollups(from_collection_name, removed=[document], client=client)
+
+            self.bump_write_version(from_collection_name, to_collection_name, client=client)
+            self.update_submission_rollups(to_collection_name, added=[document_copy], client=client)
+            self.emit_search_index_events(to_collection_name, [document_id], client=client)
 
             return True
 
@@ -813,7 +1393,8 @@ class MongoDB:
             # to_collection_name = from_collection_name
             return None
         
-        return self.migrate_single_document(from_collection_name, to_collection_name,document_id)
+        return self.migrate_single_document(from_collection_name, to_collection_name,document_id,
+                                                metadata={'deleted_timestamp': str(datetime.datetime.utcnow())})
 
     # this method will restore a soft-deleted document.
     def restore_soft_deleted_document(self,to_collection_name,document_id):
@@ -825,7 +1406,8 @@ class MongoDB:
         else:
             return None
         
-        return self.migrate_single_document(from_collection_name, to_collection_name,document_id)
+        return self.migrate_single_document(from_collection_name, to_collection_name,document_id,
+                                                metadata={'restored_timestamp': str(datetime.datetime.utcnow())})
 
 
 
@@ -857,6 +1439,7 @@ class MongoDB:
 
 
             document = self.get_document_as_dict(collection_name, document_id)
+            original = dict(document)
 
             # first we add the data to the document journal field
             document[self.metadata_field_names['journal']][timestamp_human_readable] = data
@@ -865,6 +1448,9 @@ class MongoDB:
                 document[item] = data[item]
 
             collection.update_one({'_id': ObjectId(document_id)}, { "$set": document}, upsert=False)
+            self.bump_write_version(collection_name, client=client)
+            self.update_submission_rollups(collection_name, removed=[original], added=[document], client=client)
+            self.emit_search_index_events(collection_name, [document_id], client=client)
 
             # print(data)
             return document_id
@@ -0,0 +1,118 @@
+"""
+notifications.py: coalescing form notifications into digests
+
+Each form submission, update and approval decision sends an email to the user and to 
+the form's routing list, see app.views.forms.rationalize_routing_list. Under bursty load, 
+like a user submitting many forms in quick succession, this sends many separate emails 
+to the same people. When the `mail_digest_window` app config is set, this script instead
+queues each notification for each of its recipients, and a periodic celery task merges 
+the notifications each recipient has received into a single digest once the oldest has 
+waited `mail_digest_window` seconds.
+
+Approval requests are always sent immediately, as are all notifications for forms that
+set `_digest_notifications` to False in their form config. Account emails, like password
+resets, do not pass through this script at all.
+
+# send_notification(subject, content, to_address, cc_address_list=[], form_name=None, instant=False)
+
+This takes the same arguments as Mailer.send_mail, and either sends the notification right 
+away (asynchronously if `send_mail_asynchronously` is set) or adds it to the digest queue,
+which is stored in the `mail_digest_queue` collection of the `libreforms_meta` database.
+
+# flush_mail_digests(current_time=None)
+
+This sends a digest to each recipient whose oldest queued notification has waited at least
+`mail_digest_window` seconds, over a single pooled SMTP connection, see Mailer.send_many. 
+A recipient with a single notification receives it unchanged. If a digest cannot be sent, 
+its notifications are returned to the queue and retried on the next run.
+
+"""
+
+__name__ = "app.notifications"
+__author__ = "Sig Janoska-Bedi"
+__credits__ = ["Sig Janoska-Bedi"]
+__version__ = "2.2.0"
+__license__ = "AGPL-3.0"
+__maintainer__ = "Sig Janoska-Bedi"
+__email__ = "signe@atreeus.com"
+
+import time, uuid
+from datetime import datetime
+import libreforms
+from app.config import config
+from app.mongo import mongodb
+
+
+# here we determine whether notifications for `form_name` should be coalesced into digests
+def digests_enabled(form_name=None):
+
+    if not config['mail_digest_window']:
+        return False
+
+    if form_name in libreforms.forms and libreforms.forms[form_name].get('_digest_notifications', True) == False:
+        return False
+
+    return True
+
+
+def send_notification(subject=None, content=None, to_address=None, cc_address_list=[], form_name=None, instant=False):
+
+    from app import mailer, log
+
+    cc_address_list = cc_address_list if cc_address_list else []
+
+    if instant or not digests_enabled(form_name):
+        from celeryd.tasks import send_mail_async
+        return send_mail_async.delay(subject=subject, content=content, to_address=to_address, cc_address_list=cc_address_list) \
+                    if config['send_mail_asynchronously'] else \
+                        mailer.send_mail(subject=subject, content=content, to_address=to_address, cc_address_list=cc_address_list, logfile=log)
+
+    # we queue the notification once for each recipient, so each receives their own digest
+    recipients = [ x for x in dict.fromkeys([to_address] + list(cc_address_list)) if x ]
+
+    mongodb.queue_notifications([ {'recipient': x, 'subject': subject, 'content': content, 'form_name': form_name, 
+                                    'queued_at': time.time(), 'claim': None} for x in recipients ])
+
+    return True
+
+
+# here we merge a recipient's notifications, which we expect in the order they were queued, into one message
+def build_digest(recipient, notifications):
+
+    if len(notifications) == 1:
+        return {'subject': notifications[0]['subject'], 'content': notifications[0]['content'], 'to_address': recipient}
+
+    since = datetime.utcfromtimestamp(notifications[0]['queued_at']).strftime("%Y-%m-%d %H:%M:%S")
+
+    content = f"You have received {len(notifications)} notifications from {config['site_name']} since {since} UTC.\n\n"
+    content += "\n\n---\n\n".join(f"{x['subject']}\n{x['content']}" for x in notifications)
+
+    return {'subject': f"{config['site_name']} Digest: {len(notifications)} Notifications", 'content': content, 'to_address': recipient}
+
+
+def flush_mail_digests(current_time=None):
+
+    from app import mailer, log
+
+    if not config['mail_digest_window']:
+        return 0
+
+    current_time = current_time if current_time else time.time()
+    claim = uuid.uuid4().hex
+
+    due = mongodb.claim_due_notifications(current_time - config['mail_digest_window'], claim, current_time=current_time)
+
+    if len(due) < 1:
+        return 0
+
+    recipients = list(due.keys())
+    results = mailer.send_many([ build_digest(x, due[x]) for x in recipients ], logfile=log)
+
+    # we return the notifications we could not send to the queue, and drop the rest
+    failed = [ x for x, sent in zip(recipients, results) if sent is False ]
+    if len(failed) > 0:
+        mongodb.release_claimed_notifications(claim, failed)
+
+    mongodb.delete_claimed_notifications(claim)
+
+    return len(recipients) - len(failed)
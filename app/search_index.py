@@ -0,0 +1,267 @@
+"""
+search_index.py: incremental, bulk elasticsearch indexing
+
+When the `use_elasticsearch_as_wrapper` app config is set, celery periodically indexes
+form submissions into elasticsearch, see celeryd.index_new_documents. This used to read
+every document of every form on each cycle and index them one request at a time, which
+meant the cost of each cycle grew with the amount of data rather than with the amount
+that had changed. This script instead indexes only the documents that have changed since
+the last cycle, using the elasticsearch bulk helper.
+
+# High-water marks
+
+For each form, we store the latest `Timestamp` we have indexed and the latest soft deletion
+we have removed from the index, see MongoDB.get_search_index_marks. Each cycle indexes the
+documents written or restored since the first mark, and removes the documents soft deleted
+since the second. Because concurrent writes may commit out of timestamp order, we never move
+a mark past `elasticsearch_index_lag` seconds before the start of the cycle, so a document
+written just before the cycle is indexed again on the next one; indexing is idempotent, so
+this costs us a few repeated documents rather than a missed one.
+
+We only move the marks forward if elasticsearch accepted every action in the cycle, so any
+failure is retried on the next cycle.
+
+# index_changed_documents(es, form_names, elasticsearch_index="submissions")
+
+This is the periodic, incremental cycle described above. It returns the number of documents
+indexed and removed.
+
+# flush_search_index_events(es, elasticsearch_index="submissions")
+
+The periodic cycle means new submissions are not searchable for up to `elasticsearch_index_refresh_rate`
+seconds. When the `search_index_on_write` app config is set, each write also records an `index`
+or `delete` event for the document, see MongoDB.emit_search_index_events, and schedules a celery
+task to run this within `search_index_flush_window` seconds. We send the latest event for each 
+document in a single bulk request, reading the documents to index with one query per form. 
+Events that fail are returned to the queue, and the periodic cycle flushes any that are left 
+over, eg. if celery was not running; it also remains as a backstop for writes that do not emit
+events, like collection migrations. When `use_sqlite_fts_search` is set, we also apply the events 
+to the embedded full-text index, see app.fts.
+
+# reindex_documents(es, form_names, elasticsearch_index="submissions")
+
+This indexes every document of each form, and removes every soft deleted document from the
+index, before resetting the form's marks. It is exposed through the `flask libreforms 
+reindex-search` command, and is useful after changing `exclude_forms_from_search`, migrating collections or
+restoring the database from a backup, none of which the incremental cycle can detect.
+
+"""
+
+__name__ = "app.search_index"
+__author__ = "Sig Janoska-Bedi"
+__credits__ = ["Sig Janoska-Bedi"]
+__version__ = "2.2.0"
+__license__ = "AGPL-3.0"
+__maintainer__ = "Sig Janoska-Bedi"
+__email__ = "signe@atreeus.com"
+
+import datetime, uuid
+from bson.objectid import ObjectId
+from app.config import config
+from app.mongo import mongodb
+
+
+# here we build the elasticsearch body for a single document, leaving out its metadata fields
+def build_search_document(form_name, document):
+
+    id = str(document['_id'])
+    content = { x: document[x] for x in document if x not in mongodb.metadata_fields(exclude_id=True) }
+
+    # we write a little string to approximate the page content of the corresponding page
+    fullString = ', '.join([f'{x} - {str(content[x])}' for x in content]) + f', {id}'
+
+    body = {
+        'formName': form_name,
+        'title': id,
+        'url': f"/submissions/{form_name}/{id}",
+        # let's consider adding a different `_all` field, which we can call `fullString`, see
+        #   https://www.elastic.co/guide/en/elasticsearch/reference/6.0/mapping-all-field.html#custom-all-fields
+        #   https://stackoverflow.com/a/34147611/13301284
+        'fullString': fullString,
+        **content,
+    }
+
+    # we stringify each element, otherwise elasticsearch raises a mapper_parsing_exception
+    # for fields whose type differs between documents
+    return { key: str(value) for key, value in body.items() }
+
+
+# we read the timestamp and metadata fields so we can move the mark, but drop the rest of the 
+# metadata fields, like the journal, which can be much larger than the form data itself
+def get_index_projection():
+    return { x: 0 for x in mongodb.metadata_fields() if x not in [mongodb.metadata_field_names['timestamp'], mongodb.metadata_field_names['metadata']] }
+
+
+# this yields a bulk index action for each document matching `query`, and records the
+# latest timestamp it has seen in `seen`, so the caller can move the mark afterwards
+def iter_index_actions(form_name, query, seen, elasticsearch_index="submissions"):
+
+    for document in mongodb.iter_documents_from_collection(form_name, query=query, projection=get_index_projection(),
+                                                                batch_size=config['elasticsearch_index_batch_size']):
+
+        # a restored document keeps its original timestamp, so we also track when it was restored
+        restored = (document.get(mongodb.metadata_field_names['metadata']) or {}).get('restored_timestamp')
+        timestamp = max([x for x in [document.get(mongodb.metadata_field_names['timestamp']), restored] if x], default=None)
+        if timestamp and (not seen['indexed'] or timestamp > seen['indexed']):
+            seen['indexed'] = timestamp
+
+        seen['count'] += 1
+
+        yield {'_op_type': 'index', '_index': elasticsearch_index, '_id': str(document['_id']), '_source': build_search_document(form_name, document)}
+
+
+def iter_delete_actions(form_name, query, seen, elasticsearch_index="submissions"):
+
+    deleted_field = f"{mongodb.metadata_field_names['metadata']}.deleted_timestamp"
+
+    for document in mongodb.iter_documents_from_collection(f"_{form_name}", query=query, projection={deleted_field: 1},
+                                                                batch_size=config['elasticsearch_index_batch_size']):
+
+        timestamp = (document.get(mongodb.metadata_field_names['metadata']) or {}).get('deleted_timestamp')
+        if timestamp and (not seen['deleted'] or timestamp > seen['deleted']):
+            seen['deleted'] = timestamp
+
+        seen['count'] += 1
+
+        yield {'_op_type': 'delete', '_index': elasticsearch_index, '_id': str(document['_id'])}
+
+
+# here we send the actions to elasticsearch in batches of `elasticsearch_index_batch_size`, and
+# return the failed actions; deleting a document that was never indexed is not a failure
+def send_bulk_actions(es, actions):
+
+    from elasticsearch.helpers import bulk
+
+    success, errors = bulk(es, actions, chunk_size=config['elasticsearch_index_batch_size'],
+                            raise_on_error=False, raise_on_exception=False)
+
+    return [ x for x in errors if not ('delete' in x and x['delete'].get('status') == 404) ]
+
+
+# we never move a mark past this, see the docstring above
+def get_mark_ceiling(current_time=None):
+    current_time = current_time if current_time else datetime.datetime.utcnow()
+    return str(current_time - datetime.timedelta(seconds=config['elasticsearch_index_lag']))
+
+
+def index_changed_documents(es, form_names, elasticsearch_index="submissions", current_time=None):
+
+    from app import log
+
+    ceiling = get_mark_ceiling(current_time)
+    total = 0
+
+    for form_name in form_names:
+
+        mongodb.create_search_index_indexes(form_name)
+        marks = mongodb.get_search_index_marks(form_name)
+        seen = {'indexed': marks['indexed'], 'deleted': marks['deleted'], 'count': 0}
+
+        timestamp_field = mongodb.metadata_field_names['timestamp']
+        metadata_field = mongodb.metadata_field_names['metadata']
+
+        index_query = {'$or': [{timestamp_field: {'$gt': marks['indexed']}}, {f"{metadata_field}.restored_timestamp": {'$gt': marks['indexed']}}]} \
+                        if marks['indexed'] else {}
+        delete_query = {f"{metadata_field}.deleted_timestamp": {'$gt': marks['deleted']} if marks['deleted'] else {'$exists': True}}
+
+        # a document is only ever in one of the form's collections, so soft deleted documents
+        # are removed and current documents are indexed, whatever order they were moved in
+        errors = send_bulk_actions(es, iter_delete_actions(form_name, delete_query, seen, elasticsearch_index=elasticsearch_index))
+        errors += send_bulk_actions(es, iter_index_actions(form_name, index_query, seen, elasticsearch_index=elasticsearch_index))
+
+        if len(errors) > 0:
+            log.warning(f"LIBREFORMS - failed to index {len(errors)} documents for form {form_name}, will retry on the next cycle: {errors[:5]}")
+            continue
+
+        mongodb.set_search_index_marks(form_name, indexed=min(seen['indexed'], ceiling) if seen['indexed'] else None,
+                                                  deleted=min(seen['deleted'], ceiling) if seen['deleted'] else None)
+
+        total += seen['count']
+
+    return total
+
+
+# we send the events to elasticsearch if `es` is passed, and to the SQLite full-text index if
+# `use_sqlite_fts_search` is set, see app.fts
+def flush_search_index_events(es=None, elasticsearch_index="submissions"):
+
+    from app import log
+
+    claim = uuid.uuid4().hex
+    events = mongodb.claim_search_index_events(claim)
+
+    if len(events) < 1:
+        return 0
+
+    # we only need the latest event for each document, since the events are in the order they
+    # were emitted; eg. a document written and then soft deleted only needs to be removed
+    latest = {}
+    for event in events:
+        latest[(event['form'], event['document_id'])] = event['op']
+
+    delete_ids = [ document_id for (form_name, document_id), op in latest.items() if op == 'delete' ]
+    documents = []
+
+    for form_name in dict.fromkeys(x[0] for x in latest):
+
+        document_ids = [ ObjectId(document_id) for (form, document_id), op in latest.items() if form == form_name and op == 'index' ]
+
+        if len(document_ids) < 1:
+            continue
+
+        # documents that have since been soft deleted are not found here, and are removed by their delete event
+        for document in mongodb.iter_documents_from_collection(form_name, query={'_id': {'$in': document_ids}}, projection=get_index_projection(),
+                                                                    batch_size=config['elasticsearch_index_batch_size']):
+            documents.append((form_name, str(document['_id']), build_search_document(form_name, document)))
+
+    # both backends replace documents, so we can safely apply the same events again after a failure
+    try:
+        if config['use_sqlite_fts_search']:
+            from app.fts import update_fts_index, ensure_fts_index
+
+            # the first time we run, we index the documents written before the index was enabled
+            built = ensure_fts_index()
+            if built is not None:
+                log.info(f"LIBREFORMS - built the full-text search index with {built} documents.")
+
+            update_fts_index(documents=[ (form_name, document_id, body['fullString']) for form_name, document_id, body in documents ], delete_ids=delete_ids)
+
+        errors = send_bulk_actions(es, [ {'_op_type': 'delete', '_index': elasticsearch_index, '_id': x} for x in delete_ids ] + 
+                                        [ {'_op_type': 'index', '_index': elasticsearch_index, '_id': document_id, '_source': body} for form_name, document_id, body in documents ]) \
+                    if es else []
+
+    except Exception as e:
+        errors = [str(e)]
+
+    if len(errors) > 0:
+        mongodb.release_search_index_events(claim)
+        log.warning(f"LIBREFORMS - failed to index {len(errors)} documents, will retry on the next flush: {errors[:5]}")
+        return 0
+
+    mongodb.delete_search_index_events(claim)
+
+    return len(documents) + len(delete_ids)
+
+
+def reindex_documents(es, form_names, elasticsearch_index="submissions", current_time=None):
+
+    ceiling = get_mark_ceiling(current_time)
+    total = 0
+
+    for form_name in form_names:
+
+        mongodb.create_search_index_indexes(form_name)
+        seen = {'indexed': None, 'deleted': None, 'count': 0}
+
+        errors = send_bulk_actions(es, iter_delete_actions(form_name, {}, seen, elasticsearch_index=elasticsearch_index))
+        errors += send_bulk_actions(es, iter_index_actions(form_name, {}, seen, elasticsearch_index=elasticsearch_index))
+
+        if len(errors) > 0:
+            raise Exception(f"failed to index {len(errors)} documents for form {form_name}: {errors[:5]}")
+
+        mongodb.set_search_index_marks(form_name, indexed=min(seen['indexed'], ceiling) if seen['indexed'] else None,
+                                                  deleted=min(seen['deleted'], ceiling) if seen['deleted'] else None)
+
+        total += seen['count']
+
+    return total
@@ -25,7 +25,26 @@ method in app.views.forms.
 # send_mail() method
 
 This is the primary method of the Mailer class; it's used to send outgoing mail
-using smtplib. It creates a connection with the mail server each time mail is sent.
+using smtplib. It sends each message over a pooled connection, see below.
+
+# send_many() method
+
+This sends a batch of messages, eg. the emails generated during a report cycle, over a
+single pooled connection, and returns whether each message was sent.
+
+# Connection pooling
+
+Opening a connection, running STARTTLS and logging in for every message makes sending
+mail slow, and can trip providers' rate limits when we send many messages at once. So,
+each Mailer keeps a pool of at most `pool_size` open connections per process (see the 
+`smtp_pool_size` app config), which are reused across messages. Connections that have
+been idle for longer than `keepalive_interval` seconds are checked with a NOOP before
+they are reused; dropped connections are replaced, and a message that fails because its
+connection dropped is retried once on a new connection. The pool is reset after a fork,
+so worker processes never share connections. 
+
+To test the mailer against a local SMTP stand-in, like aiosmtpd, pass `starttls=False`
+and no `username`, so the mailer neither upgrades the connection nor logs in.
 
 It is implemented synchronously; however, there is a celery wrapper that is disabled 
 by default to send mail asynchronously, see config.send_mail_asynchronously for the 
@@ -45,6 +64,7 @@ __email__ = "signe@atreeus.com"
 
 import ssl
 import smtplib 
+import os, time, queue, threading
 import datetime as dt
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -53,7 +73,9 @@ from flask import current_app
 class Mailer():
     def __init__(self, mail_server=None, port=None, 
                         username=None, password=None, 
-                        from_address=None, enabled=True):
+                        from_address=None, enabled=True,
+                        pool_size=2, keepalive_interval=30, 
+                        timeout=30, starttls=True):
 
         if enabled:
             # setting up ssl context
@@ -64,43 +86,196 @@ class Mailer():
             self.password = password
             self.from_address = from_address
             self.enabled = True
+
+            # connection pool settings, see the discussion of pooling above
+            self.pool_size = max(int(pool_size), 1)
+            self.keepalive_interval = keepalive_interval
+            self.timeout = timeout
+            self.starttls = starttls
+            self._reset_pool()
         else: 
             self.enabled = False
 
+    # we set up an empty pool; we also call this when we find ourselves in a forked process,
+    # as connections opened by the parent process must not be shared with the child
+    def _reset_pool(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.mail_server, self.port, timeout=self.timeout)
+
+        # securing using tls
+        if self.starttls:
+            server.starttls(context=self.context)
+
+        # authenticating with the server to prove our identity
+        if self.username:
+            server.login(self.username, self.password)
+
+        return server
+
+    def _close(self, server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    # here we check out a connection from the pool, waiting for one to free up if `pool_size`
+    # connections are already in use. We reuse the most recently used idle connection, sending 
+    # a NOOP first if it has been idle for longer than `keepalive_interval` seconds, and open
+    # a new connection if there are none idle or the NOOP fails.
+    def _acquire(self):
+
+        if os.getpid() != self._pid:
+            self._reset_pool()
+
+        self._slots.acquire()
+
+        try:
+            while True:
+                try:
+                    server, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+
+                if time.monotonic() - last_used < self.keepalive_interval:
+                    return server
+
+                try:
+                    if server.noop()[0] == 250:
+                        return server
+                except Exception:
+                    pass
+
+                self._close(server)
+
+        except Exception:
+            self._slots.release()
+            raise
+
+    # here we return a connection to the pool, or close it if it is no longer usable
+    def _release(self, server, healthy=True):
+
+        if os.getpid() != self._pid:
+            return
+
+        if server is not None:
+            if healthy:
+                self._idle.put((server, time.monotonic()))
+            else:
+                self._close(server)
+
+        self._slots.release()
+
+    def _build_message(self, subject, content, to_address, cc_address_list=[]):
+
+        msg = MIMEMultipart()
+        msg['Subject'] = subject
+        msg['From'] = self.from_address
+        msg['To'] = to_address
+        # print(cc_address_list)
+        msg['Cc'] = ", ".join(cc_address_list) if cc_address_list and len(cc_address_list)>0 else None
+
+        msg.attach(MIMEText(content))
+
+        return msg
+
+    # this sends a single message over `server`; if the connection has been dropped, we 
+    # reconnect and try once more. We return the (possibly new) connection.
+    def _send(self, server, msg, recipients):
+
+        try:
+            server.sendmail(self.from_address, recipients, msg.as_string())
+            return server
+
+        except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError):
+            self._close(server)
+            server = self._connect()
+            server.sendmail(self.from_address, recipients, msg.as_string())
+            return server
+
     # borrowed shamelessly from 
     # https://www.aabidsofi.com/posts/sending-emails-with-aws-ses-and-python/
     def send_mail(self, subject=None, content=None, to_address=None, cc_address_list=[], logfile=None):
 
         # only if we have enabled SMTP
         if self.enabled:
-            try:
-                # creating an unsecure smtp connection
-                with smtplib.SMTP(self.mail_server,self.port) as server:
+            return self.send_many([{'subject': subject, 'content': content, 'to_address': to_address, 
+                                        'cc_address_list': cc_address_list}], logfile=logfile)[0]
+
+    # this sends a batch of messages, each a dict with the same keys as the send_mail() kwargs,
+    # over a single pooled connection, and returns a list with True for each message that was 
+    # sent and False for each that was not. A message that fails does not stop the others.
+    def send_many(self, messages, logfile=None):
+
+        if not self.enabled:
+            return [None for x in messages]
 
-                    msg = MIMEMultipart()
-                    msg['Subject'] = subject
-                    msg['From'] = self.from_address
-                    msg['To'] = to_address
-                    # print(cc_address_list)
-                    msg['Cc'] = ", ".join(cc_address_list) if cc_address_list and len(cc_address_list)>0 else None
+        results = []
+        server = None
 
-                    msg.attach(MIMEText(content))
+        try:
+            server = self._acquire()
 
-                    # securing using tls
-                    server.starttls(context=self.context)
+        except Exception as e: 
+            if logfile: logfile.error(f'could not connect to the SMTP server - {e}')
+            return [False for x in messages]
 
-                    # authenticating with the server to prove our identity
-                    server.login(self.username, self.password)
+        healthy = True
+
+        try:
+            for message in messages:
+
+                to_address = message.get('to_address')
+                cc_address_list = message.get('cc_address_list') or []
+
+                try:
+                    msg = self._build_message(message.get('subject'), message.get('content'), to_address, cc_address_list)
 
                     # sending a plain text email
-                    server.sendmail(self.from_address, [to_address]+cc_address_list, msg.as_string())
-                    # server.send_message(msg.as_string())
+                    server = self._send(server, msg, [to_address]+cc_address_list)
 
                     if logfile: logfile.info(f'successfully sent an email to {to_address}')
-                    
-                    return True
+                    results.append(True)
+
+                except smtplib.SMTPRecipientsRefused as e:
+                    # the connection is still usable when the server rejects a recipient
+                    if logfile: logfile.error(f'could not send an email to {to_address} - {e}')
+                    results.append(False)
+
+                except Exception as e: 
+                    if logfile: logfile.error(f'could not send an email to {to_address} - {e}')
+                    results.append(False)
+
+                    # we do not know what state the connection is in, so we replace it
+                    self._close(server)
+                    try:
+                        server = self._connect()
+                    except Exception as e:
+                        if logfile: logfile.error(f'could not reconnect to the SMTP server - {e}')
+                        server, healthy = None, False
+                        results += [False for x in messages[len(results):]]
+                        break
 
-            except Exception as e: 
-                if logfile: logfile.error(f'could not send an email to {to_address} - {e}')
-                
-                return False
+        finally:
+            self._release(server, healthy=healthy and server is not None)
+
+        return results
+
+    # this closes the idle connections in the pool, eg. when a worker shuts down
+    def close(self):
+
+        if not self.enabled or os.getpid() != self._pid:
+            return
+
+        while True:
+            try:
+                server, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(server)
@@ -81,6 +81,7 @@ from werkzeug.security import generate_password_hash
 from werkzeug.utils import secure_filename
 from celeryd.tasks import send_mail_async, restart_app_async
 from app.scripts import prettify_time_diff, convert_to_string, mask_string
+from app.form_registry import publish_form_registry_version
 
 # borrows from and extends the functionality of flask_login.login_required, see
 # https://github.com/maxcountryman/flask-login/blob/main/src/flask_login/utils.py.
@@ -122,6 +123,7 @@ def compile_admin_views_for_menu():
                                                                                                         'admin.bulk_password_change',
                                                                                                         'admin.toggle_users_active_status',
                                                                                                         'admin.refresh_users_login_date',
+                                                                                                        'admin.reload_form_definitions',
                                                                                                         # 'admin.',
                                                                                                         ]]:
 
@@ -282,16 +284,53 @@ bp = Blueprint('admin', __name__, url_prefix='/admin')
 #     return redirect(url_for(f'admin.{view_name}'))
 
 
+# this compiles a per-form summary of submissions for the admin overview from the daily
+# submission rollups, see app.mongo, rather than reading each collection: the number of 
+# active and soft-deleted submissions, the number created in the last `admin_overview_recent_days`
+# days, and the number awaiting approval.
+def compile_form_overview():
+
+    form_names = list(libreforms.forms.keys())
+    collection_names = form_names + [f"_{x}" for x in form_names]
+
+    totals = mongodb.query_submission_rollups(form_names=collection_names, group_by=['form', 'approval'])
+    recent = mongodb.query_submission_rollups(form_names=form_names, group_by=['form'],
+                    start=datetime.datetime.utcnow().date() - datetime.timedelta(days=config['admin_overview_recent_days']))
+
+    overview = []
+    for form_name in form_names:
+        overview.append({
+            'form': form_name,
+            'active': int(totals.loc[totals['form'] == form_name, 'count'].sum()),
+            'deleted': int(totals.loc[totals['form'] == f"_{form_name}", 'count'].sum()),
+            'recent': int(recent.loc[recent['form'] == form_name, 'count'].sum()),
+            'pending': int(totals.loc[(totals['form'] == form_name) & (totals['approval'] == 'pending'), 'count'].sum()),
+        })
+
+    return overview
+
+
 @bp.route('/')
 @is_admin
 def admin_home():
 
+    try:
+        overview = compile_form_overview()
+
+    except Exception as e:
+        overview = []
+        transaction_id = str(uuid.uuid1())
+        log.warning(f"{current_user.username.upper()} - failed to load submission rollups: {e}", extra={'transaction_id': transaction_id})
+        flash (f"There was an error in processing your request. Transaction ID: {transaction_id}. ", 'warning')
+
     return render_template('admin/admin_home.html.jinja',
         name='Admin',
         subtitle='Home',
         type="admin",
         msg="Select an admin view from the left-hand menu.",
         menu=compile_admin_views_for_menu(),
+        overview=overview,
+        recent_days=config['admin_overview_recent_days'],
         **standard_view_kwargs(),
         )
 
@@ -413,6 +452,26 @@ def form_management():
 
 
 
+# this route reloads the form definitions in libreforms/form_config.py without restarting 
+# the application; other workers will pick up the new version on their next request, 
+# see app.form_registry.
+@bp.route('/forms/reload', methods=['POST'])
+@is_admin
+def reload_form_definitions():
+
+    try:
+        version = publish_form_registry_version()
+        flash(f'Successfully reloaded form definitions. ', "success")
+        log.info(f'{current_user.username.upper()} - reloaded form definitions, version {version}.')
+
+    except Exception as e:
+        transaction_id = str(uuid.uuid1())
+        log.warning(f"{current_user.username.upper()} - failed to reload form definitions: {e}", extra={'transaction_id': transaction_id})
+        flash (f"There was an error in processing your request. Transaction ID: {transaction_id}. ", 'warning')
+
+    return redirect(url_for('admin.form_management'))
+
+
 # define a route for documentation management
 @bp.route('/docs', methods=('GET', 'POST'))
 @is_admin
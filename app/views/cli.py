@@ -373,3 +373,165 @@ def generate_accessibility_audio(directory):
     generate_all_app_audio_files(directory)
     click.echo (f"Success: generated accessibility audio in {directory}.")
     sys.exit(0)
+
+
+########################################################################
+## `reload-forms` reload form definitions without restarting the app
+########################################################################
+
+# this command validates libreforms/form_config.py and publishes a new version of the form
+# definitions, which running application workers will load on their next request, see the
+# discussion in app.form_registry.
+@bp.cli.command('reload-forms')
+@click.option('--version', is_flag=True, callback=print_version,
+              expose_value=False, is_eager=True)
+@with_appcontext
+def reload_forms():
+    """Reload form definitions for libreForms web app."""
+
+    from app.form_registry import publish_form_registry_version
+
+    try:
+        version = publish_form_registry_version()
+
+    except Exception as e:
+        click.echo(f"Error: failed to reload form definitions: {e}")
+        sys.exit(2)
+
+    click.echo(f"Success: published form definitions version {version}.")
+    log.info(f"LIBREFORMS - successfully reloaded form definitions via CLI, version {version}.")
+    sys.exit(0)
+
+
+########################################################################
+## `export-parquet` write form collections to parquet for analytics
+########################################################################
+
+# this command writes a Parquet snapshot of each form collection (or of the forms passed 
+# using --form), see the discussion in app.exports. Pass --async to queue the export as a 
+# celery task rather than running it in the foreground.
+@bp.cli.command('export-parquet')
+@click.option('--version', is_flag=True, callback=print_version,
+              expose_value=False, is_eager=True)
+@click.option('--form', 'form_names', multiple=True, help='form to export, can be passed multiple times; defaults to all forms')
+@click.option('--partition-by-month/--no-partition-by-month', show_default=True, default=True, help='partition exports by the month each submission was created')
+@click.option('--async', 'run_async', is_flag=True, show_default=True, default=False, help='queue the export as a celery task')
+@with_appcontext
+def export_parquet(form_names, partition_by_month, run_async):
+    """Export form data to parquet for libreForms web app."""
+
+    import libreforms
+
+    for form_name in form_names:
+        if form_name not in libreforms.forms.keys():
+            click.echo(f"{form_name} is not a valid form.")
+            sys.exit(2)
+
+    if run_async:
+        from celeryd.tasks import export_forms_to_parquet_async
+        task = export_forms_to_parquet_async.delay(form_names=list(form_names), partition_by_month=partition_by_month)
+        click.echo(f"Success: queued parquet export, task ID {task.id}.")
+        sys.exit(0)
+
+    from app.exports import export_forms_to_parquet
+
+    try:
+        summaries = export_forms_to_parquet(form_names=list(form_names), partition_by_month=partition_by_month)
+
+    except ImportError:
+        click.echo("Error: parquet exports require pyarrow, see requirements/parquet.txt.")
+        sys.exit(2)
+
+    for summary in summaries:
+        click.echo(f"Exported {summary['rows']} rows of {summary['form_name']} to {summary['path']}.")
+
+    click.echo("Success: exported form data to parquet.")
+    sys.exit(0)
+
+
+########################################################################
+## `rebuild-rollups` recount the daily submission rollups
+########################################################################
+
+# this command recounts the daily submission rollups for each collection (or for the forms
+# passed using --form, along with their soft-deleted documents) from the documents themselves;
+# the rollups are otherwise maintained on each write, see app.mongo.
+@bp.cli.command('rebuild-rollups')
+@click.option('--version', is_flag=True, callback=print_version,
+              expose_value=False, is_eager=True)
+@click.option('--form', 'form_names', multiple=True, help='form to rebuild, can be passed multiple times; defaults to all collections')
+@with_appcontext
+def rebuild_rollups(form_names):
+    """Rebuild submission rollups for libreForms web app."""
+
+    import libreforms
+    from app import mongodb
+
+    for form_name in form_names:
+        if form_name not in libreforms.forms.keys():
+            click.echo(f"{form_name} is not a valid form.")
+            sys.exit(2)
+
+    try:
+        mongodb.rebuild_submission_rollups(*[ x for form_name in form_names for x in [form_name, f"_{form_name}"] ])
+
+    except Exception as e:
+        click.echo(f"Error: failed to rebuild submission rollups: {e}")
+        sys.exit(2)
+
+    click.echo("Success: rebuilt submission rollups.")
+    log.info(f"LIBREFORMS - successfully rebuilt submission rollups via CLI.")
+    sys.exit(0)
+
+
+########################################################################
+## `reindex-search` rebuild the elasticsearch index
+########################################################################
+
+# this command sends every document of each searchable form (or of the forms passed using 
+# --form) to the elasticsearch index, and removes their soft-deleted documents from it; the
+# index is otherwise updated incrementally by celery, see app.search_index. If the embedded
+# full-text index is enabled, we rebuild it in the same way, see app.fts.
+@bp.cli.command('reindex-search')
+@click.option('--version', is_flag=True, callback=print_version,
+              expose_value=False, is_eager=True)
+@click.option('--form', 'form_names', multiple=True, help='form to reindex, can be passed multiple times; defaults to all searchable forms')
+@with_appcontext
+def reindex_search(form_names):
+    """Rebuild the search index for libreForms web app."""
+
+    import libreforms
+    from flask import current_app
+    from app.search_index import reindex_documents
+    from app.fts import rebuild_fts_index
+
+    if not config['use_elasticsearch_as_wrapper'] and not config['use_sqlite_fts_search']:
+        click.echo("Error: no search index is enabled, see the `use_elasticsearch_as_wrapper` and `use_sqlite_fts_search` app configs.")
+        sys.exit(2)
+
+    for form_name in form_names:
+        if form_name not in libreforms.forms.keys():
+            click.echo(f"{form_name} is not a valid form.")
+            sys.exit(2)
+
+    exclude_forms = config['exclude_forms_from_search'] if config['exclude_forms_from_search'] else []
+    prune = len(form_names) < 1
+    form_names = form_names if len(form_names) > 0 else [ x for x in libreforms.forms if x not in exclude_forms ]
+
+    try:
+        count = 0
+
+        if config['use_elasticsearch_as_wrapper']:
+            count += reindex_documents(current_app.elasticsearch, form_names)
+
+        # when rebuilding every form, we also drop forms that are no longer searchable
+        if config['use_sqlite_fts_search']:
+            count += rebuild_fts_index(form_names, prune=prune)
+
+    except Exception as e:
+        click.echo(f"Error: failed to rebuild the search index: {e}")
+        sys.exit(2)
+
+    click.echo(f"Success: reindexed {count} documents.")
+    log.info(f"LIBREFORMS - successfully rebuilt the search index via CLI.")
+    sys.exit(0)
@@ -14,7 +14,7 @@ __maintainer__ = "Sig Janoska-Bedi"
 __email__ = "signe@atreeus.com"
 
 # import flask-related packages
-from flask import current_app, Blueprint, render_template, request, redirect, flash, url_for
+from flask import current_app, Blueprint, render_template, request, redirect, flash, url_for, Response
 from flask_login import current_user
 
 # import custom packages from the current repository
@@ -24,10 +24,13 @@ from app.views.forms import propagate_form_configs, checkGroup, checkDashboardGr
 from app import config, log, mongodb
 from app.models import db
 from app.decorators import required_login_and_password_reset
+from app.form_registry import load_form_dataframe, compile_form_schema
+from app.aggregations import aggregate_bar_data, aggregate_histogram_data, load_point_data, \
+    downsample_line_data, downsample_scatter_data, get_cached_figure, cache_figure, aggregate_rollup_data
 
 
 # and finally, import other packages
-import os, json, uuid, types
+import os, json, uuid, types, hashlib
 import plotly
 import plotly.express as px
 import pandas as pd
@@ -50,7 +53,149 @@ def dashboards_home():
         ) 
 
 
-# this creates the route to each of the dashboards
+# these are the fields a dashboard may plot: the form's fields and the owner, reporter and timestamp metadata
+def get_dashboard_fields(form_name):
+    return list(compile_form_schema(form_name).keys()) + [ mongodb.metadata_field_names[x] for x in ['owner', 'reporter', 'timestamp'] ]
+
+
+# here we list-ify the dashboards configured for a form, if it is just a single dict, per 
+# https://github.com/libreForms/libreForms-flask/issues/409
+def get_dashboard_configs(form_name):
+
+    all_dashboard_data = libreforms.forms[form_name]["_dashboard"]
+
+    if isinstance(all_dashboard_data, dict):
+        all_dashboard_data = [all_dashboard_data]
+
+    return all_dashboard_data
+
+
+# Quick logic to permit locking down dashboard access by group, see
+# https://github.com/libreForms/libreForms-flask/issues/473
+def verify_dashboard_access(dashboard_data):
+
+    if not checkGroup(group=current_user.group, struct=dashboard_data):
+        return False
+
+    if "_deny_groups" in dashboard_data and isinstance(dashboard_data['_deny_groups'], list) and current_user.group in dashboard_data["_deny_groups"]:
+        return False
+
+    return True
+
+
+# here we allow the user to specify the field they want to use, overriding the default 
+# y-axis field defined in libreforms/forms; we only accept fields that exist on the form, 
+# as the field is passed to the database. Bootstrap dashboards, and those drawn from the 
+# submission rollups, do not have a y-axis.
+def get_dashboard_y_context(form_name, dashboard_data):
+
+    if dashboard_data['type'] == "bootstrap" or dashboard_data.get('source') == "rollups":
+        return None
+
+    if request.args.get("y") and request.args.get("y") in get_dashboard_fields(form_name):
+        return request.args.get("y")
+
+    return dashboard_data['fields']['y']
+
+
+def get_dashboard_theme():
+    return 'plotly_dark' if (config['dark_mode'] and \
+                not current_user.theme == 'light') or current_user.theme == 'dark' else 'plotly_white'
+
+
+# this renders a single dashboard as plotly JSON, returning the figure and, for scatter and line
+# charts, which we downsample before rendering, the number of points plotted and the number 
+# available. Figures are cached until the next write to the form, see app.aggregations.
+def render_dashboard_figure(form_name, index, dashboard_data, cache_key):
+
+    cached = get_cached_figure(cache_key)
+
+    if cached:
+        return cached
+
+    ref = dashboard_data.get('fields', {})
+    viz_type = dashboard_data['type']
+    y_context = get_dashboard_y_context(form_name, dashboard_data)
+    theme = get_dashboard_theme()
+
+    graph, sample = None, None
+
+    # dashboards drawn from the daily submission rollups plot the number of submissions per
+    # day as a bar or line chart, see app.aggregations
+    if dashboard_data.get('source') == "rollups":
+        color = ref.get('color') if isinstance(ref, dict) else None
+        agg = aggregate_rollup_data(form_name, color=color)
+        plot = px.bar if viz_type == "bar" else px.line
+        fig = plot(agg, 
+                    x='day', 
+                    y='count', 
+                    color=agg.columns[1] if len(agg.columns) > 2 else None,
+                    template=theme)
+        graph = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+    elif viz_type == "scatter":
+        points, available = load_point_data(form_name, [ref['x'], y_context, ref.get('color')])
+        points = downsample_scatter_data(points, color=ref.get('color'), target_points=dashboard_data.get('max_points', None))
+        sample = (len(points.index), available)
+
+        fig = px.scatter(points, 
+                    x=ref['x'], 
+                    y=y_context, 
+                    color=ref.get('color'),
+                    template=theme)
+        graph = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+    # bar charts and histograms are aggregated in the database, so we plot the pre-computed
+    # value of each bin, see app.aggregations
+    elif viz_type == "bar":
+        agg = aggregate_bar_data(form_name, ref['x'], y=y_context, color=ref.get('color'))
+        fig = px.bar(agg, 
+                    x=ref['x'], 
+                    y=agg.columns[-1], 
+                    barmode='group',
+                    color=ref.get('color'),
+                    template='plotly_dark')
+        graph = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+    elif viz_type == "histogram":
+        agg = aggregate_histogram_data(form_name, ref['x'], y=y_context, color=ref.get('color'))
+        fig = px.bar(agg, 
+                    x=ref['x'], 
+                    y=agg.columns[-1], 
+                    color=ref.get('color'),
+                    template='plotly_dark')
+        graph = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+    elif viz_type == "bootstrap":
+        # we expect the `fields` sub-field (which is referenced as `ref` above) to store a callable that
+        # returns a plotly object as json, see https://github.com/libreForms/libreForms-flask/issues/410;
+        # these are passed the full (typed) dataframe
+        graph = ref(load_form_dataframe(form_name))
+
+    elif viz_type == "table":
+        pass
+
+    else: # default to line graph
+        points, available = load_point_data(form_name, [ref['x'], y_context, ref.get('color')], sort=ref['x'])
+        points = downsample_line_data(points, ref['x'], y_context, color=ref.get('color'), target_points=dashboard_data.get('max_points', None))
+        sample = (len(points.index), available)
+
+        fig = px.line(points, 
+                    x=ref['x'], 
+                    y=y_context, 
+                    color=ref.get('color'),
+                    template='plotly_dark')
+        graph = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+    if graph:
+        cache_figure(cache_key, (graph, sample))
+
+    return graph, sample
+
+
+# this creates the route to each of the dashboards; the page itself only lists the dashboards
+# the user has access to, and each figure is then fetched from the dashboards.dashboard_figure
+# view, so the page renders immediately and slow figures do not hold up fast ones.
 @bp.route(f'/<form_name>')
 @required_login_and_password_reset
 def dashboards(form_name):
@@ -73,102 +218,22 @@ def dashboards(form_name):
 
     try:
 
-        data = mongodb.read_documents_from_collection(form_name)
-        df = pd.DataFrame(list(data))
-
-        graphJSON = [] # here we create the list of figures we'll pass to the jinja template later
-        all_dashboard_data = ref = libreforms.forms[form_name]["_dashboard"]
-
-        # list-ify the dashboard passed, if it just a single dict, per 
-        # https://github.com/libreForms/libreForms-flask/issues/409
-        if isinstance(all_dashboard_data, dict):
-            all_dashboard_data = [all_dashboard_data]
-
-        for dashboard_data in all_dashboard_data:
-
-            if not checkGroup(group=current_user.group, struct=dashboard_data):
-                continue
-
-            # Quick logic to permit locking down dashboard access by group, see
-            # https://github.com/libreForms/libreForms-flask/issues/473
-            def verify_access(dashboard):
-                if "_deny_groups" in dashboard and isinstance(dashboard['_deny_groups'], list) and current_user.group in dashboard["_deny_groups"]:
-                    return False
-                return True
-
-            if not verify_access(dashboard_data):
-                continue
-
-            ref = dashboard_data['fields']
-            viz_type = dashboard_data['type']
+        # we check there are submissions up front; each dashboard then queries only the data 
+        # it needs, see app.aggregations
+        documents, total, filtered = mongodb.query_collection_page(form_name, projection=['_id'], limit=1)
 
-            # here we allow the user to specify the field they want to use, 
-            # overriding the default y-axis field defined in libreforms/forms.
-            # warning, this may be buggy
-
-            # if request.args.get("y") and request.args.get("y") in form.keys(): # alternative if we want to verify the field exists
-            # y_context = request.args.get("y") if request.args.get("y") else ref['y']
-
-
-            if request.args.get("y") and viz_type != "bootstrap":
-                y_context = request.args.get("y")
-            # elif not isinstance(ref, types.FunctionType):
-            elif viz_type == "bootstrap":
-                pass
-            else:
-                y_context = ref['y']
-
-
-            if len(df.index) < 1:
-                flash('This form has not received any submissions.', "warning")
-                return redirect(url_for('dashboards.dashboards_home'))
-
-            theme = 'plotly_dark' if (config['dark_mode'] and \
-                not current_user.theme == 'light') or current_user.theme == 'dark' else 'plotly_white'
-
-            if viz_type == "scatter":
-                fig = px.scatter(df, 
-                            x=ref['x'], 
-                            y=y_context, 
-                            color=ref['color'],
-                            template=theme)
-                graphJSON.append(json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder))
-
-            elif viz_type == "bar":
-                fig = px.histogram(df, 
-                            x=ref['x'], 
-                            y=y_context, 
-                            barmode='group',
-                            color=ref['color'],
-                            template='plotly_dark')
-                graphJSON.append(json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder))
-
-            elif viz_type == "histogram":
-                fig = px.histogram(df, 
-                            x=ref['x'], 
-                            y=y_context, 
-                            color=ref['color'],
-                            template='plotly_dark')
-                graphJSON.append(json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder))
-            elif viz_type == "bootstrap":
-                # we expect the `fields` sub-field (which is referenced as `ref` above) to store a callable that
-                # returns a plotly object as json, see https://github.com/libreForms/libreForms-flask/issues/410
-                graphJSON.append(ref(df)) 
-
-            elif viz_type == "table":
-                passref
-
-            else: # default to line graph
-                fig = px.line(df, 
-                            x=ref['x'], 
-                            y=y_context, 
-                            color=ref['color'],
-                            template='plotly_dark')
-                graphJSON.append(json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder))
+        if len(documents) < 1:
+            flash('This form has not received any submissions.', "warning")
+            return redirect(url_for('dashboards.dashboards_home'))
 
+        # here we create the list of figure URLs we'll pass to the jinja template, which
+        # will fetch them concurrently once the page has loaded
+        figures = [ url_for('dashboards.dashboard_figure', form_name=form_name, index=index, **({'y': request.args.get('y')} if request.args.get('y') else {}))
+                        for index, dashboard_data in enumerate(get_dashboard_configs(form_name)) 
+                            if verify_dashboard_access(dashboard_data) and dashboard_data['type'] != "table" ]
 
         return render_template('app/dashboards.html.jinja', 
-            graphJSON=graphJSON,
+            figures=figures,
             name='Dashboards',
             subtitle=form_name,
             type="dashboards",
@@ -184,3 +249,49 @@ def dashboards(form_name):
         flash (f"There was an error in processing your request. Transaction ID: {transaction_id}. ", 'warning')
         
         return redirect(url_for('dashboards.dashboards_home'))
+
+
+# this returns a single dashboard figure as JSON, in the format {"figure": <plotly figure>, 
+# "sampling": [points plotted, points available] or null}. Figures are served with an ETag
+# derived from the form's write version, so browsers revalidate them, and we return a 304
+# without rendering anything if the form has not changed.
+@bp.route(f'/<form_name>/figure/<int:index>')
+@required_login_and_password_reset
+def dashboard_figure(form_name, index):
+
+    if form_name not in libreforms.forms.keys() or '_dashboard' not in libreforms.forms[form_name].keys() \
+            or propagate_form_configs(form=form_name)["_dashboard"] == False:
+        return Response(json.dumps({'status':'failure', 'msg': 'This form does not have any dashboards.'}), status=config['error_code'], mimetype='application/json')
+
+    all_dashboard_data = get_dashboard_configs(form_name)
+
+    if index >= len(all_dashboard_data) or not verify_dashboard_access(all_dashboard_data[index]):
+        return Response(json.dumps({'status':'failure', 'msg': 'You do not have access to this dashboard.'}), status=config['error_code'], mimetype='application/json')
+
+    dashboard_data = all_dashboard_data[index]
+
+    try:
+        cache_key = (libreforms.forms_version, form_name, index, get_dashboard_theme(), 
+                        get_dashboard_y_context(form_name, dashboard_data), mongodb.get_write_version(form_name))
+
+        etag = hashlib.sha1(repr(cache_key).encode()).hexdigest()
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+
+        else:
+            graph, sample = render_dashboard_figure(form_name, index, dashboard_data, cache_key)
+
+            # the figure is already encoded, so we splice it into the response body as-is
+            response = Response('{"figure": ' + (graph if graph else 'null') + ', "sampling": ' + json.dumps(sample) + '}', 
+                                    status=config['success_code'], mimetype='application/json')
+
+    except Exception as e: 
+        transaction_id = str(uuid.uuid1())
+        log.warning(f"{current_user.username.upper()} - {e}", extra={'transaction_id': transaction_id})
+        return Response(json.dumps({'status':'failure', 'msg': f"There was an error in processing your request. Transaction ID: {transaction_id}."}), status=config['error_code'], mimetype='application/json')
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response
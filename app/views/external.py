@@ -31,6 +31,7 @@ from app.views.forms import define_webarg_form_data_types, checkGroup, reconcile
 import app.signing as signing
 from app.models import Signing, db
 from celeryd.tasks import send_mail_async
+from app.notifications import send_notification
 
 
 
@@ -172,7 +173,7 @@ if config['allow_anonymous_form_submissions']:
                     content = f"This email serves to verify that an anonymous user {signature} (linked to {email}) has just submitted the {form_name} form. {'; '.join(key + ': ' + str(value) for key, value in parsed_args.items() if key != mongodb.metadata_field_names['journal']) if options['_send_form_with_email_notification'] else ''}"
                     
                     # and then we send our message
-                    m = send_mail_async.delay(subject=subject, content=content, to_address=email, cc_address_list=rationalize_routing_list(form_name)) if config['send_mail_asynchronously'] else mailer.send_mail(subject=subject, content=content, to_address=email, cc_address_list=rationalize_routing_list(form_name), logfile=log)
+                    m = send_notification(subject=subject, content=content, to_address=email, cc_address_list=rationalize_routing_list(form_name), form_name=form_name)
 
 
                     return redirect(url_for('home'))
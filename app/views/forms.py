@@ -26,10 +26,14 @@ from werkzeug.datastructures import ImmutableMultiDict
 
 # import custom packages from the current repository
 import libreforms
-from app import config, log, mailer, mongodb
+from app import config, log, mailer, mongodb, celery
 from app.models import User, db
 from app.certification import encrypt_with_symmetric_key
-from celeryd.tasks import send_mail_async
+from celeryd.tasks import import_form_upload_async
+from app.notifications import send_notification
+from app.form_imports import spool_form_upload, import_form_upload, get_form_import_directory
+from app.form_registry import compile_form_schema, lint_field_value, compile_form_metadata, \
+                        render_form_display_name
 from app.scripts import convert_to_string
 from app.decorators import required_login_and_password_reset
 
@@ -143,7 +147,15 @@ def checkGroup(group, struct):
     return False if checkKey(struct, '_deny_groups') and group \
         in struct['_deny_groups'] else True
 
+# the menus for the form, table and dashboard views are precompiled for each group in 
+# the form registry, see app.form_registry; we fall back to checking each form for any
+# other access check that gets passed.
 def form_menu(func):
+    menu = {checkFormGroup: 'forms', checkTableGroup: 'tables', checkDashboardGroup: 'dashboards'}.get(func, None)
+
+    if menu:
+        return list(compile_form_metadata(current_user.group)['menus'][menu])
+
     return [x for x in libreforms.forms.keys() if func(x, current_user.group)]
 
 def checkFieldGroup(form, field, group):
@@ -166,39 +178,12 @@ def checkDashboardGroup(form, group):
     return True if x and len(x) > 0 else False # temporarily need to just let everything through w/o ACLs
 
 # this function just compiles 'depends_on' data for each form
-# to build a useful data tree that can be parsed by the jinja / javascript
+# to build a useful data tree that can be parsed by the jinja / javascript;
+# the tree is precompiled in the form registry, see app.form_registry.
 def compile_depends_on_data(form=None, user_group=None):
 
     if form:
-
-        RETURN = {}
-
-        for field in libreforms.forms[form].keys():
-
-
-            # if checkKey(libreforms.forms[form][field], '_group_access') and \
-            #         (user_group in libreforms.forms[form][field]['_group_access']['deny']) \
-            #         or (user_group not in libreforms.forms[form][field]['_group_access']['allow'] \
-            #         and config['allow_all_groups_default'] == False):
-            #     pass
-
-            # else:
-
-                # ignore form configs that start with _ but only select if the _depends_on has been set
-                if not field.startswith("_") and "_depends_on" in libreforms.forms[form][field].keys():
-
-                    element = libreforms.forms[form][field]['_depends_on']
-
-                    if element[0] not in RETURN:
-                        RETURN[element[0]] = {element[1]:[field]}
-
-                    elif element[0] in RETURN and element[1] not in RETURN[element[0]].keys():
-                        RETURN[element[0]][element[1]] = [field]
-
-                    else:
-                        RETURN[element[0]][element[1]].append(field)
-
-        return RETURN
+        return compile_form_metadata(user_group)['forms'][form]['depends_on']
 
     return None
 
@@ -426,17 +411,6 @@ def propagate_form_fields(form=False, group=None):
         log.warning(f"LIBREFORMS - {e}")
         return {}
 
-def render_form_display_name(form_name, form_config):
-  
-  if '_title' in form_config and '_subtitle' in form_config:
-    return f"{form_config['_title']}: {form_config['_subtitle']}"
-
-  elif '_title' in form_config:
-    return form_config['_title']
-
-  return form_name.replace('_',' ')
-
-
 # every form defined under libreforms/ contains a series of key-value pairs for fields and configs. 
 # Configs define unique behavior for each form and are denoted by a _ at the beginning of the key;
 # for example `_dashboard` or `_allow_csv_uploads`. This method parses the configs for a given form and,
@@ -463,6 +437,7 @@ def propagate_form_configs(form=False):
             "_suppress_default_values": False,  
             "_allow_anonymous_access": False,  
             "_smtp_notifications":False,
+            "_digest_notifications":True,
             '_deny_groups': [],
             "_allow_owner_deletion": True,
             '_enable_universal_form_access': False,
@@ -746,12 +721,13 @@ def forms(form_name):
             content = f"This email serves to verify that {current_user.username} ({current_user.email}) has just submitted the {form_name} form, which you can view at {config['domain']}/submissions/{form_name}/{document_id}. {'; '.join(key + ': ' + str(value) for key, value in parsed_args.items() if key != mongodb.metadata_field_names['journal']) if options['_send_form_with_email_notification'] else ''}"
                             
             # and then we send our message
-            m = send_mail_async.delay(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name)) if config['send_mail_asynchronously'] else mailer.send_mail(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name), logfile=log)
+            m = send_notification(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name), form_name=form_name)
 
             if approver:
                 subject = f'{config["site_name"]} {form_name} Requires Approval ({document_id})'
                 content = f"This email serves to notify that {current_user.username} ({current_user.email}) has just submitted the {form_name} form for your review, which you can view at {config['domain']}/submissions/{form_name}/{document_id}/review."
-                m = send_mail_async.delay(subject=subject, content=content, to_address=approver.email, cc_address_list=rationalize_routing_list(form_name)) if config['send_mail_asynchronously'] else mailer.send_mail(subject=subject, content=content, to_address=approver.email, cc_address_list=rationalize_routing_list(form_name), logfile=log)
+                # approval requests skip the digest queue, so approvers can act on them right away
+                m = send_notification(subject=subject, content=content, to_address=approver.email, cc_address_list=rationalize_routing_list(form_name), form_name=form_name, instant=True)
 
             # form processing trigger, see https://github.com/libreForms/libreForms-flask/issues/201
             if config['enable_form_processing']:
@@ -800,73 +776,65 @@ def upload_forms(form_name):
 
     try:
         options = propagate_form_configs(form_name)
-        forms = propagate_form_fields(form_name, group=current_user.group)
         assert options['_allow_csv_uploads']
 
     except Exception as e:
         # print(e)
         return redirect(url_for('forms.forms', form_name=form_name))
 
-    if request.method == 'POST':
+    task_id = None
 
+    if request.method == 'POST':
 
         try:
             
             # collect the file name
             file = request.files['file']
 
-            # get file size and assert
-            file_size = len(file.read())
-            assert config['max_form_upload_size'] >= file_size, f"File upload size is too large. Max file size is {config['max_form_upload_size']} bytes."
-
-            # Reset the file pointer to the beginning of the file
-            file.seek(0)
-
             # print(file.filename)
             # assert we've passed a file name
             assert file.filename != '', "Please select a file to upload"
 
-            with tempfile.TemporaryDirectory() as tmpdirname:
-
-                filepath = secure_filename(file.filename) # first remove any banned chars
-                filepath = os.path.join(tmpdirname, file.filename)
-
-                if not config['allow_form_uploads_as_excel']:
-                    assert file.filename.lower().endswith(".csv",), 'Please upload a CSV file.'
-                else:
-                    assert file.filename.lower().endswith(('.csv', '.xlsx', '.xls')), 'Please upload a CSV or Excel file.'
-
-                # Save a local copy of the file
-                file.save(filepath)
+            # get file size and assert; we seek to the end of the stream instead of 
+            # reading it, to avoid loading the entire file into memory
+            file.seek(0, os.SEEK_END)
+            file_size = file.tell()
+            assert config['max_form_upload_size'] >= file_size, f"File upload size is too large. Max file size is {config['max_form_upload_size']} bytes."
 
-                if file.filename.lower().endswith('.xlsx'):
-                    excel_file = pd.ExcelFile(filepath, engine='openpyxl')
+            # Reset the file pointer to the beginning of the file
+            file.seek(0)
 
-                    # ensure the excel document only has one sheet
-                    assert len(excel_file.sheet_names) == 1, "Your submitted Excel file has too many sheets. To avoid breaking assumptions, please only submit Excel files with a single sheet."
+            if not config['allow_form_uploads_as_excel']:
+                assert file.filename.lower().endswith(".csv",), 'Please upload a CSV file.'
+            else:
+                assert file.filename.lower().endswith(('.csv', '.xlsx', '.xls')), 'Please upload a CSV or Excel file.'
 
-                    # Read a specific sheet as a DataFrame
-                    df = excel_file.parse()
+            # here we spool the upload to disk so it can be parsed in chunks, see app.form_imports
+            filepath = spool_form_upload(file, current_user.username)
 
-                elif file.filename.lower().endswith('.xls'):
-                    excel_file = pd.ExcelFile(filepath, engine='xlrd')
+            ip_address = request.remote_addr if options['_collect_client_ip'] else None
 
-                    # ensure the excel document only has one sheet
-                    assert len(excel_file.sheet_names) == 1, "Your submitted Excel file has too many sheets. To avoid breaking assumptions, please only submit Excel files with a single sheet."
+            # if we are importing uploads asynchronously, we hand the spooled file to a celery
+            # task and render the upload page with the task ID, which the page will use to poll
+            # forms.upload_status for the progress of the import.
+            if config['import_form_uploads_asynchronously']:
+                task = import_form_upload_async.delay(filepath, form_name, group=current_user.group,
+                                reporter=current_user.username, ip_address=ip_address)
+                task_id = task.id
 
-                    # Read a specific sheet as a DataFrame
-                    df = excel_file.parse()
+                log.info(f'{current_user.username.upper()} - queued form upload import for {form_name}, task ID {task_id}.')
+                flash(f"Your file has been received and is being imported. You can follow its progress below.", 'info')
 
+            else:
+                summary = import_form_upload(filepath, form_name, group=current_user.group,
+                                reporter=current_user.username, ip_address=ip_address)
 
-                else:
-                    # print('csv')
-                    df = pd.read_csv(filepath)
-                    
-                # print(df)
+                URL = config['domain']+url_for('submissions.submissions', form_name=form_name)
+                flash(Markup(f"Successfully imported {summary['inserted']} forms, which can be accessed at <a href=\"{URL}\">{URL}</a>"), 'info')
 
-                for x in forms.keys(): # a minimalist common sense check
-                    assert x in df.columns, f"{x} not in columns"
-                    
+                if summary['rejected'] > 0:
+                    URL = url_for('forms.download_upload_errors', form_name=form_name, filename=summary['errors_file'])
+                    flash(Markup(f"{summary['rejected']} rows failed validation and were not imported. You can <a href=\"{URL}\">download a report of these errors</a>."), 'warning')
 
         except Exception as e: 
             # log.warning(f"{current_user.username.upper()} - {str(e)}")
@@ -878,36 +846,6 @@ def upload_forms(form_name):
 
             return redirect(url_for('forms.upload_forms', form_name=form_name))
 
-
-        for index, row in df.iterrows():
-            # print(row)
-        
-            try:
-                ### eventually add content validators for each cell here
-
-                # drop any stray columns
-                row.drop(labels=[x for x in row.index if x not in forms.keys()], inplace=True)
-
-                # construct a dictionary payload
-                data = row.to_dict()
-
-                # write to database
-                document_id = mongodb.write_document_to_collection(data, form_name, 
-                                reporter=current_user.username, 
-                                ip_address=request.remote_addr if options['_collect_client_ip'] else None,)
-
-                URL = f"{config['domain']}/submissions/{form_name}/{document_id}"
-                flash(Markup(f"Successfully created new form, which can be accessed at <a href=\"{URL}\">{URL}</a>"), 'info')
-
-            except Exception as e: 
-
-                transaction_id = str(uuid.uuid1())
-                log.warning(f"{current_user.username.upper()} - {e}", extra={'transaction_id': transaction_id})
-                flash (f"There was an error in processing your request. Transaction ID: {transaction_id}. ", 'warning')
-
-                # log.warning(f"{current_user.username.upper()} - {str(e)}")
-                # flash(str(e), 'warning')
-
     return render_template('app/upload_form.html.jinja', 
         name='Forms',
         subtitle=form_name,
@@ -915,9 +853,52 @@ def upload_forms(form_name):
         type="forms",       
         filename = f'{form_name.lower().replace(" ","")}.csv' if options['_allow_csv_templates'] else False,
         user_list = collect_list_of_users() if config['allow_forms_access_to_user_list'] else [],
+        task_id=task_id,
         **standard_view_kwargs(),
         )
 
+
+# this route reports the progress of background form upload imports, which
+# are queued by forms.upload_forms, see app.form_imports for more details.
+@bp.route(f'/<form_name>/upload/status/<task_id>', methods=['GET'])
+@required_login_and_password_reset
+def upload_status(form_name, task_id):
+
+    task = celery.AsyncResult(task_id)
+
+    response = {'state': task.state}
+
+    # the task result contains the username of the user who queued the import;
+    # we don't share progress with anyone else.
+    if isinstance(task.info, dict):
+        if task.info.get('reporter') != current_user.username or task.info.get('form_name') != form_name:
+            return abort(404)
+        response.update(task.info)
+
+    elif task.state == 'FAILURE':
+        transaction_id = str(uuid.uuid1())
+        log.warning(f"{current_user.username.upper()} - {task.info}", extra={'transaction_id': transaction_id})
+        response['msg'] = f"There was an error in processing your request. Transaction ID: {transaction_id}."
+
+    return Response(json.dumps(response), status=config['success_code'], mimetype='application/json')
+
+
+# this route serves the error reports generated when rows in a form upload fail
+# validation, see app.form_imports. We only look in the current user's directory.
+@bp.route(f'/<form_name>/upload/errors/<filename>', methods=['GET'])
+@required_login_and_password_reset
+def download_upload_errors(form_name, filename):
+
+    directory = os.path.abspath(get_form_import_directory(current_user.username))
+    filename = secure_filename(filename)
+
+    if not filename.endswith('_errors.csv') or not os.path.exists(os.path.join(directory, filename)):
+        return abort(404)
+
+    return send_from_directory(directory, filename, as_attachment=True, 
+                                download_name=f"{form_name}_upload_errors.csv")
+
+
 @bp.route(f'/lookup', methods=['GET', 'POST'])
 @required_login_and_password_reset
 def generate_lookup():
@@ -943,32 +924,6 @@ def generate_lookup():
 @required_login_and_password_reset
 def lint_field():
 
-
-    def validate_option(form, field, value):
-
-        # here we set the validators field, if it exists
-        validators = libreforms.forms[form][field]['output_data']['validators'].copy() if 'validators' in libreforms.forms[form][field]['output_data'] else []
-
-        for validator in validators:
-
-            # admins can pass validators as tuples where the second value is the error msg. 
-            # Here, we unpack if they are tuples.
-            if type(validator) == tuple:
-                (validator, error_msg) = validator
-
-            else:
-                error_msg = f"{field} failed validation." 
-
-
-            # print(str(validator))
-            try:
-                assert validator(value), error_msg
-
-            except Exception as e:
-                return str(e)
-
-        return True
-
     if request.method == 'POST':
         # print(request)
 
@@ -979,7 +934,9 @@ def lint_field():
 
         # print(string)
 
-        v = validate_option(form, field, value)
+        # here we use the validators precompiled in the form registry, see app.form_registry
+        schema = compile_form_schema(form, group=current_user.group)
+        v = lint_field_value(schema[field]['validators'], value) if field in schema else f"{field} is not a field in this form."
 
         if type(v) == bool:
             return Response(json.dumps({'status':'success'}), status=config['success_code'], mimetype='application/json')
@@ -989,6 +946,45 @@ def lint_field():
     return abort(404)
 
 
+# this route lints a map of field values for a single form in one request, returning 
+# each field's verdict, so the form page can validate all the fields a user changed 
+# in a single round trip. Clients can pass an `X-Lint-Sequence` header, which we echo 
+# back so they can discard responses to stale requests; and we return the interval 
+# that clients should wait between requests in the `X-Lint-Debounce` header.
+@bp.route(f'/lint/batch', methods=['POST'])
+@required_login_and_password_reset
+def lint_fields():
+
+    try:
+        form = request.json['form']
+        values = request.json['fields']
+        assert form in libreforms.forms.keys()
+        assert isinstance(values, dict)
+
+    except Exception as e:
+        return Response(json.dumps({'status':'failure'}), status=config['error_code'], mimetype='application/json')
+
+    schema = compile_form_schema(form, group=current_user.group)
+
+    verdicts = {}
+    for field, value in values.items():
+
+        v = lint_field_value(schema[field]['validators'], value) if field in schema else f"{field} is not a field in this form."
+
+        verdicts[field] = {'status':'success'} if type(v) == bool else {'status':'failure', 'msg': v}
+
+    status = 'success' if all(x['status'] == 'success' for x in verdicts.values()) else 'failure'
+
+    response = Response(json.dumps({'status': status, 'fields': verdicts}), status=config['success_code'], mimetype='application/json')
+    response.headers['X-Lint-Debounce'] = str(config['lint_debounce_interval'])
+    response.headers['Cache-Control'] = 'no-store'
+
+    if request.headers.get('X-Lint-Sequence'):
+        response.headers['X-Lint-Sequence'] = request.headers.get('X-Lint-Sequence')
+
+    return response
+
+
 # this is the download link for files in the temp directory
 @bp.route('/download/<path:filename>')
 @required_login_and_password_reset
@@ -24,11 +24,11 @@ from app.views.auth import login_required
 from app.signing import generate_key
 from app.models import Report
 from app import config, log, mongodb, mailer, config, db
-from app.filters import lint_filters, send_individual_report
+from app.filters import lint_filters, compile_report_filters, send_individual_report
 from app.decorators import required_login_and_password_reset
 
 # and finally, import other packages
-import os
+import os, uuid
 from datetime import datetime
 import pandas as pd
 import json
@@ -73,6 +73,9 @@ def write_report_to_db(name=None, form_name=None, filters=None, frequency=None,
                         last_run_at=start_at,
                         last_run_at_human_readable=start_at_human_readable,)
 
+        # we set `next_run_at`, which the report scheduler uses to select due reports
+        new_report.schedule()
+
         db.session.add(new_report)
         db.session.commit()
         log.info(f'{current_user.username.upper()} - successfully generated report {new_report.report_id}: {name}.')
@@ -139,7 +142,13 @@ def create_reports(form_name):
         end_at_human_readable = request.form['end_at'] if request.form['end_at'] else ''
         start_at = datetime.strptime(request.form['start_at'], "%Y-%m-%d").timestamp() if request.form['start_at'] != '' else datetime.timestamp(datetime.now())
         end_at = datetime.strptime(request.form['end_at'], "%Y-%m-%d").timestamp() if request.form['end_at'] != '' else 0
-        
+
+        # we reject filters that cannot be compiled, see app.filters
+        try:
+            compile_report_filters(filters, form_name=form_name)
+        except ValueError as e:
+            flash(f'Invalid filters: {e}. ', "warning")
+            return redirect(url_for('reports.create_reports', form_name=form_name))
 
         report_id = write_report_to_db( name=name, 
                                         form_name=form_name, filters=filters, 
@@ -195,6 +204,12 @@ def modify_report(report_id):
         start_at = datetime.strptime(request.form['start_at'], "%Y-%m-%d").timestamp() if request.form['start_at'] != '' else datetime.timestamp(datetime.now())
         end_at = datetime.strptime(request.form['end_at'], "%Y-%m-%d").timestamp() if request.form['end_at'] != '' else 0
 
+        # we reject filters that cannot be compiled, see app.filters
+        try:
+            compile_report_filters(filters, form_name=report.form_name)
+        except ValueError as e:
+            flash(f'Invalid filters: {e}. ', "warning")
+            return redirect(url_for('reports.modify_report', report_id=str(report_id)))
     
         try:
 
@@ -211,6 +226,7 @@ def modify_report(report_id):
             report.timestamp = datetime.timestamp(datetime.now()) 
             # report.last_run_at = datetime.timestamp(datetime.now()) 
             # report.last_run_at_human_readable = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S") 
+            report.schedule()
 
             db.session.commit()
 
@@ -307,6 +323,7 @@ def activate_report(report_id):
         return redirect(url_for('reports.view_report', report_id=str(report_id)))
 
     report.active = 1 
+    report.schedule()
     db.session.commit()
 
     flash (f'Report successfully activated. ', 'info')
@@ -333,6 +350,7 @@ def deactivate_report(report_id):
         return redirect(url_for('reports.view_report', report_id=str(report_id)))
 
     report.active = 0 
+    report.schedule()
     db.session.commit()
 
     flash (f'Report successfully deactivated. ', 'info')
@@ -374,7 +392,10 @@ def view_lint_filters():
         string = request.json['string']
         # print(string)
 
-        if lint_filters(string):
+        # when the form is passed, we also check the fields and value types against it
+        form_name = request.json.get('form_name') if request.json.get('form_name') in libreforms.forms else None
+
+        if lint_filters(string, form_name=form_name):
             return Response(json.dumps({'status':'success'}), status=config['success_code'], mimetype='application/json')
 
         return Response(json.dumps({'status':'failure'}), status=config['error_code'], mimetype='application/json')
@@ -24,7 +24,7 @@ from app.form_access import test_access_single_group
 from app.views.auth import login_required
 from app.views.forms import standard_view_kwargs
 from app.decorators import required_login_and_password_reset
-from libreforms import forms as lf
+import libreforms
 
 bp = Blueprint('search', __name__, url_prefix='/search')
 
@@ -74,6 +74,13 @@ def search():
         # print([x for x in results])
 
 
+    # if we've enabled the embedded full-text index, see app.fts
+    elif config['use_sqlite_fts_search']:
+        from app.fts import search_fts_index
+
+        results = search_fts_index(query, exclude_forms=total_exclusions, 
+                        limit=config['limit_search_results_length'] if config['limit_search_results_length'] else 100)
+
     else: 
         # if we are not using elasticsearch as a search wrapper for mongodb, 
         # then let's just query mongodb directly; if we've passed any forms
@@ -159,9 +166,9 @@ def advanced_search():
 
     # For GET method (initial page load)
     if config['exclude_forms_from_search']:
-        f = [x for x in lf.keys() if x not in config['exclude_forms_from_search']]
+        f = [x for x in libreforms.forms.keys() if x not in config['exclude_forms_from_search']]
     else:
-        f = lf.keys()
+        f = libreforms.forms.keys()
 
     return render_template('app/advanced_search.html.jinja', 
         type="home",
@@ -179,9 +186,9 @@ def get_fields_advanced_search():
     data = request.get_json()
     form_name = data.get('formName')
 
-    # Check if the form name exists in the lf dictionary
-    if form_name in lf:
-        form_fields = lf[form_name]
+    # Check if the form name exists in the libreforms.forms dictionary
+    if form_name in libreforms.forms:
+        form_fields = libreforms.forms[form_name]
         response_data = [{"name": field, "type": form_fields[field]['input_field']["type"], "content": form_fields[field]['input_field']["content"]} for field in form_fields if not field.startswith("_") and form_fields[field]['input_field']["type"] != "hidden"]
         return jsonify(response_data)
     else:
@@ -36,8 +36,9 @@ from app.views.forms import form_menu, checkGroup, checkFormGroup, \
 if config['enable_wtforms_test_features']:
     from app.views.forms import create_dynamic_form
     
-from celeryd.tasks import send_mail_async
+from app.notifications import send_notification
 from app.decorators import required_login_and_password_reset
+from app.form_registry import compile_form_metadata
 
 # and finally, import other packages
 import os
@@ -370,19 +371,8 @@ def generate_username_badge_list(form_name:str) -> list:
     if not config['parse_usernames_as_badges']:
         return []
     
-    FIELD_LIST = []
-    
-    # add the basic metadata fields
-    FIELD_LIST.append(mongodb.metadata_field_names['owner'])
-    FIELD_LIST.append(mongodb.metadata_field_names['reporter'])
-    FIELD_LIST.append(mongodb.metadata_field_names['approver'])
-    FIELD_LIST.append(mongodb.metadata_field_names['approval'])
-
-    for index,data in propagate_form_fields(form_name).items():
-        if '_render_user_badges' in data and data['_render_user_badges']:
-            FIELD_LIST.append(index)
-
-    return FIELD_LIST
+    # the badge fields are precompiled in the form registry, see app.form_registry
+    return list(compile_form_metadata()['forms'][form_name]['badge_fields'])
 
 bp = Blueprint('submissions', __name__, url_prefix='/submissions')
 
@@ -1073,7 +1063,7 @@ def render_document_edit(form_name, document_id):
                     content = f"This email serves to verify that {current_user.username} ({current_user.email}) has just updated the {form_name} form, which you can view at {config['domain']}/submissions/{form_name}/{document_id}. {'; '.join(key + ': ' + str(value) for key, value in parsed_args.items() if key not in [mongodb.metadata_field_names['journal'], mongodb.metadata_field_names['metadata']]) if options['_send_form_with_email_notification'] else ''}"
                     
                     # and then we send our message
-                    m = send_mail_async.delay(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name)) if config['send_mail_asynchronously'] else mailer.send_mail(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name), logfile=log)
+                    m = send_notification(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name), form_name=form_name)
 
 
                     # form processing trigger, see https://github.com/libreForms/libreForms-flask/issues/201    
@@ -1244,7 +1234,7 @@ def duplicate_document(form_name, document_id):
                     content = f"This email serves to verify that {current_user.username} ({current_user.email}) has just updated the {form_name} form, which you can view at {config['domain']}/submissions/{form_name}/{new_document_id}. {'; '.join(key + ': ' + str(value) for key, value in parsed_args.items() if key not in [mongodb.metadata_field_names['journal'], mongodb.metadata_field_names['metadata']]) if options['_send_form_with_email_notification'] else ''}"
                     
                     # and then we send our message
-                    m = send_mail_async.delay(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name)) if config['send_mail_asynchronously'] else mailer.send_mail(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name), logfile=log)
+                    m = send_notification(subject=subject, content=content, to_address=current_user.email, cc_address_list=rationalize_routing_list(form_name), form_name=form_name)
 
 
                     # form processing trigger, see https://github.com/libreForms/libreForms-flask/issues/201    
@@ -1443,7 +1433,7 @@ def review_document(form_name, document_id):
             to_user = User.query.filter_by(username=overrides[mongodb.metadata_field_names['owner']]).first()
 
             # # and then we send our message
-            m = send_mail_async.delay(subject=subject, content=content, to_address=to_user.email, cc_address_list=[current_user.email]) if config['send_mail_asynchronously'] else mailer.send_mail(subject=subject, content=content, to_address=to_user.email, cc_address_list=[current_user.email], logfile=log)
+            m = send_notification(subject=subject, content=content, to_address=to_user.email, cc_address_list=[current_user.email], form_name=form_name)
 
             return redirect(url_for('submissions.render_document', form_name=form_name, document_id=document_id))
 
@@ -15,9 +15,10 @@ __email__ = "signe@atreeus.com"
 
 
 # import flask-related packages
-from flask import current_app, Blueprint, render_template, request, flash, redirect, url_for, send_from_directory
+from flask import current_app, Blueprint, render_template, request, flash, redirect, url_for, send_from_directory, Response, stream_with_context
 from flask_login import current_user
 from markupsafe import Markup
+from werkzeug.utils import secure_filename
 
 # import custom packages from the current repository
 import libreforms as libreforms
@@ -27,10 +28,11 @@ from app.views.submissions import set_digital_signature
 from app.models import User
 from app import config, log, mongodb, db
 from app.decorators import required_login_and_password_reset
+from app.form_registry import compile_form_schema
 
 
 # and finally, import other packages
-import os
+import os, json, uuid, csv, io
 import pandas as pd
 
 # pd.set_option('display.max_colwidth', 30)
@@ -50,6 +52,119 @@ def tables_home():
             **standard_view_kwargs(),
         ) 
 
+# here we define the table columns a user can see, filter and sort on: the form fields 
+# their group has access to, and the owner, reporter and (last edit) timestamp metadata.
+def get_table_columns(form_name):
+    return list(compile_form_schema(form_name, group=current_user.group).keys()) + [ mongodb.metadata_field_names[x] for x in ['owner', 'reporter', 'timestamp'] ]
+
+
+# here we translate per-column filters passed as request args (eg. ?Text_Field=foo) into a
+# MongoDB query. These used to be applied in pandas by comparing each value as a string; to
+# preserve that behavior for numeric fields, we match both the string and numeric value.
+def compile_table_filters(form_name, args):
+
+    schema = compile_form_schema(form_name, group=current_user.group)
+
+    query = {}
+
+    for col in get_table_columns(form_name):
+
+        value = args.get(col)
+
+        if not value:
+            continue
+
+        candidates = [str(value)]
+
+        if col in schema and schema[col]['type'] in ['int', 'float']:
+            try:
+                candidates.append(float(value))
+            except ValueError:
+                pass
+
+        query[col] = candidates[0] if len(candidates) == 1 else {'$in': candidates}
+
+    return query
+
+
+# Added signature verification, see https://github.com/signebedi/libreForms/issues/8; we
+# expect this to be run on a single page of data, as it requires a database lookup per row.
+def verify_table_signatures(df, form_name):
+
+    approval_fields = [mongodb.metadata_field_names['approval'],mongodb.metadata_field_names['approver'], mongodb.metadata_field_names['approver_comment']]
+
+    if mongodb.metadata_field_names['signature'] in df.columns:
+        df[mongodb.metadata_field_names['signature']] = df.apply(lambda row: set_digital_signature(username=row[mongodb.metadata_field_names['owner']],encrypted_string=row[mongodb.metadata_field_names['signature']],
+            base_string=config['signature_key'],
+            return_markup=False), axis=1)
+
+    if all(x in df.columns for x in approval_fields):
+        df[mongodb.metadata_field_names['approval']] = df.apply(lambda row: set_digital_signature(
+            username= db.session.query(User).filter(getattr(User, config['visible_signature_field'])==row[mongodb.metadata_field_names['approver']]).first(),
+            encrypted_string=row[mongodb.metadata_field_names['signature']],
+            base_string=config['approval_key'],
+            fallback_string=config['disapproval_key'],
+            return_markup=False), axis=1)
+    else:
+        [ df.drop(columns=[x], inplace=True) for x in approval_fields if x in df.columns]
+
+    return df
+
+
+# this loads a single page of table data, with filtering, sorting and paging pushed into 
+# MongoDB, so the cost of rendering a table is bounded by the page size rather than the 
+# size of the collection. Signatures are only included (and verified) if `include_signatures`
+# is set and the form is digitally signed. We return the page as a dataframe, along with
+# the paging details.
+def load_table_page(form_name, args, include_signatures=False):
+
+    page_size = min(max(args.get('page_size', config['table_page_size'], type=int), 1), config['table_max_page_size'])
+    page = max(args.get('page', 1, type=int), 1)
+
+    columns = get_table_columns(form_name)
+
+    # sort values using timestamp field (last edit time) by default, newest
+    # on top, see https://github.com/libreForms/libreForms-flask/issues/336.
+    sort = args.get('sort', mongodb.metadata_field_names['timestamp'])
+    if sort not in columns:
+        sort = mongodb.metadata_field_names['timestamp']
+    direction = 'asc' if args.get('direction', 'desc') == 'asc' else 'desc'
+
+    if include_signatures and propagate_form_configs(form_name)['_digitally_sign']:
+        columns = columns + [ mongodb.metadata_field_names[x] for x in ['signature', 'approver', 'approval', 'approver_comment'] ]
+
+    documents, total, filtered = mongodb.query_collection_page(form_name, 
+                                        query=compile_table_filters(form_name, args), 
+                                        projection=columns + ['_id'], 
+                                        sort=[(sort, 1 if direction == 'asc' else -1)],
+                                        skip=(page-1)*page_size, 
+                                        limit=page_size)
+
+    df = pd.DataFrame(documents, columns=columns + ['_id'])
+
+    # drop signature columns that none of the documents on this page have set
+    df.drop(columns=[x for x in df.columns if x not in get_table_columns(form_name)+['_id'] and df[x].isna().all()], inplace=True)
+
+    df = verify_table_signatures(df, form_name)
+
+    # we generate hyperlinks to each individual form, see https://github.com/libreForms/libreForms-flask/issues/243;
+    # we call url_for once and substitute each document ID, rather than calling it for each row
+    hyperlink = config['domain']+url_for('submissions.render_document', form_name=form_name, document_id='__document_id__')
+    df['Hyperlink'] = df['_id'].map(lambda x: hyperlink.replace('__document_id__', str(x)))
+
+    df.drop(columns=['_id'], inplace=True)
+
+    return df, {
+        'page': page,
+        'page_size': page_size,
+        'pages': max(-(-filtered // page_size), 1),
+        'total': total,
+        'filtered': filtered,
+        'sort': sort,
+        'direction': direction,
+    }
+
+
 # this creates the route to each of the tables
 @bp.route(f'/<form_name>', methods=['GET', 'POST'])
 @required_login_and_password_reset
@@ -65,66 +180,12 @@ def tables(form_name):
 
 
     try:
-        data = mongodb.read_documents_from_collection(form_name)
-        df = pd.DataFrame(list(data))
-
-        # Added signature verification, see https://github.com/signebedi/libreForms/issues/8
-        if mongodb.metadata_field_names['signature'] in df.columns:
-            if propagate_form_configs(form_name)['_digitally_sign']:
-                df[mongodb.metadata_field_names['signature']] = df.apply(lambda row: set_digital_signature(username=row[mongodb.metadata_field_names['owner']],encrypted_string=row[mongodb.metadata_field_names['signature']],
-                    base_string=config['signature_key'],
-                    return_markup=False), axis=1)
-            else:
-                df.drop(columns=[mongodb.metadata_field_names['signature']], inplace=True)
-                
-
-        if all(x in df.columns for x in [mongodb.metadata_field_names['approval'],mongodb.metadata_field_names['approver'], mongodb.metadata_field_names['approver_comment']]):
-            if propagate_form_configs(form_name)['_digitally_sign']:
-
-
-                df[mongodb.metadata_field_names['approval']] = df.apply(lambda row: set_digital_signature(
-                    username= db.session.query(User).filter(getattr(User, config['visible_signature_field'])==row[mongodb.metadata_field_names['approver']]).first(),
-                    encrypted_string=row[mongodb.metadata_field_names['signature']],
-                    base_string=config['approval_key'],
-                    fallback_string=config['disapproval_key'],
-                    return_markup=False), axis=1)
-            else:
-                df.drop(columns=[mongodb.metadata_field_names['approval'],mongodb.metadata_field_names['approver'], mongodb.metadata_field_names['approver_comment']], inplace=True)
-        else:
-            [ df.drop(columns=[x], inplace=True) for x in [mongodb.metadata_field_names['approval'],mongodb.metadata_field_names['approver'], mongodb.metadata_field_names['approver_comment']] if x in df.columns]
+        df, paging = load_table_page(form_name, request.args)
 
-
-
-        if len(df.index) < 1:
+        if paging['total'] < 1:
             flash('This form has not received any submissions.', "warning")
             return redirect(url_for('tables.tables_home'))
 
-        # prior to dropping the metadata fields, we generate hyperlinks to each individual
-        # form, see https://github.com/libreForms/libreForms-flask/issues/243. Luckily, we
-        # don't need to deal with submissions.gen_hyperlink because pandas dataframes allow
-        # you to render links when you generate the table as html using render_link, see
-        # https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.DataFrame.to_html.html. 
-        # df['Hyperlink'] = df.apply(lambda row: f"{config['domain']}/submissions/{form_name}/{row._id}", axis=1)
-        df['Hyperlink'] = df.apply(lambda row: config['domain']+url_for('submissions.render_document', form_name=form_name, document_id=row['_id']), axis=1)
-
-
-        # drop `meta` fields from user vis
-        # [ df.drop(columns=[x], inplace=True) for x in [mongodb.metadata_field_names['journal'], mongodb.metadata_field_names['metadata'], '_id'] if x in df.columns]
-        [ df.drop(columns=[x], inplace=True) for x in mongodb.metadata_fields(exclude_id=True, ignore_fields=['owner', 'reporter', 'timestamp',]) if x in df.columns]
-
-        # here we allow the user to select fields they want to use, 
-        # overriding the default view-all.
-        # warning, this may be buggy
-
-        for col in df.columns:
-            if request.args.get(col):
-                # prevent type-mismatch by casting both fields as strings
-                df = df.loc[df[col].astype("string") == str(request.args.get(col))] 
-
-        # sort values using timestamp field (last edit time) by default, newest
-        # on top, see https://github.com/libreForms/libreForms-flask/issues/336.
-        df.sort_values(by=mongodb.metadata_field_names['timestamp'], inplace=True, ignore_index=True, ascending=False)
-
         df.columns = [x.replace("_", " ") for x in df.columns]
 
     except Exception as e: 
@@ -145,11 +206,15 @@ def tables(form_name):
 
     df = df.applymap(clip_string)
 
-    print(df.columns)
-
+    # we pass the current filter, sorting and page size args so the pager links preserve them; we
+    # leave out any other args, like `page` and `form_name`, which the pager sets itself
+    page_args = {key: value for key, value in request.args.items() 
+                    if key in get_table_columns(form_name) + ['sort', 'direction', 'page_size'] and key not in ['page', 'form_name']}
 
     return render_template('app/tables.html.jinja',
         table=df,
+        paging=paging,
+        page_args=page_args,
         type="tables",
         name='Tables',
         subtitle=form_name,
@@ -161,12 +226,83 @@ def tables(form_name):
     )
 
 
-# this is the download link for files in the temp directory
+# this is a JSON data endpoint for server-side table widgets; it accepts the `page`, 
+# `page_size`, `sort` and `direction` (asc or desc) args, and any number of per-column 
+# filters passed as args, and returns a single page of data. We echo the `draw` arg, 
+# which some widgets use to order their requests.
+@bp.route(f'/<form_name>/data', methods=['GET'])
+@required_login_and_password_reset
+def table_data(form_name):
+
+    if form_name not in libreforms.forms.keys() or not checkGroup(group=current_user.group, struct=propagate_form_configs(form_name)['_table']):
+        return Response(json.dumps({'status':'failure'}), status=config['error_code'], mimetype='application/json')
+
+    try:
+        df, paging = load_table_page(form_name, request.args, include_signatures=True)
+
+        data = {
+            'status': 'success',
+            'draw': request.args.get('draw', None, type=int),
+            'columns': list(df.columns),
+            'data': json.loads(df.to_json(orient='records', default_handler=str)),
+            **paging,
+        }
+
+    except Exception as e: 
+        transaction_id = str(uuid.uuid1())
+        log.warning(f"{current_user.username.upper()} - {e}", extra={'transaction_id': transaction_id})
+        return Response(json.dumps({'status':'failure', 'msg': f"There was an error in processing your request. Transaction ID: {transaction_id}."}), status=config['error_code'], mimetype='application/json')
+
+    return Response(json.dumps(data), status=config['success_code'], mimetype='application/json')
+
+
+# this generates the rows of a table export, one document at a time, from a projected 
+# cursor. We verify signatures as we go, and cache approver lookups so we only query the 
+# user database once for each approver.
+def iter_table_export_rows(form_name, columns, query):
+
+    digitally_sign = propagate_form_configs(form_name)['_digitally_sign']
+    approvers = {}
+
+    # we index the sort field, and let the sort spill to disk while the index builds, so large 
+    # forms do not hit MongoDB's in-memory sort limit partway through the download
+    mongodb.create_timestamp_index(form_name)
+
+    for document in mongodb.iter_documents_from_collection(form_name, query=query, projection=columns, 
+                                        sort=[(mongodb.metadata_field_names['timestamp'], -1)], allow_disk_use=True):
+
+        # Added signature verification, see https://github.com/signebedi/libreForms/issues/8
+        if digitally_sign:
+            document[mongodb.metadata_field_names['signature']] = set_digital_signature(username=document.get(mongodb.metadata_field_names['owner']),
+                encrypted_string=document.get(mongodb.metadata_field_names['signature']),
+                base_string=config['signature_key'],
+                return_markup=False)
+
+            approver = document.get(mongodb.metadata_field_names['approver'])
+            if approver:
+                if approver not in approvers:
+                    approvers[approver] = db.session.query(User).filter(getattr(User, config['visible_signature_field'])==approver).first()
+
+                document[mongodb.metadata_field_names['approval']] = set_digital_signature(
+                    username=approvers[approver],
+                    encrypted_string=document.get(mongodb.metadata_field_names['signature']),
+                    base_string=config['approval_key'],
+                    fallback_string=config['disapproval_key'],
+                    return_markup=False)
+
+        yield [ document.get(x) for x in columns ]
+
+
+# this is the download link for table exports, which are streamed to the client as the 
+# cursor is read, rather than staged in the temp directory, so memory use is bounded by 
+# the cursor batch size and the download begins immediately. The format is set by the 
+# file extension: `.csv` (the default) or `.ndjson` (one JSON document per line). 
+# Per-column filters can be passed as args, as in the tables view.
 @bp.route('/download/<path:filename>')
 @required_login_and_password_reset
 def download_file(filename):
 
-    form_name = filename.replace('.csv', '')
+    form_name, extension = os.path.splitext(filename)
 
     if form_name not in libreforms.forms.keys():
         flash('This form does not exist.', "warning")
@@ -176,69 +312,59 @@ def download_file(filename):
         flash(f'You do not have access to this dashboard.', "warning")
         return redirect(url_for('tables.tables_home'))
 
+    if extension not in ['.csv', '.ndjson']:
+        flash('This export format is not supported.', "warning")
+        return redirect(url_for('tables.tables', form_name=form_name))
 
     try:
-        data = mongodb.read_documents_from_collection(form_name)
-        df = pd.DataFrame(list(data))
 
-        # Added signature verification, see https://github.com/signebedi/libreForms/issues/8
-        if mongodb.metadata_field_names['signature'] in df.columns:
-            if propagate_form_configs(form_name)['_digitally_sign']:
-                df[mongodb.metadata_field_names['signature']] = df.apply(lambda row: set_digital_signature(username=row[mongodb.metadata_field_names['owner']],encrypted_string=row[mongodb.metadata_field_names['signature']],
-                base_string=config['signature_key'],
-                return_markup=False), axis=1)
+        # we export the same columns as the tables view, and the signature and 
+        # approval fields for digitally signed forms
+        columns = get_table_columns(form_name)
+        if propagate_form_configs(form_name)['_digitally_sign']:
+            columns = columns + [ mongodb.metadata_field_names[x] for x in ['signature', 'approver', 'approval', 'approver_comment'] ]
 
-            else:
-                df.drop(columns=[mongodb.metadata_field_names['signature']], inplace=True)
+        query = compile_table_filters(form_name, request.args)
 
-        if all(x in df.columns for x in [mongodb.metadata_field_names['approval'],mongodb.metadata_field_names['approver'], mongodb.metadata_field_names['approver_comment']]):
-            if propagate_form_configs(form_name)['_digitally_sign']:
-
-
-                df[mongodb.metadata_field_names['approval']] = df.apply(lambda row: set_digital_signature(
-                    username= db.session.query(User).filter(getattr(User, config['visible_signature_field'])==row[mongodb.metadata_field_names['approver']]).first(),
-                    encrypted_string=row[mongodb.metadata_field_names['signature']],
-                    base_string=config['approval_key'],
-                    fallback_string=config['disapproval_key'],
-                    return_markup=False), axis=1)
-            else:
-                df.drop(columns=[mongodb.metadata_field_names['approval'], mongodb.metadata_field_names['approver'], mongodb.metadata_field_names['approver_comment']], inplace=True)
-        else:
-            [ df.drop(columns=[x], inplace=True) for x in [mongodb.metadata_field_names['approval'], mongodb.metadata_field_names['approver'], mongodb.metadata_field_names['approver_comment']] if x in df.columns]
+        # we check for submissions up front, as we cannot redirect once the stream has started
+        documents, total, filtered = mongodb.query_collection_page(form_name, query=query, projection=['_id'], limit=1)
 
-        if len(df.index) < 1:
+        if len(documents) < 1:
             flash('This form has not received any submissions.', "warning")
             return redirect(url_for('tables.tables_home'))
 
-
-        [ df.drop(columns=[x], inplace=True) for x in [mongodb.metadata_field_names['journal'], mongodb.metadata_field_names['metadata'], '_id'] if x in df.columns]
-        
-        # here we allow the user to select fields they want to use, 
-        # overriding the default view-all.
-        # warning, this may be buggy
-
-        for col in df.columns:
-            if request.args.get(col):
-                # prevent type-mismatch by casting both fields as strings
-                df = df.loc[df[col].astype("string") == str(request.args.get(col))] 
-
-        df.columns = [x.replace("_", " ") for x in df.columns]
     except Exception as e: 
-        # log.warning(f"LIBREFORMS - {e}")
-        # flash(f'This form does not exist. {e}', "warning")
         transaction_id = str(uuid.uuid1())
         log.warning(f"{current_user.username.upper()} - {e}", extra={'transaction_id': transaction_id})
         flash (f"There was an error in processing your request. Transaction ID: {transaction_id}. ", 'warning')
 
         return redirect(url_for('tables.tables_home'))
 
-    # here we employ a context-bound temp directory to stage this file for download, see
-    # discussion in app.tmpfiles and https://github.com/signebedi/libreForms/issues/169.
-    from app.tmpfiles import temporary_directory
-    with temporary_directory() as tempfile_path:
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        writer.writerow([x.replace("_", " ") for x in columns])
+
+        for i, row in enumerate(iter_table_export_rows(form_name, columns, query), start=1):
+            writer.writerow(row)
+
+            # we flush the buffer every few hundred rows to avoid yielding tiny chunks
+            if i % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+
+        yield buffer.getvalue()
+
+    def generate_ndjson():
+        for row in iter_table_export_rows(form_name, columns, query):
+            yield json.dumps(dict(zip(columns, row)), default=str) + '\n'
 
-        fp = os.path.join(tempfile_path, filename)
-        df.to_csv(fp, index=False)
+    log.info(f'{current_user.username.upper()} - exported {form_name} as {extension}.')
 
-        return send_from_directory(tempfile_path,
-                                filename, as_attachment=True)
\ No newline at end of file
+    # we use stream_with_context because the generators rely on the request context, eg. to 
+    # query the user database when verifying approvals
+    return Response(stream_with_context(generate_csv() if extension == '.csv' else generate_ndjson()),
+                        mimetype='text/csv' if extension == '.csv' else 'application/x-ndjson',
+                        headers={'Content-Disposition': f'attachment; filename={secure_filename(filename)}'})
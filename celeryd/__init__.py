@@ -40,14 +40,17 @@ __maintainer__ = "Sig Janoska-Bedi"
 __email__ = "signe@atreeus.com"
 
 # import any relevant tasks defined in celeryd outside the app context
-from celeryd.tasks import send_mail_async, write_document_to_collection_async
+from celeryd.tasks import send_mail_async, write_document_to_collection_async, export_forms_to_parquet_async, flush_mail_digests_async, flush_search_index_events_async
 
 # import flask app specific dependencies
 from app import create_app, celery, log, mongodb
-from app.filters import send_eligible_reports
+from app.filters import send_eligible_reports, dispatch_eligible_reports, send_report_batch
+from app.search_index import index_changed_documents, flush_search_index_events
 
-# import the libreforms form config
-from libreforms import forms
+# import the libreforms form config; nb. we reference `libreforms.forms` rather than
+# importing `forms` directly, so we pick up reloaded form definitions, see app.form_registry
+import libreforms
+from app.form_registry import sync_form_registry_version, refresh_form_registry_if_stale
 
 # import data management tools
 import pandas as pd
@@ -59,9 +62,41 @@ from dateutil import parser
 app = create_app(celery_app=True)
 app.app_context().push()
 
+# record the version of the form definitions loaded by this process
+sync_form_registry_version()
+
+# this is the periodic report task; when the `report_fan_out` app config is set, it only
+# dispatches the due reports to send_form_reports_async, see app.filters.dispatch_eligible_reports.
 @celery.task()
 def send_eligible_reports_async(*arg, **kwargs):
-    return send_eligible_reports(*arg, **kwargs)
+    refresh_form_registry_if_stale()
+
+    if not app.config["REPORT_FAN_OUT"]:
+        return send_eligible_reports(*arg, **kwargs)
+
+    batches = dispatch_eligible_reports()
+
+    for form_name, report_ids in batches:
+        send_form_reports_async.delay(form_name, report_ids)
+
+    return len(batches)
+
+
+# this sends a batch of reports for a single form; if any reports fail, we retry only those
+# reports, with an exponential backoff, so one failing report does not hold up the others.
+@celery.task(bind=True)
+def send_form_reports_async(self, form_name, report_ids):
+    refresh_form_registry_if_stale()
+
+    failed = send_report_batch(form_name, report_ids)
+
+    if len(failed) > 0 and self.request.retries < app.config["REPORT_TASK_MAX_RETRIES"]:
+        raise self.retry(args=[form_name, failed], countdown=60 * 2**self.request.retries, max_retries=app.config["REPORT_TASK_MAX_RETRIES"])
+
+    if len(failed) > 0:
+        log.error(f"LIBREFORMS - failed to send reports {', '.join(failed)} after {self.request.retries} retries.")
+
+    return failed
 
 
 # this should run periodically to refresh the elasticsearch index 
@@ -84,86 +119,24 @@ def convert_timestamp(row, now):
     
 
 
+# this periodically sends the documents written, restored or soft deleted since the last
+# cycle to the elasticsearch index, see app.search_index.
 @celery.task()
 def index_new_documents(elasticsearch_index="submissions"):
 
-    # log.info(f'LIBREFORMS - started elasticsearch index process.')
+    refresh_form_registry_if_stale()
 
     # here we exclude forms explicitly exlucded from search indexing.
-    form_list = [x for x in forms if x not in app.config["EXCLUDE_FORMS_FROM_SEARCH"]]
-    
-    # for each of these form names
-    for f in form_list:
-        
-        # log.info(f'LIBREFORMS - stated elasticsearch index for form {f}.')   
-
-        # get all the documents in the collection
-        df = mongodb.new_read_documents_from_collection(f)
-
-        # mongodb.new_read_documents_from_collection() returns False if no collection
-        # exists with that name, so we can save ourselves an otherwise wasted iteration
-        # here if any given form is not of type `DataFrame`
-        if not isinstance(df, pd.DataFrame):
-            print(f,' - empty collection - type: ', type(df))
-            continue
-
-        # print(df)
-        print(f, ' - found data - type: ', type(df))
+    form_list = [x for x in libreforms.forms if x not in app.config["EXCLUDE_FORMS_FROM_SEARCH"]]
 
-        # stringify the BSON data
-        df['_id'] = df.apply(lambda row: str(row['_id']), axis=1)
+    # we first send any search index events left over from writes, see app.search_index
+    count = flush_search_index_events(app.elasticsearch, elasticsearch_index=elasticsearch_index)
+    count += index_changed_documents(app.elasticsearch, form_list, elasticsearch_index=elasticsearch_index)
 
-        # drop the unnecessary columns
-        df.drop(columns=[x for x in mongodb.metadata_fields() if x in df.columns], inplace=True)
+    if count > 0:
+        log.info(f'LIBREFORMS - updated search index with {count} changed documents.')
 
-        # we iterate through rows
-        for index, row in df.iterrows():
-
-            id = row['_id']
-
-            # print(f'{f} - {id}')
-
-            # we write a little string to approximate the page content of the corresponding page; nb. we 
-            # exclude certain fields that are not 'content' fields...
-            fullString = ', '.join([f'{x} - {str(row[x])}' for x in df.columns if x not in mongodb.metadata_fields(exclude_id=True)])
-
-            # add back the stringified document ID
-            fullString = fullString + f', {id}' 
-
-            # this is the new form data we want to pass
-            v2_elasticsearch_content = dict(row)
-
-            # remove the _id field from the content
-            del v2_elasticsearch_content['_id']
-
-            # we construct the body payload for elasticsearch
-            elasticsearch_data = {
-                'formName': f,
-                'title': id,
-                'url': f"/submissions/{f}/{id}", 
-                # 'url': url_for('submissions.render_document', form_name=f, document_id=str(row._id)), 
-                # let's consider adding a different `_all` field, which we can call `fullString`. Here are some references
-                # that this 
-                #   https://www.elastic.co/guide/en/elasticsearch/reference/6.0/mapping-all-field.html#custom-all-fields
-                #   https://stackoverflow.com/a/34147611/13301284
-                'fullString': fullString,
-                **v2_elasticsearch_content, # pass the row data from above as kwargs
-            }
-
-            # let's stringify each element for now, just for simplicity; otherwise, we are receiving the following error:
-            # elasticsearch.exceptions.RequestError: RequestError(400, 'mapper_parsing_exception', 'failed to parse')
-            # if we want to have better typing, we should probably add a DocType object from elasticsearch-dsl
-            for key in elasticsearch_data:
-                elasticsearch_data[key] = str(elasticsearch_data[key])
-            
-            # write the item to the elasticsearch index 
-            app.elasticsearch.index(id=id, body=elasticsearch_data, index=elasticsearch_index)
-
-            # log.info(f'LIBREFORMS - updated search index for document no. {document_id}.')
-
-    return True
-
-    # log.info(f'LIBREFORMS - finished elasticsearch index process.')
+    return count
 
 
 
@@ -175,10 +148,23 @@ def setup_periodic_tasks(sender, **kwargs):
         # periodically calls send_reports 
         sender.add_periodic_task(app.config["REPORT_SEND_RATE"], send_eligible_reports_async.s(), name='send reports periodically')
 
+    # periodically send notification digests, if enabled, see app.notifications
+    if app.config["MAIL_DIGEST_WINDOW"]:
+        sender.add_periodic_task(app.config["MAIL_DIGEST_FLUSH_RATE"], flush_mail_digests_async.s(), name='send notification digests')
+
     # periodically conduct a heartbeat check
     sender.add_periodic_task(3600.0, celery_beat_logger.s(), name='log that celery beat is working')
 
     # periodically update the elasticsearch index, giving a slightly longer `time_since`
     # to avoid delay problems. We might be able to design this better ... This value ultimately
     # derives from the `elasticsearch_index_refresh_rate` app config.
-    sender.add_periodic_task(app.config["ELASTICSEARCH_INDEX_REFRESH_RATE"], index_new_documents.s(), name='update elasticsearch index')
\ No newline at end of file
+    sender.add_periodic_task(app.config["ELASTICSEARCH_INDEX_REFRESH_RATE"], index_new_documents.s(), name='update elasticsearch index')
+
+    # periodically apply any search index events left over from writes to the embedded full-text
+    # index, see app.fts; when elasticsearch is enabled, index_new_documents already does this
+    if app.config["USE_SQLITE_FTS_SEARCH"] and not app.config["USE_ELASTICSEARCH_AS_WRAPPER"]:
+        sender.add_periodic_task(app.config["ELASTICSEARCH_INDEX_REFRESH_RATE"], flush_search_index_events_async.s(), name='update full-text search index')
+
+    # periodically write Parquet snapshots of the form collections, if enabled
+    if app.config["ANALYTICS_EXPORT_RATE"]:
+        sender.add_periodic_task(app.config["ANALYTICS_EXPORT_RATE"], export_forms_to_parquet_async.s(), name='export forms to parquet')
\ No newline at end of file
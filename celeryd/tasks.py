@@ -21,6 +21,12 @@ __maintainer__ = "Sig Janoska-Bedi"
 __email__ = "signe@atreeus.com"
 
 from app import celery, log, mailer, mongodb, create_app
+from app.form_imports import import_form_upload
+from app.form_registry import refresh_form_registry_if_stale
+from app.exports import export_forms_to_parquet
+from app.notifications import flush_mail_digests
+from app.search_index import flush_search_index_events
+from app.config import config
 from flask import current_app
 import os
 from datetime import datetime
@@ -34,6 +40,40 @@ def send_mail_async(subject, content, to_address, cc_address_list=[], logfile=lo
     log.info(f'successfully sent an email to {to_address}')
 
 
+# here we define a task to send a batch of emails over a single pooled SMTP connection,
+# see Mailer.send_many in app.smtp; `messages` is a list of dicts with the `subject`, 
+# `content`, `to_address` and `cc_address_list` kwargs of send_mail_async.
+@celery.task()
+def send_mail_many_async(messages):
+    results = mailer.send_many(messages, logfile=log)
+    log.info(f'sent {sum(1 for x in results if x)} of {len(messages)} emails in a batch')
+    return results
+
+
+# here we send the queued search index events to elasticsearch and / or the embedded
+# full-text index, see app.search_index; 
+# this is scheduled by MongoDB.emit_search_index_events when documents are written.
+@celery.task()
+def flush_search_index_events_async(elasticsearch_index="submissions"):
+
+    es = None
+    if config["use_elasticsearch_as_wrapper"]:
+        from elasticsearch_dsl import connections
+        es = connections.get_connection()
+
+    return flush_search_index_events(es, elasticsearch_index=elasticsearch_index)
+
+
+# here we send the notification digests that are due, see app.notifications; this
+# is called periodically when the `mail_digest_window` config is set.
+@celery.task()
+def flush_mail_digests_async():
+    sent = flush_mail_digests()
+    if sent > 0:
+        log.info(f'sent {sent} notification digests')
+    return sent
+
+
 # here we define an asynchronous wrapper function for the app.mongo.write_documents_to_collection 
 # method, which we'll implement when the `write_documents_asynchronously` config is set, see
 # https://github.com/libreForms/libreForms-flask/issues/180.
@@ -73,3 +113,39 @@ def restart_app_async():
     #     from werkzeug.serving import shutdown_server
     #     shutdown_server()  # Stop the current server instance
     #     subprocess.Popen(["flask", "run"])  # Start a new server instance using subprocess
+
+
+# here we define a task to import CSV / Excel form uploads in the background, see the
+# discussion in app.form_imports. We publish a summary of the import progress after
+# each chunk, which the forms.upload_status view reads to report back to the user.
+@celery.task(bind=True)
+def import_form_upload_async(self, filepath, form_name, group=None, reporter=None, ip_address=None):
+
+    def publish_progress(summary):
+        self.update_state(state='PROGRESS', meta=summary)
+
+    # make sure we validate against the latest form definitions, see app.form_registry
+    refresh_form_registry_if_stale()
+
+    summary = import_form_upload(filepath, form_name, group=group, reporter=reporter, 
+                                    ip_address=ip_address, progress_callback=publish_progress)
+
+    log.info(f'{str(reporter).upper()} - imported {summary["inserted"]} rows into {form_name} from form upload.')
+
+    return summary
+
+
+# here we define an asynchronous wrapper for app.exports.export_forms_to_parquet, which
+# writes Parquet snapshots of form collections for analytics; it is also run periodically
+# when the `analytics_export_rate` app config is set.
+@celery.task()
+def export_forms_to_parquet_async(form_names=None, partition_by_month=True):
+
+    refresh_form_registry_if_stale()
+
+    summaries = export_forms_to_parquet(form_names=form_names, partition_by_month=partition_by_month)
+
+    for summary in summaries:
+        log.info(f"LIBREFORMS - exported {summary['rows']} rows of {summary['form_name']} to {summary['path']}.")
+
+    return summaries
@@ -53,7 +53,7 @@ __license__     = "AGPL-3.0"
 __maintainer__  = "Sig Janoska-Bedi"
 __email__       = "signe@atreeus.com"
 
-import datetime, os, json
+import datetime, os, json, importlib
 
 forms = {
     "sample-form": {
@@ -113,6 +113,7 @@ forms = {
         "_allow_repeat": False, # defaults to False
         "_description": False, # defaults to False
         "_smtp_notifications": False, # defaults to False
+        "_digest_notifications": True, # defaults to True, only applies when the `mail_digest_window` app config is set
         "_allow_anonymous_access": False, # defaults to False
         "_allow_csv_uploads": True, # defaults to False
         "_allow_csv_templates": True, # defaults to False
@@ -120,24 +121,45 @@ forms = {
     },
 }
 
+# we keep a reference to the sample form above, which we fall back to
+# if administrators have not defined their own forms
+default_forms = forms
+
 # read forms from file as form
-# overwrite/append form to forms in this file
-try:
-    import libreforms.form_config as form_config
-    forms_appended = dict(forms)            # this creates a copy of the original dictionary, to
-    forms_appended.update(form_config.forms)    # which we will append the form data
-    forms = form_config.forms # this is the default behavior, which overwrites the default behavior   
-except Exception as e:  # if anything above fails, we skip 
-    print (e)
+# overwrite/append form to forms in this file. When `reload_config` is set,
+# we re-import libreforms/form_config.py to pick up changes made since the 
+# application started, and raise any errors instead of falling back to the 
+# default forms; see app.form_registry for how this is used.
+def load_forms(reload_config=False):
+    try:
+        import libreforms.form_config as form_config
+        if reload_config:
+            form_config = importlib.reload(form_config)
+        forms_appended = dict(default_forms)            # this creates a copy of the original dictionary, to
+        forms_appended.update(form_config.forms)    # which we will append the form data
+        return form_config.forms # this is the default behavior, which overwrites the default behavior   
+    except Exception as e:  # if anything above fails, we skip 
+        if reload_config:
+            raise
+        print (e)
+        return default_forms
+
+forms = load_forms()
+
+# this tracks the version of the form definitions currently loaded, which 
+# is updated each time they are reloaded, see app.form_registry.
+forms_version = None
 
 # this function can be run to debug the forms located in this 
 # file and any additional form data passed through forms.d/
-def lint(forms=forms):
+def lint(forms=forms, verbose=True):
     for form in forms.keys():
-        print(form)
+        if verbose:
+            print(form)
 
         for field in forms[form].keys():
-            print(field)
+            if verbose:
+                print(field)
 
             if field.startswith("_"):
                 break
@@ -155,7 +177,7 @@ def lint(forms=forms):
             assert forms[form][field]["output_data"]
 
             # verify that the type employed conforms to one of the acceptable form fields
-            assert forms[form][field]["output_data"]["type"] in ["str", "float", "int", "list"]
+            assert forms[form][field]["output_data"]["type"] in ["str", "float", "int", "list", "date"]
 
             # verify that required is set to true or false
             assert forms[form][field]["output_data"]['required'] in [True, False]